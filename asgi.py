@@ -0,0 +1,3 @@
+from server.aio import create_app
+
+app = create_app()
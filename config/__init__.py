@@ -1,6 +1,159 @@
+import os
+import tempfile
+
+
 class BaseConfig:
     SECRET_KEY = 'development key'
 
+    # Outgoing connection pool (per worker process)
+    HTTP_POOL_SIZE = 4
+    HTTP_POOL_IDLE_TIMEOUT = 60
+    HTTP_CONNECT_TIMEOUT = 5
+
+    # Schema validation: 'input' validates only the requests and responses we
+    # receive; 'full' also re-validates our own normalized output
+    VALIDATION_MODE = 'input'
+
+    # Number of normalized requests (and responses) to cache, 0 to disable
+    NORMALIZATION_CACHE_SIZE = 1024
+
+    # JSON library: 'orjson' or 'ujson' (if installed), 'json' (the standard
+    # library), or 'auto' for the fastest installed
+    JSON_BACKEND = 'auto'
+
+    # Maximum size, in bytes, of a response from an outgoing server. With the
+    # standard library's JSON backend, install ijson (3.1+) to parse responses
+    # incrementally as they are received.
+    MAX_RESPONSE_SIZE = 16 * 1024 * 1024
+
+    # Requests to outgoing servers are shaped to each server's profile (see
+    # `python manage.py profiles`): optional fields it doesn't use are left out,
+    # and requests of at least GZIP_MIN_SIZE bytes are compressed if it accepts
+    # gzip. GZIP_RESPONSES asks servers without a profile for gzip responses.
+    GZIP_MIN_SIZE = 1024
+    GZIP_RESPONSES = True
+
+    # Cache responses from outgoing servers, by server and normalized request.
+    # RESPONSE_CACHE_SERVER_TTLS overrides the TTL (in seconds) per server id,
+    # and RESPONSE_CACHE_TEST_TTL applies to test requests (0 to not cache).
+    # Clients can bypass the cache with `Cache-Control: no-cache` or `?cache=false`.
+    RESPONSE_CACHE_ENABLED = False
+    RESPONSE_CACHE_SIZE = 1024
+    RESPONSE_CACHE_TTL = 300
+    RESPONSE_CACHE_SERVER_TTLS = {}
+    RESPONSE_CACHE_TEST_TTL = 0
+
+    # Send identical concurrent requests (by server and normalized request) to
+    # a server only once, and share the response. Each is still logged.
+    COALESCE_REQUESTS = True
+
+    # Rate limits, as (requests per second, burst), by client id and by
+    # receiving server id. RATE_LIMIT_DEFAULT applies to clients without their
+    # own limit (None for no limit). Requests over the limit get a 429 with a
+    # Retry-After header. The worker processes share the limits through the
+    # RATE_LIMIT_DB SQLite file (None to limit each worker separately).
+    RATE_LIMITS = {}
+    RATE_LIMIT_DEFAULT = None
+    RECEIVER_RATE_LIMITS = {}
+    RATE_LIMIT_DB = os.path.join(tempfile.gettempdir(), 'mme-exchange-ratelimit.sqlite')
+
+    # Maximum number of outgoing requests in flight per worker (0 for no
+    # limit). Beyond it, requests wait their turn, and clients are served in
+    # proportion to their CLIENT_WEIGHTS (default 1), so that one client's
+    # batch of requests cannot starve the others.
+    OUTBOUND_MAX_CONCURRENCY = 0
+    CLIENT_WEIGHTS = {}
+
+    # Refuse requests to a server (with a 503) after this many consecutive
+    # failures, and probe it again after CIRCUIT_BREAKER_RESET_TIMEOUT seconds
+    CIRCUIT_BREAKER_ENABLED = True
+    CIRCUIT_BREAKER_FAILURES = 5
+    CIRCUIT_BREAKER_RESET_TIMEOUT = 30
+
+    # Shorten the timeout for a server to a multiple of its observed latency
+    # percentile (over the last HEALTH_WINDOW requests), but not below the minimum
+    ADAPTIVE_TIMEOUT_ENABLED = True
+    ADAPTIVE_TIMEOUT_PERCENTILE = 99
+    ADAPTIVE_TIMEOUT_MULTIPLIER = 3
+    ADAPTIVE_TIMEOUT_MIN = 2
+    HEALTH_WINDOW = 100
+
+    # Reload the server registry after this many seconds, or whenever the
+    # stamp file is touched (by `manage.py servers ...`)
+    SERVER_REGISTRY_TTL = 300
+    SERVER_REGISTRY_STAMP_FILE = os.path.join(tempfile.gettempdir(), 'mme-exchange-servers.stamp')
+
+    # Maximum number of concurrent outgoing requests for /v1/servers/match
+    BROADCAST_MAX_WORKERS = 16
+
+    # Batch jobs posted to /v1/jobs (one match request per line) are stored in
+    # JOBS_DIR and run in the background by up to JOBS_MAX_WORKERS threads per
+    # worker, sending at most JOBS_RECEIVER_CONCURRENCY requests to any server
+    # at once. Rate limited requests are retried up to JOBS_RETRIES times. Jobs
+    # are deleted JOBS_TTL seconds after they were last updated.
+    JOBS_DIR = os.path.join(tempfile.gettempdir(), 'mme-exchange-jobs')
+    JOBS_MAX_ITEMS = 10000
+    JOBS_MAX_WORKERS = 8
+    JOBS_RECEIVER_CONCURRENCY = 2
+    JOBS_RETRIES = 3
+    JOBS_TIMEOUT = 20
+    JOBS_TTL = 7 * 24 * 60 * 60
+
+    # Write-behind buffer for the exchange log: documents are indexed in bulk
+    # every STATS_FLUSH_INTERVAL seconds or STATS_BATCH_SIZE documents. When the
+    # buffer is full, wait up to STATS_BLOCK_TIMEOUT seconds, then drop.
+    STATS_WRITE_BEHIND = True
+    STATS_BUFFER_SIZE = 10000
+    STATS_BATCH_SIZE = 500
+    STATS_FLUSH_INTERVAL = 1.0
+    STATS_BLOCK_TIMEOUT = 0
+
+    # The exchange log is partitioned into an index per 'day' or 'month' (None
+    # for a single index), all in the `exchanges` alias. `manage.py stats
+    # retention` deletes partitions older than STATS_RETENTION_DAYS (None to
+    # keep them all), and merges those older than STATS_FORCEMERGE_DAYS.
+    STATS_PARTITION = 'month'
+    STATS_RETENTION_DAYS = None
+    STATS_FORCEMERGE_DAYS = 7
+
+    # Compression of logged payloads ('zlib', or 'zstd' if zstandard is
+    # installed). Identical request bodies are stored only once.
+    STATS_COMPRESSION = 'zlib'
+    STATS_DEDUPLICATE_REQUESTS = True
+
+    # Hourly exchange statistics per sender and receiver, served at
+    # /v1/stats/exchanges. Each worker indexes its changed totals every
+    # ROLLUP_FLUSH_INTERVAL seconds. Exchanges logged before this was enabled
+    # are added with `manage.py stats backfill`.
+    ROLLUPS_ENABLED = True
+    ROLLUP_FLUSH_INTERVAL = 10
+
+    # Logged exchanges can be queried at /v1/exchanges with this token in the
+    # X-Auth-Token header. The API is disabled if it is not set.
+    EXCHANGE_LOG_AUTH_TOKEN = None
+
+    # Trace each request, timing its stages (parsing, normalization, each
+    # phase of the upstream requests, logging...). Traces are passed to
+    # TRACE_EXPORTER: 'file' appends them to TRACE_FILE as JSON lines, or give
+    # the import path (module:Class) of an exporter class. The clients in
+    # SERVER_TIMING_CLIENTS ('*' for all) also get the timings of their
+    # requests in a Server-Timing header.
+    TRACING_ENABLED = False
+    TRACE_EXPORTER = 'file'
+    TRACE_FILE = os.path.join(tempfile.gettempdir(), 'mme-exchange-traces.jsonl')
+    SERVER_TIMING_CLIENTS = []
+
+    # Metrics are served at /metrics. With several worker processes, set
+    # METRICS_DIR so that each worker writes its metrics there and any worker
+    # can export the totals. If METRICS_AUTH_TOKEN is set, it must be given in
+    # the X-Auth-Token header.
+    METRICS_DIR = os.getenv('METRICS_DIR')
+    METRICS_WRITE_INTERVAL = 5
+    METRICS_AUTH_TOKEN = None
+
+    # Threads for the synchronous parts of requests in the async engine
+    ASYNC_MAX_THREADS = 32
+
     @staticmethod
     def init_app(app):
         pass
@@ -1,6 +1,67 @@
+import os
+import shutil
+
 bind = 'localhost:8008'
 workers = 3
 umask = '0o007'
 accesslog = '-'
 errorlog = '-'
 loglevel = 'info'
+
+# Serving engine: 'sync' (Flask/WSGI) or 'async' (asyncio/ASGI, requires uvicorn)
+engine = os.getenv('GATEWAY_ENGINE', 'sync')
+if engine == 'async':
+    wsgi_app = 'asgi:app'
+    worker_class = 'uvicorn.workers.UvicornWorker'
+else:
+    wsgi_app = 'wsgi:app'
+
+# Import and warm up the application once, in the master process, so that
+# workers are forked ready to serve and share its memory. Code changes then
+# need a restart, rather than a HUP.
+preload_app = True
+
+# Workers share their metrics through this directory
+metrics_dir = os.environ.setdefault('METRICS_DIR', '/tmp/mme-exchange-metrics')
+
+
+def on_starting(server):
+    # Start counting from zero
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
+
+def when_ready(server):
+    from server import warm_up
+    warm_up()
+
+    from server.metrics import compact_snapshots
+    compact_snapshots(metrics_dir)
+
+
+def post_worker_init(worker):
+    # Resume batch jobs left unfinished by workers that exited
+    from server import get_job_runner
+    get_job_runner()
+
+
+def worker_exit(server, worker):
+    # Finish the batch job items in progress; other workers resume the rest
+    from server.jobs import close_runner
+    close_runner()
+
+    # Index any buffered exchange logs and rollups before the worker exits
+    from server.managers.bulk import close_writer
+    close_writer()
+
+    # Keep the worker's final counts
+    from server.metrics import close_snapshot_writer
+    close_snapshot_writer()
+
+
+def child_exit(server, worker):
+    # Fold the exited worker's metrics into those of earlier workers, so
+    # recycled workers' snapshots don't accumulate. This runs in the master
+    # process, once the worker has written its final snapshot.
+    from server.metrics import compact_snapshots
+    compact_snapshots(metrics_dir)
@@ -12,6 +12,7 @@ from server import app
 __package__ = 'server'
 DEFAULT_HOST = '0.0.0.0'
 DEFAULT_PORT = 8000
+ENGINES = ['sync', 'async']
 
 
 def run_tests():
@@ -19,8 +20,259 @@ def run_tests():
     unittest.TextTestRunner().run(suite)
 
 
+def start(host=DEFAULT_HOST, port=DEFAULT_PORT, engine='sync'):
+    if engine == 'async':
+        try:
+            import uvicorn
+        except ImportError:
+            sys.exit('The async engine requires uvicorn: pip install uvicorn')
+
+        from server.aio import create_app
+        uvicorn.run(create_app(app), host=host, port=port)
+    else:
+        app.run(host=host, port=port)
+
+
+def manage_servers(command, args):
+    """Run a `mme-server` servers/clients command, then reload the server registry"""
+    from mme_server.cli import main as mme_server_main
+    from server.registry import invalidate
+
+    try:
+        mme_server_main([command] + args)
+    finally:
+        invalidate(app.config['SERVER_REGISTRY_STAMP_FILE'])
+
+
+def migrate_stats(batch_size=500):
+    """Re-encode exchange logs stored in the legacy uncompressed format"""
+    from mme_server.backend import get_backend
+
+    with app.app_context():
+        stats = get_backend().get_manager('stats')
+        migrated = stats.migrate(batch_size=batch_size)
+    print('Migrated {} documents'.format(migrated))
+
+
+def backfill_stats(since=None, until=None, batch_size=500):
+    """Add exchanges logged before statistics were recorded to the hourly statistics"""
+    from datetime import datetime
+    from mme_server.backend import get_backend
+
+    since = datetime.strptime(since, '%Y-%m-%d') if since else None
+    until = datetime.strptime(until, '%Y-%m-%d') if until else None
+    with app.app_context():
+        rollups = get_backend().get_manager('rollups')
+        counted = rollups.backfill(since=since, until=until, batch_size=batch_size)
+    print('Counted {} exchanges'.format(counted))
+
+
+def rollover_stats():
+    """Create the current and next exchange log partitions"""
+    from mme_server.backend import get_backend
+
+    with app.app_context():
+        stats = get_backend().get_manager('stats')
+        created = stats.rollover()
+    print('Created {} partitions{}'.format(len(created), ''.join(' ' + index for index in created)))
+
+
+def apply_stats_retention(keep_days=None, forcemerge_days=None, drop_legacy=False, dry_run=False):
+    """Delete or compact old exchange log partitions"""
+    from mme_server.backend import get_backend
+
+    with app.app_context():
+        if keep_days is None:
+            keep_days = app.config.get('STATS_RETENTION_DAYS')
+        if forcemerge_days is None:
+            forcemerge_days = app.config.get('STATS_FORCEMERGE_DAYS')
+
+        stats = get_backend().get_manager('stats')
+        actions = stats.apply_retention(keep_days=keep_days, forcemerge_days=forcemerge_days,
+                                        drop_legacy=drop_legacy, dry_run=dry_run)
+    for action, index in actions:
+        print('{}{} {}'.format('Would ' if dry_run else '', action, index))
+
+
+def set_profile(server_id, fields=None, gzip_requests=False, gzip_responses=True):
+    """Store a server's capability profile, and reload the server registry"""
+    from mme_server.backend import get_backend
+    from server.registry import invalidate
+
+    profile = {
+        'fields': fields,
+        'gzip_requests': gzip_requests,
+        'gzip_responses': gzip_responses,
+    }
+    with app.app_context():
+        profiles = get_backend().get_manager('profiles')
+        try:
+            profiles.set_profile(server_id, profile)
+        except ValueError as e:
+            sys.exit(str(e))
+    invalidate(app.config['SERVER_REGISTRY_STAMP_FILE'])
+
+
+def remove_profile(server_id):
+    """Delete a server's capability profile, and reload the server registry"""
+    from mme_server.backend import get_backend
+    from server.registry import invalidate
+
+    with app.app_context():
+        profiles = get_backend().get_manager('profiles')
+        if not profiles.delete_profile(server_id):
+            sys.exit('No profile for server: {}'.format(server_id))
+    invalidate(app.config['SERVER_REGISTRY_STAMP_FILE'])
+
+
+def list_profiles():
+    """Print the servers' capability profiles"""
+    from mme_server.backend import get_backend
+
+    with app.app_context():
+        profiles = get_backend().get_manager('profiles').get_profiles()
+    for server_id, profile in sorted(profiles.items()):
+        fields = profile.get('fields')
+        print('{}\tfields={}\tgzip_requests={}\tgzip_responses={}'.format(
+            server_id, 'all' if fields is None else ','.join(fields) or 'none',
+            profile.get('gzip_requests', False), profile.get('gzip_responses', True)))
+
+
+def bench(output=None, baseline=None, **kwargs):
+    """Benchmark the exchange server against local mock MME nodes"""
+    import json
+    from server.bench import run_benchmark, format_report
+
+    report = run_benchmark(app, **kwargs)
+
+    if baseline:
+        with open(baseline) as ifp:
+            baseline = json.load(ifp)
+    print(format_report(report, baseline=baseline))
+
+    if output:
+        with open(output, 'w') as ofp:
+            json.dump(report, ofp, indent=2, sort_keys=True)
+
+
+def bench_startup(output=None, baseline=None, **kwargs):
+    """Measure how long new workers take to serve their first request"""
+    import json
+    from server.bench import measure_startup, format_startup_report
+
+    report = measure_startup(**kwargs)
+
+    if baseline:
+        with open(baseline) as ifp:
+            baseline = json.load(ifp)
+    print(format_startup_report(report, baseline=baseline))
+
+    if output:
+        with open(output, 'w') as ofp:
+            json.dump(report, ofp, indent=2, sort_keys=True)
+
+
+def get_replay_records(input=None, since=None, until=None, sender=None, receiver=None, tests=True,
+                       status=None, patient=None, requests=True, responses=False, limit=None, ordered=True):
+    """Get exchange records from a JSON lines export, or else from the exchange log"""
+    from datetime import datetime
+    from mme_server.backend import get_backend
+    from server import ErrorResponse, parse_status
+    from server.replay import iter_jsonl, iter_logged
+
+    if input:
+        with open(input) as ifp:
+            for record in iter_jsonl(ifp):
+                yield record
+        return
+
+    since = datetime.strptime(since, '%Y-%m-%d') if since else None
+    until = datetime.strptime(until, '%Y-%m-%d') if until else None
+    try:
+        status = parse_status(status) if status else None
+    except ErrorResponse as error:
+        sys.exit(str(error))
+
+    with app.app_context():
+        stats = get_backend().get_manager('stats')
+        for record in iter_logged(stats, include_requests=requests, include_responses=responses,
+                                  ordered=ordered, limit=limit, since=since, until=until,
+                                  sender_id=sender, receiver_id=receiver, include_tests=tests,
+                                  status=status, patient_id=patient):
+            yield record
+
+
+def export_exchanges(output=None, **kwargs):
+    """Export logged exchanges as JSON lines"""
+    from server.replay import export
+
+    if output:
+        with open(output, 'w') as ofp:
+            count = export(get_replay_records(**kwargs), ofp)
+        print('Exported {} exchanges'.format(count))
+    else:
+        export(get_replay_records(**kwargs), sys.stdout)
+
+
+def replay_exchanges(target=None, token=None, mock=False, latency=0.05, output=None, speed=1.0, concurrency=10,
+                     server=None, timeout=20, keep_test_flag=False, no_cache=False, **kwargs):
+    """Replay logged exchanges through a running exchange server, or an in-process one with a mock receiver"""
+    import json
+    import uuid
+    from server.bench import Gateway, MockNode, NODE_ID_PREFIX, format_report, register_nodes, unregister_nodes
+    from server.replay import replay
+
+    records = get_replay_records(**kwargs)
+    options = dict(speed=speed, concurrency=concurrency, timeout=timeout,
+                   mark_test=not keep_test_flag, use_cache=not no_cache)
+    if mock:
+        token = uuid.uuid4().hex
+        stamp_file = app.config.get('SERVER_REGISTRY_STAMP_FILE')
+        nodes = [MockNode(latency=latency).start()]
+        gateway = Gateway(app).start()
+        register_nodes(nodes, token, stamp_file=stamp_file)
+        try:
+            summary = replay(records, gateway.base_url, token, receiver_id='{}0'.format(NODE_ID_PREFIX), **options)
+        finally:
+            unregister_nodes(nodes, stamp_file=stamp_file)
+            gateway.stop()
+            nodes[0].stop()
+    else:
+        if not (target and token):
+            sys.exit('Specify a --target and --token, or use --mock')
+        summary = replay(records, target.rstrip('/'), token, receiver_id=server, **options)
+
+    summary['stages'] = {}
+    print(format_report({'endpoints': {'replay': summary}}))
+    print('  {:<28} {:10.1f} ms'.format('mean lag', (summary['meanLag'] or 0) * 1000))
+    if output:
+        with open(output, 'w') as ofp:
+            json.dump(summary, ofp, indent=2, sort_keys=True)
+
+
+def add_exchange_filters(parser, input=True):
+    if input:
+        parser.add_argument("--input", default=None, metavar="FILE",
+                            help="Read exchanges from a JSON lines export, instead of the exchange log")
+    parser.add_argument("--since", default=None, metavar="YYYY-MM-DD",
+                        help="Only include exchanges from this date on")
+    parser.add_argument("--until", default=None, metavar="YYYY-MM-DD",
+                        help="Only include exchanges before this date")
+    parser.add_argument("--sender", default=None, metavar="ID",
+                        help="Only include exchanges from this client")
+    parser.add_argument("--receiver", default=None, metavar="ID",
+                        help="Only include exchanges to this server")
+    parser.add_argument("--status", default=None, metavar="STATUS",
+                        help="Only include exchanges with this response status, or class of them (e.g. 5xx)")
+    parser.add_argument("--patient", default=None, metavar="ID",
+                        help="Only include exchanges about this patient, as the query or a result")
+    parser.add_argument("--no-tests", action="store_false",
+                        dest="tests",
+                        help="Exclude test requests")
+
+
 def parse_args(args):
-    from argparse import ArgumentParser
+    from argparse import ArgumentParser, REMAINDER
 
     parser = ArgumentParser()
     subparsers = parser.add_subparsers(title='subcommands')
@@ -31,7 +283,172 @@ def parse_args(args):
     subparser.add_argument("--host", default=DEFAULT_HOST,
                            dest="host", metavar="IP",
                            help="The host the server will listen to (0.0.0.0 to listen globally; 127.0.0.1 to listen locally; default: %(default)s)")
-    subparser.set_defaults(function=app.run)
+    subparser.add_argument("--engine", default=ENGINES[0], choices=ENGINES,
+                           dest="engine",
+                           help="Serve with synchronous Flask, or proxy match requests with asyncio (default: %(default)s)")
+    subparser.set_defaults(function=start)
+
+    for command in ['servers', 'clients']:
+        subparser = subparsers.add_parser(command, description="Manage {} with `mme-server {}`, and reload them in the running exchange server".format(command, command))
+        subparser.add_argument("args", nargs=REMAINDER,
+                               help="Arguments passed on to `mme-server {}`".format(command))
+        subparser.set_defaults(function=manage_servers, command=command)
+
+    subparser = subparsers.add_parser('stats', description="Manage the exchange logs")
+    stats_subparsers = subparser.add_subparsers(title='subcommands')
+    subparser = stats_subparsers.add_parser('migrate', description="Compress exchange logs stored in the legacy base64 JSON format")
+    subparser.add_argument("--batch-size", default=500,
+                           dest="batch_size", type=int, metavar="N",
+                           help="The number of documents to update per bulk request (default: %(default)s)")
+    subparser.set_defaults(function=migrate_stats)
+    subparser = stats_subparsers.add_parser('backfill', description="Compute hourly statistics for exchanges logged before they were recorded")
+    subparser.add_argument("--since", default=None,
+                           dest="since", metavar="YYYY-MM-DD",
+                           help="Only count exchanges from this date on (default: all)")
+    subparser.add_argument("--until", default=None,
+                           dest="until", metavar="YYYY-MM-DD",
+                           help="Only count exchanges before this date (default: all)")
+    subparser.add_argument("--batch-size", default=500,
+                           dest="batch_size", type=int, metavar="N",
+                           help="The number of statistics documents to index per bulk request (default: %(default)s)")
+    subparser.set_defaults(function=backfill_stats)
+    subparser = stats_subparsers.add_parser('rollover', description="Create the current and next exchange log partitions ahead of time (they are otherwise created when first written to)")
+    subparser.set_defaults(function=rollover_stats)
+    subparser = stats_subparsers.add_parser('retention', description="Delete exchange log partitions past the retention period, and merge older partitions into a single segment")
+    subparser.add_argument("--keep-days", default=None,
+                           dest="keep_days", type=int, metavar="DAYS",
+                           help="Delete partitions that ended more than this many days ago (default: STATS_RETENTION_DAYS)")
+    subparser.add_argument("--forcemerge-days", default=None,
+                           dest="forcemerge_days", type=int, metavar="DAYS",
+                           help="Merge partitions that ended more than this many days ago (default: STATS_FORCEMERGE_DAYS)")
+    subparser.add_argument("--drop-legacy", action="store_true",
+                           dest="drop_legacy",
+                           help="Also delete the unpartitioned exchange index, once all its exchanges are past the retention period")
+    subparser.add_argument("--dry-run", action="store_true",
+                           dest="dry_run",
+                           help="Only print what would be done")
+    subparser.set_defaults(function=apply_stats_retention)
+    subparser = stats_subparsers.add_parser('export', description="Export logged exchanges as JSON lines, without their payloads unless requested")
+    add_exchange_filters(subparser, input=False)
+    subparser.add_argument("--requests", action="store_true",
+                           help="Include the decoded requests")
+    subparser.add_argument("--responses", action="store_true",
+                           help="Include the decoded responses")
+    subparser.add_argument("--limit", default=None, type=int, metavar="N",
+                           help="Export at most this many exchanges")
+    subparser.add_argument("--unordered", action="store_false",
+                           dest="ordered",
+                           help="Don't sort the exchanges by time (faster)")
+    subparser.add_argument("-o", "--output", default=None, metavar="FILE",
+                           help="Write to this file (default: standard output)")
+    subparser.set_defaults(function=export_exchanges)
+
+    subparser = subparsers.add_parser('profiles', description="Manage the capability profiles that requests to outgoing servers are shaped to")
+    profiles_subparsers = subparser.add_subparsers(title='subcommands')
+    subparser = profiles_subparsers.add_parser('set', description="Set a server's profile, replacing any existing one")
+    subparser.add_argument("server_id", metavar="SERVER_ID",
+                           help="The id of the outgoing server")
+    subparser.add_argument("--fields", default=None, nargs='*',
+                           dest="fields", metavar="FIELD",
+                           help="The optional request fields the server uses, as dotted paths like patient.features.label (default: all; none if given without fields)")
+    subparser.add_argument("--gzip-requests", action="store_true",
+                           dest="gzip_requests",
+                           help="Send gzip-compressed requests to the server")
+    subparser.add_argument("--no-gzip-responses", action="store_false",
+                           dest="gzip_responses",
+                           help="Don't ask the server for gzip-compressed responses")
+    subparser.set_defaults(function=set_profile)
+    subparser = profiles_subparsers.add_parser('rm', description="Delete a server's profile, so it is sent full requests")
+    subparser.add_argument("server_id", metavar="SERVER_ID",
+                           help="The id of the outgoing server")
+    subparser.set_defaults(function=remove_profile)
+    subparser = profiles_subparsers.add_parser('list', description="List the servers' profiles")
+    subparser.set_defaults(function=list_profiles)
+
+    subparser = subparsers.add_parser('bench', description="Benchmark the exchange server against local mock MME nodes, which are registered as servers for the duration of the benchmark")
+    subparser.add_argument("--nodes", default=1, type=int, metavar="N",
+                           help="The number of mock MME nodes (default: %(default)s)")
+    subparser.add_argument("--latency", default=0.05, type=float, metavar="SECONDS",
+                           help="The mean response time of the mock nodes (default: %(default)s)")
+    subparser.add_argument("--jitter", default=0.0, type=float, metavar="SECONDS",
+                           help="The maximum random variation of the response time (default: %(default)s)")
+    subparser.add_argument("--error-rate", default=0.0, type=float, metavar="FRACTION",
+                           dest="error_rate",
+                           help="The fraction of requests the mock nodes fail (default: %(default)s)")
+    subparser.add_argument("--results", default=5, type=int, metavar="N",
+                           help="The number of results in each mock response (default: %(default)s)")
+    subparser.add_argument("-c", "--concurrency", default=10, type=int, metavar="N",
+                           help="The number of concurrent clients (default: %(default)s)")
+    subparser.add_argument("-n", "--requests", default=1000, type=int, metavar="N",
+                           help="The number of requests per endpoint (default: %(default)s)")
+    subparser.add_argument("--distinct", default=100, type=int, metavar="N",
+                           help="The number of distinct request bodies (default: %(default)s)")
+    subparser.add_argument("--endpoint", action="append", choices=['match', 'validate'],
+                           dest="endpoints",
+                           help="An endpoint to benchmark, may be repeated (default: all)")
+    subparser.add_argument("--timeout", default=60, type=int, metavar="SECONDS",
+                           help="The timeout for each request (default: %(default)s)")
+    subparser.add_argument("--cache", action="store_true",
+                           dest="use_cache",
+                           help="Allow cached responses from the mock nodes")
+    subparser.add_argument("--json-backend", default=None, choices=['orjson', 'ujson', 'json'],
+                           dest="json_backend",
+                           help="The JSON library for the exchange server to use (default: as configured)")
+    subparser.add_argument("-o", "--output", default=None, metavar="FILE",
+                           help="Save the results as JSON")
+    subparser.add_argument("--baseline", default=None, metavar="FILE",
+                           help="Compare with results saved by an earlier run")
+    subparser.set_defaults(function=bench, endpoints=None)
+
+    subparser = subparsers.add_parser('bench-startup', description="Measure how long a new worker takes to import the exchange server and serve its first request, both from a cold start and forked from a preloaded, warmed up process")
+    subparser.add_argument("--repeat", default=5, type=int, metavar="N",
+                           help="The number of times to start each kind of worker (default: %(default)s)")
+    subparser.add_argument("--mode", action="append", choices=['cold', 'preload'],
+                           dest="modes",
+                           help="A kind of worker start to measure, may be repeated (default: all)")
+    subparser.add_argument("-o", "--output", default=None, metavar="FILE",
+                           help="Save the results as JSON")
+    subparser.add_argument("--baseline", default=None, metavar="FILE",
+                           help="Compare with results saved by an earlier run")
+    subparser.set_defaults(function=bench_startup, modes=None)
+
+    subparser = subparsers.add_parser('replay', description="Replay logged exchanges, or export them for replaying later")
+    replay_subparsers = subparser.add_subparsers(title='subcommands')
+    subparser = replay_subparsers.add_parser('export', description="Export logged exchanges as JSON lines, in order")
+    add_exchange_filters(subparser)
+    subparser.add_argument("--responses", action="store_true",
+                           help="Include the logged responses")
+    subparser.add_argument("-o", "--output", default=None, metavar="FILE",
+                           help="Write to this file (default: standard output)")
+    subparser.set_defaults(function=export_exchanges)
+
+    subparser = replay_subparsers.add_parser('run', description="Send logged exchanges through the exchange server with their original timing")
+    add_exchange_filters(subparser)
+    subparser.add_argument("--target", default=None, metavar="URL",
+                           help="The base URL of the exchange server")
+    subparser.add_argument("--token", default=None, metavar="KEY",
+                           help="The client auth token to send requests with")
+    subparser.add_argument("--mock", action="store_true",
+                           help="Send requests through an in-process exchange server to a local mock MME node instead")
+    subparser.add_argument("--latency", default=0.05, type=float, metavar="SECONDS",
+                           help="The response time of the mock node (default: %(default)s)")
+    subparser.add_argument("--server", default=None, metavar="ID",
+                           help="Send every request to this server, instead of the original receiver")
+    subparser.add_argument("--speed", default=1.0, type=float, metavar="FACTOR",
+                           help="Replay this many times faster than the original traffic, 0 for as fast as possible (default: %(default)s)")
+    subparser.add_argument("-c", "--concurrency", default=10, type=int, metavar="N",
+                           help="The maximum number of requests in flight (default: %(default)s)")
+    subparser.add_argument("--timeout", default=20, type=int, metavar="SECONDS",
+                           help="The timeout for each request (default: %(default)s)")
+    subparser.add_argument("--keep-test-flag", action="store_true",
+                           dest="keep_test_flag",
+                           help="Don't mark replayed requests as test requests")
+    subparser.add_argument("--no-cache", action="store_true",
+                           dest="no_cache",
+                           help="Bypass the exchange server's response cache")
+    subparser.add_argument("-o", "--output", default=None, metavar="FILE",
+                           help="Save the results as JSON")
+    subparser.set_defaults(function=replay_exchanges)
 
     subparser = subparsers.add_parser('test', description="Run tests")
     subparser.set_defaults(function=run_tests)
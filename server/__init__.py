@@ -1,15 +1,17 @@
 import os
 
+import hmac
 import logging
-import json
+import math
+import socket
+import time
 import flask
 
 from collections import defaultdict
-from datetime import datetime
-from elasticsearch_dsl import Search
+from copy import deepcopy
+from datetime import datetime, timedelta
 from flask import after_this_request, jsonify, render_template, request as flask_request
 from flask_negotiate import consumes, produces
-from werkzeug.exceptions import BadRequest
 
 from mme_server.auth import auth_token_required
 from mme_server.backend import get_backend
@@ -17,9 +19,26 @@ from mme_server.server import app, API_MIME_TYPE
 from mme_server.models import MatchRequest, MatchResponse
 from mme_server.schemas import validate_request, validate_response, ValidationError
 
-from .compat import urlopen, HTTPError, Request
-# Import manager to register
-from .managers import StatsManager
+from . import serialization
+from .broadcast import broadcast, get_recipients
+from .coalesce import get_single_flight, CallTimeout
+from .cache import canonical_hash, get_cache, get_cache_stats, TTLCache
+from .health import get_current_tracker, get_tracker, OPEN
+from .jobs import Job, get_runner, remove_expired
+from .managers.bulk import get_current_writer
+from .merge import merge_results
+from .metrics import (clock, registry as metrics_registry, upstream_coalesced, upstream_seconds, upstream_requests,
+                      upstream_in_flight, http_requests, http_in_flight, export_text, read_snapshots,
+                      get_snapshot_writer)
+from .pool import get_pool
+from .ratelimit import get_current_scheduler, get_scheduler, get_store, RateLimiter
+from .registry import get_registry, DEFAULT_STAMP_FILE, DEFAULT_TTL as DEFAULT_REGISTRY_TTL
+from .shaping import get_stripped_fields, gunzip_data, gzip_data, strip_fields, DEFAULT_GZIP_MIN_SIZE
+from .streaming import iter_json, iter_json_lines, read_json, LimitedReader, ResponseTooLarge, DEFAULT_MAX_SIZE
+from .tracing import add_span, end_trace, format_server_timing, get_exporter, span, stage, start_trace
+# Import managers to register
+from .managers import PayloadManager, ProfileManager, RollupManager, StatsManager
+from .managers.rollups import GROUP_FIELDS, INTERVALS
 
 VERSION = '0.1'
 USER_AGENT = 'mme-exchange-server/{}'.format(VERSION)
@@ -29,19 +48,22 @@ logger = logging.getLogger(__name__)
 # Default to development configuration
 app_settings = os.getenv('APP_SETTINGS', 'config.dev.Config')
 app.config.from_object(app_settings)
+serialization.configure(app.config.get('JSON_BACKEND', 'auto'))
 app.template_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
 
 
 class ErrorResponse(Exception):
     """Custom Exception class that wraps an error response"""
-    def __init__(self, message, status=500):
+    def __init__(self, message, status=500, headers=None):
         self.message = message
         self.status = status
+        self.headers = headers or {}
 
     def get_response(self):
         data = { 'message': self.message }
         response = jsonify(**data)
         response.status_code = self.status
+        response.headers.extend(self.headers)
         return response
 
     def __str__(self):
@@ -49,11 +71,20 @@ class ErrorResponse(Exception):
 
 
 class MMERequest:
-    def __init__(self, body, sender_id=None, timestamp=None):
+    def __init__(self, body, sender_id=None, timestamp=None, data=None):
+        """
+        body - the parsed request
+        data - the request as received (UTF-8 encoded JSON), if available
+        """
         assert body
         self.body = body
+        self.data = data
         self.sender_id = sender_id
         self.timestamp = datetime.now() if timestamp is None else timestamp
+        self.hash = None
+        self.normalized_hash = None
+        # Serialized (and compressed) normalized requests, by (stripped fields, gzip)
+        self.payloads = {}
         self.prepared = self._normalize_request(body)
 
     def is_test(self):
@@ -62,10 +93,33 @@ class MMERequest:
     def get_raw(self):
         return self.body
 
+    def get_raw_data(self):
+        """Get the request as received, or None if not available"""
+        return self.data
+
     def get_normalized(self):
         assert self.prepared is not None, 'Request was not normalized'
         return self.prepared
 
+    def get_normalized_data(self, stripped_fields=(), compress=False):
+        """Get the normalized request, serialized once for all servers with the same profile
+
+        stripped_fields - optional fields to leave out (see shaping.get_stripped_fields)
+        compress - whether to compress the data with gzip
+        """
+        key = (stripped_fields, compress)
+        data = self.payloads.get(key)
+        if data is None:
+            if compress:
+                data = self.get_normalized_data(stripped_fields)
+                with stage('compress_request'):
+                    data = gzip_data(data)
+            else:
+                with stage('serialize_request'):
+                    data = serialization.dumps(strip_fields(self.get_normalized(), stripped_fields))
+            self.payloads[key] = data
+        return data
+
     def get_sender_id(self):
         return self.sender_id
 
@@ -75,6 +129,18 @@ class MMERequest:
     def get_patient_id(self):
         return self.get_raw().get('patient', {}).get('id', '')
 
+    def get_hash(self):
+        """Get a hash of the raw request content"""
+        if self.hash is None:
+            self.hash = canonical_hash(self.get_raw())
+        return self.hash
+
+    def get_normalized_hash(self):
+        """Get a hash of the normalized request content"""
+        if self.normalized_hash is None:
+            self.normalized_hash = canonical_hash(self.get_normalized())
+        return self.normalized_hash
+
     def get_headers(self, auth_token=None):
         sender_id = self.get_sender_id()
         headers = {
@@ -92,25 +158,50 @@ class MMERequest:
 
     @classmethod
     def _normalize_request(cls, raw_request):
+        """Normalize and validate the request, using cached results for identical requests"""
+        cache = get_normalization_cache('request')
+        key = canonical_hash(raw_request)
+        cached = cache.get(key)
+        if cached is None:
+            try:
+                cached = (cls._normalize_request_uncached(raw_request), None)
+            except ErrorResponse as e:
+                if e.status != 422:
+                    # Don't cache errors that might be transient
+                    raise
+                cached = (None, (e.message, e.status))
+            cache.set(key, cached)
+        else:
+            logger.info('Using cached normalized request')
+
+        normalized, error = cached
+        if error:
+            raise ErrorResponse(*error)
+
+        # Callers may modify the result, so never hand out the cached copy
+        return deepcopy(normalized)
+
+    @classmethod
+    def _normalize_request_uncached(cls, raw_request):
         logger.info('Normalizing request')
         try:
-            normalized = MatchRequest.from_api(raw_request).to_api()
+            with stage('normalize_request'):
+                normalized = MatchRequest.from_api(raw_request).to_api()
         except Exception as e:
             raise ErrorResponse('Error normalizing request: {}'.format(e), status=400)
 
-        try:
-            logger.info('Validate normalized request')
-            validate_request(normalized)
-        except ValidationError as e:
-            raise ErrorResponse('Normalized request does not conform to API specification: {}'.format(e), status=422)
+        if validate_normalized():
+            try:
+                logger.info('Validate normalized request')
+                with stage('validate_normalized_request'):
+                    validate_request(normalized)
+            except ValidationError as e:
+                raise ErrorResponse('Normalized request does not conform to API specification: {}'.format(e), status=422)
 
         return normalized
 
-    def send(self, server, timeout=10):
-        """Send the request to the given server and return a MMEResponse object
-
-        timeout - terminate the request after this many seconds
-        """
+    def prepare(self, server):
+        """Get the (url, headers, data) needed to send the request to the given server"""
         server_id = server['server_id']
         base_url = server['base_url']
         auth_token = server['server_key']
@@ -121,50 +212,88 @@ class MMERequest:
 
         headers = self.get_headers(auth_token=auth_token)
 
-        logger.info('Opening request to URL: ' + match_url)
-        try:
-            request = self.get_normalized()
+        # Leave out the fields the server doesn't use, and compress if it can decompress
+        profile = server.get('profile') or {}
+        stripped_fields = get_stripped_fields(profile)
+        request_data = self.get_normalized_data(stripped_fields)
+        if profile.get('gzip_requests') and len(request_data) >= app.config.get('GZIP_MIN_SIZE', DEFAULT_GZIP_MIN_SIZE):
+            request_data = self.get_normalized_data(stripped_fields, compress=True)
+            headers['Content-Encoding'] = 'gzip'
+        if profile.get('gzip_responses', app.config.get('GZIP_RESPONSES', True)):
+            headers['Accept-Encoding'] = 'gzip'
 
-            # Serialize request
-            request_data = json.dumps(request).encode('utf-8')
+        return match_url, headers, request_data
 
-            sent_request_at = datetime.now()
-            req = Request(match_url, data=request_data, headers=headers)
-            try:
-                handler = urlopen(req, timeout=timeout)
-                code = handler.getcode()
-                response_body = handler
-            except HTTPError as e:
-                # Handle HTTP Errors thrown for non-200 responses
-                code = e.code
-                response_body = e
-
-            logger.info('Received HTTP {}'.format(code))
-            received_response_at = datetime.now()
-            elapsed_time = (received_response_at - sent_request_at).total_seconds()
-
-            logger.info('Loading response')
-            response_data = response_body.read().decode('utf-8')
-            response = json.loads(response_data)
+    def send(self, server, timeout=10):
+        """Send the request to the given server and return a MMEResponse object
+
+        timeout - terminate the request after this many seconds
+        """
+        request = self.get_normalized()
+        match_url, headers, request_data = self.prepare(server)
+
+        server_id = server['server_id']
+        logger.info('Opening request to URL: ' + match_url)
+        try:
+            sent_request_at = clock()
+            pool = get_connection_pool()
+            with stage('upstream', server=server_id), pool.urlopen('POST', match_url, body=request_data, headers=headers, timeout=timeout) as response_body:
+                code = response_body.getcode()
+
+                logger.info('Received HTTP {}'.format(code))
+                elapsed_time = clock() - sent_request_at
+                for phase in ['dns', 'tcp', 'tls', 'ttfb']:
+                    if phase in response_body.timings:
+                        add_span('upstream_{}'.format(phase), *response_body.timings[phase], server=server_id)
+
+                logger.info('Loading response')
+                max_size = app.config.get('MAX_RESPONSE_SIZE', DEFAULT_MAX_SIZE)
+                with span('upstream_body', server=server_id):
+                    if response_body.getheader('Content-Encoding', '').lower() == 'gzip':
+                        response_data = gunzip_data(LimitedReader(response_body, max_size=max_size).read(),
+                                                    max_size=max_size)
+                        response = serialization.loads(response_data)
+                    else:
+                        response, response_data = read_json(
+                            response_body, max_size=max_size,
+                            content_length=response_body.getheader('Content-Length'))
+                response_body.release()
         except Exception as e:
             logger.error('Request resulted in error: {}'.format(e))
+            if is_timeout(e):
+                return MMEResponse(request, {'message': 'Request timed out'}, status=504)
+            elif isinstance(e, ResponseTooLarge):
+                return MMEResponse(request, {'message': str(e)}, status=502)
             return MMEResponse(request, {'message': str(e)}, status=500)
 
-        return MMEResponse(request, response, status=code, time=elapsed_time)
+        return MMEResponse(request, response, status=code, time=elapsed_time, data=response_data)
 
 
 class MMEResponse:
-    def __init__(self, request, body, status=200, time=0):
+    def __init__(self, request, body, status=200, time=0, data=None):
+        """
+        body - the parsed response
+        data - the response as received (UTF-8 encoded JSON), if available
+        """
         assert request and body
         self.request = request
         self.body = body
+        self.data = data
         self.status = status
         self.time = time
+        # 'HIT' or 'MISS' if the response cache was used, else None
+        self.cache_status = None
+        # Seconds until the request may be retried, if it was rate limited
+        self.retry_after = None
         self.prepared = self._normalize_response(body, status=status, request=request)
 
     def get_raw(self):
         return self.body
 
+    def get_raw_data(self):
+        """Get the response as received, or None if not available"""
+        return self.data
+
     def get_normalized(self):
         assert self.prepared is not None, 'Response was not normalized'
         return self.prepared
@@ -175,6 +304,9 @@ class MMEResponse:
     def get_time(self):
         return self.time
 
+    def get_cache_status(self):
+        return self.cache_status
+
     def get_patient_ids(self):
         pids = []
         for result in self.get_raw().get('results', []):
@@ -183,10 +315,14 @@ class MMEResponse:
         return pids
 
     def get_response(self):
-        """Get the HTTP response"""
+        """Get the HTTP response, streaming the serialized JSON"""
         assert self.prepared is not None, 'Response was not normalized'
-        response = jsonify(self.prepared)
+        response = app.response_class(iter_json(self.prepared), mimetype='application/json')
         response.status_code = self.status
+        if self.cache_status:
+            response.headers['X-Cache'] = self.cache_status
+        if self.retry_after is not None:
+            response.headers['Retry-After'] = '{}'.format(self.retry_after)
         return response
 
     @classmethod
@@ -195,31 +331,309 @@ class MMEResponse:
             # Just use the raw response directly
             return raw_response
 
+        cache = get_normalization_cache('response')
+        key = canonical_hash(raw_response)
+        normalized = cache.get(key)
+        if normalized is None:
+            normalized = cls._normalize_response_uncached(raw_response)
+            cache.set(key, normalized)
+        else:
+            logger.info('Using cached normalized response')
+
+        # Callers may modify the result, so never hand out the cached copy
+        normalized = deepcopy(normalized)
+
+        if request:
+            # Inject request data into response
+            normalized['_request'] = request
+
+        return normalized
+
+    @classmethod
+    def _normalize_response_uncached(cls, raw_response):
         logger.info('Validating response syntax')
         try:
-            validate_response(raw_response)
+            with stage('validate_response'):
+                validate_response(raw_response)
         except ValidationError as e:
             # log and return response anyway
             logger.warning('Response does not conform to API specification:\n{}'.format(e))
 
         try:
             logger.info('Normalizing response')
-            normalized = MatchResponse.from_api(raw_response).to_api()
+            with stage('normalize_response'):
+                normalized = MatchResponse.from_api(raw_response).to_api()
         except Exception as e:
             # log and return response anyway
             logger.warning('Error normalizing response:\n{}'.format(e))
+            return raw_response
+
+        if validate_normalized():
+            try:
+                with stage('validate_normalized_response'):
+                    validate_response(normalized)
+            except ValidationError as e:
+                # log and return response anyway
+                logger.warning('Normalized response does not conform to API specification:\n{}'.format(e))
+
+        return normalized
+
+
+def get_response_cache_ttl(request, server):
+    """Get the number of seconds to cache responses to the request from the server
+
+    Returns 0 if the response should not be cached.
+    """
+    if not app.config.get('RESPONSE_CACHE_ENABLED', False):
+        return 0
+    elif request.is_test():
+        return app.config.get('RESPONSE_CACHE_TEST_TTL', 0)
+
+    ttls = app.config.get('RESPONSE_CACHE_SERVER_TTLS', {})
+    return ttls.get(server['server_id'], app.config.get('RESPONSE_CACHE_TTL', 300))
+
+
+def get_response_cache():
+    """Get the cache of responses from outgoing servers for this worker process"""
+    return get_cache('responses', factory=TTLCache, maxsize=app.config.get('RESPONSE_CACHE_SIZE', 1024))
+
+
+def is_cache_bypassed(flask_request):
+    """Whether the client asked not to be served a cached response"""
+    cache_control = flask_request.headers.get('Cache-Control', '').lower()
+    if 'no-cache' in cache_control or 'no-store' in cache_control:
+        return True
+    return flask_request.args.get('cache', '').lower() in ['0', 'false', 'no']
+
+
+def get_cached_response(request, server):
+    """Get a fresh copy of the cached response from the server, or None"""
+    if not get_response_cache_ttl(request, server):
+        return None
+
+    key = (server['server_id'], request.get_normalized_hash())
+    cached = get_response_cache().get(key)
+    if cached is None:
+        return None
+
+    body, status = cached
+    response = MMEResponse(request.get_normalized(), body, status=status)
+    response.cache_status = 'HIT'
+    return response
+
+
+def cache_response(request, server, response):
+    """Cache the response from the server, if caching is enabled for it"""
+    ttl = get_response_cache_ttl(request, server)
+    if not ttl:
+        return
+
+    response.cache_status = 'MISS'
+    if response.get_status() == 200:
+        key = (server['server_id'], request.get_normalized_hash())
+        get_response_cache().set(key, (response.get_raw(), response.get_status()), ttl=ttl)
+
+
+def get_server_health(server):
+    """Get the health of the outgoing server, as seen by this worker process"""
+    tracker = get_tracker(window=app.config.get('HEALTH_WINDOW', 100),
+                          failure_threshold=app.config.get('CIRCUIT_BREAKER_FAILURES', 5),
+                          reset_timeout=app.config.get('CIRCUIT_BREAKER_RESET_TIMEOUT', 30))
+    return tracker.get(server['server_id'])
+
+
+def check_server_health(request, server):
+    """Get an error response if the server's circuit is open, else None"""
+    if not app.config.get('CIRCUIT_BREAKER_ENABLED', True):
+        return None
+
+    if not get_server_health(server).allow_request():
+        logger.warning('Not sending request to unavailable server: {}'.format(server['server_id']))
+        message = 'Server {} is temporarily unavailable'.format(server['server_id'])
+        return MMEResponse(request.get_normalized(), {'message': message}, status=503)
+
 
+def get_server_timeout(server, timeout):
+    """Get the timeout for a request to the server, adapted to its observed latency"""
+    if not app.config.get('ADAPTIVE_TIMEOUT_ENABLED', True):
+        return timeout
+
+    return get_server_health(server).get_timeout(
+        timeout,
+        percentile=app.config.get('ADAPTIVE_TIMEOUT_PERCENTILE', 99),
+        multiplier=app.config.get('ADAPTIVE_TIMEOUT_MULTIPLIER', 3),
+        min_timeout=app.config.get('ADAPTIVE_TIMEOUT_MIN', 2))
+
+
+def record_response(server, response):
+    """Record the outcome of a request to the server in its health and metrics"""
+    server_id = server['server_id']
+    status = response.get_status()
+    get_server_health(server).record(status, response.get_time())
+    upstream_requests.inc(receiver=server_id, status=status)
+    if response.get_time():
+        upstream_seconds.observe(response.get_time(), receiver=server_id)
+
+
+def get_coalescing_key(request, server):
+    """Get the key identifying identical requests to the server"""
+    return (server['server_id'], request.get_normalized_hash())
+
+
+def send_request(request, server, timeout=10, use_cache=True):
+    """Send the request to the server, using the response cache if enabled
+
+    Requests to servers that are failing are refused with a 503, and the
+    timeout is shortened for servers that usually respond quickly. Unless
+    COALESCE_REQUESTS is disabled, a request identical to one already in
+    flight to the same server waits for and shares its response.
+
+    use_cache - if false, never serve a cached response (but still cache the new one)
+    """
+    if use_cache:
+        response = get_cached_response(request, server)
+        if response is not None:
+            return response
+
+    if not app.config.get('COALESCE_REQUESTS', True):
+        return send_upstream(request, server, timeout=timeout)
+
+    try:
+        response, shared = get_single_flight('upstream').do(
+            get_coalescing_key(request, server), send_upstream, request, server, timeout=timeout,
+            wait_timeout=timeout)
+    except CallTimeout:
+        return MMEResponse(request.get_normalized(), {'message': 'Request timed out'}, status=504)
+
+    if shared:
+        logger.info('Shared the response to an identical request in flight')
+        upstream_coalesced.inc(receiver=server['server_id'])
+    return response
+
+
+def send_upstream(request, server, timeout=10):
+    """Send the request to the server, and record the outcome
+
+    Requests are refused if the server's rate limit is exceeded or its
+    circuit is open, and wait their turn if the worker has too many outgoing
+    requests in flight. The circuit is checked last, as it may let this
+    request through as its only probe, whose outcome must then be recorded.
+    """
+    response = check_receiver_rate(request, server)
+    if response is not None:
+        return response
+
+    scheduler = get_outbound_scheduler()
+    if scheduler is not None and not scheduler.acquire(request.get_sender_id(), timeout=timeout):
+        message = 'Too many requests waiting to be sent to {}'.format(server['server_id'])
+        return MMEResponse(request.get_normalized(), {'message': message}, status=503)
+
+    try:
+        response = check_server_health(request, server)
+        if response is not None:
+            return response
+
+        with upstream_in_flight.track(receiver=server['server_id']):
+            response = request.send(server, timeout=get_server_timeout(server, timeout))
+    finally:
+        if scheduler is not None:
+            scheduler.release()
+    record_response(server, response)
+    cache_response(request, server, response)
+    return response
+
+
+def get_rate_limiter(kind):
+    """Get the rate limiter for requests from clients ('client') or to servers ('receiver')"""
+    store = get_store(app.config.get('RATE_LIMIT_DB'))
+    if kind == 'client':
+        return RateLimiter(store, limits=app.config.get('RATE_LIMITS', {}),
+                           default=app.config.get('RATE_LIMIT_DEFAULT'), prefix='client:')
+    return RateLimiter(store, limits=app.config.get('RECEIVER_RATE_LIMITS', {}), prefix='receiver:')
+
+
+def check_client_rate(sender_id):
+    """Raise a 429 error if the client has exceeded its rate limit"""
+    retry_after = get_rate_limiter('client').check(sender_id)
+    if retry_after:
+        rate_limited.inc(scope='client', id=sender_id)
+        retry_after = int(math.ceil(retry_after))
+        raise ErrorResponse('Rate limit exceeded, retry after {} seconds'.format(retry_after), status=429,
+                            headers={'Retry-After': '{}'.format(retry_after)})
+
+
+def check_receiver_rate(request, server):
+    """Get a 429 response if the server's rate limit is exceeded, else None"""
+    server_id = server['server_id']
+    retry_after = get_rate_limiter('receiver').check(server_id)
+    if retry_after:
+        rate_limited.inc(scope='receiver', id=server_id)
+        retry_after = int(math.ceil(retry_after))
+        message = 'Rate limit for {} exceeded, retry after {} seconds'.format(server_id, retry_after)
+        response = MMEResponse(request.get_normalized(), {'message': message}, status=429)
+        response.retry_after = retry_after
+        return response
+
+
+def get_outbound_scheduler():
+    """Get the fair scheduler of outgoing requests for this worker, or None if unlimited"""
+    max_concurrency = app.config.get('OUTBOUND_MAX_CONCURRENCY', 0)
+    if not max_concurrency:
+        return None
+    return get_scheduler(max_concurrency, weights=app.config.get('CLIENT_WEIGHTS', {}))
+
+
+def validate_normalized():
+    """Whether to validate our own normalized output, as well as the input"""
+    return app.config.get('VALIDATION_MODE', 'input') == 'full'
+
+
+def get_normalization_cache(kind):
+    """Get the cache of normalized requests or responses for this worker process"""
+    return get_cache('normalized_{}'.format(kind), maxsize=app.config.get('NORMALIZATION_CACHE_SIZE', 1024))
+
+
+def get_connection_pool():
+    """Get the outgoing HTTP connection pool for this worker process"""
+    return get_pool(maxsize=app.config.get('HTTP_POOL_SIZE', 4),
+                    idle_timeout=app.config.get('HTTP_POOL_IDLE_TIMEOUT', 60),
+                    connect_timeout=app.config.get('HTTP_CONNECT_TIMEOUT', 5))
+
+
+def is_timeout(error):
+    """Whether the exception was caused by a socket timeout"""
+    return isinstance(error, socket.timeout)
+
+
+def load_servers():
+    """Load the records for all servers from the servers manager"""
+    with app.app_context():
+        backend = get_backend()
+        servers = backend.get_manager('servers')
+        s = servers.search(doc_type=servers.SERVER_DOC_TYPE)
+        records = [hit.to_dict() for hit in s.scan()]
+
+        # Add the capability profiles of the servers that have one
         try:
-            validate_response(normalized)
-        except ValidationError as e:
-            # log and return response anyway
-            logger.warning('Normalized response does not conform to API specification:\n{}'.format(e))
+            profiles = backend.get_manager('profiles').get_profiles()
+        except Exception as error:
+            logger.warning('Error loading server profiles: {}'.format(error))
+            profiles = {}
+        for record in records:
+            record['profile'] = profiles.get(record['server_id'])
+        return records
 
-        if request:
-            # Inject request data into response
-            normalized['_request'] = request
 
-        return normalized
+def get_server_registry():
+    """Get the cache of server records for this worker process"""
+    return get_registry(load_servers,
+                        ttl=app.config.get('SERVER_REGISTRY_TTL', DEFAULT_REGISTRY_TTL),
+                        stamp_file=app.config.get('SERVER_REGISTRY_STAMP_FILE', DEFAULT_STAMP_FILE))
+
+
+def get_outgoing_servers():
+    """Get the information for all outgoing servers"""
+    return get_server_registry().list(direction='out')
 
 
 def get_outgoing_server(server_id, required=False):
@@ -228,52 +642,316 @@ def get_outgoing_server(server_id, required=False):
     required - if true, an ErrorResponse will be raised if the server is not found
     """
     logger.info('Looking up server: {}'.format(server_id))
-    backend = get_backend()
-    servers = backend.get_manager('servers')
-    s = servers.search(doc_type=servers.SERVER_DOC_TYPE)
-    s = s.filter('term', server_id=server_id)
-    results = s.execute()
+    with stage('server_lookup'):
+        server = get_server_registry().get(server_id, direction='out')
 
-    if results.hits:
-        return results.hits[0]
+    if server:
+        return server
     elif required:
         raise ErrorResponse('Bad server id: {}'.format(server_id), status=400)
 
 
+def json_response(obj, status=200):
+    """Get a JSON response, serialized with the fastest available library"""
+    return app.response_class(serialization.dumps(obj), status=status, mimetype='application/json')
+
+
+def log_exchange(request, server, response):
+    """Log the exchange with the stats manager, ignoring any errors"""
+    try:
+        with stage('stats_write'):
+            backend = get_backend()
+            stats = backend.get_manager('stats')
+            stats.save_request(request, server, response)
+    except Exception as error:
+        logger.warning('Error logging request: {}'.format(error))
+
+
+def warm_up():
+    """Do the one-off work that would otherwise slow down a worker's first requests
+
+    Loads the schemas and templates, and runs the validation and serialization
+    code once on an example request and response. With gunicorn's preload_app,
+    this runs in the master process before the workers are forked, and they all
+    share the result. Nothing here opens connections or starts threads, as they
+    would not survive the fork; so the models, which look up terms in the
+    database, are left to warm up on the workers' first requests.
+    """
+    from .bench import get_example_request, get_example_response
+
+    request_json = get_example_request('warm-up')
+    response_json = get_example_response(1)
+    try:
+        with app.app_context():
+            validate_request(request_json)
+            validate_response(response_json)
+            app.jinja_env.get_template('index.html')
+    except Exception as error:
+        logger.warning('Error warming up: {}'.format(error))
+    serialization.loads(serialization.dumps(request_json))
+
+
+def run_job_item(job, body, server_id):
+    """Send one request of a batch job to the server, and log the exchange
+
+    Rate limited requests are retried after the delay given by the limit, up
+    to JOBS_RETRIES times. Returns a (result, failed) tuple.
+    """
+    with app.app_context():
+        server = get_outgoing_server(server_id)
+        if server is None:
+            return {'status': 400, 'response': {'message': 'Bad server id: {}'.format(server_id)}}, True
+
+        try:
+            request = MMERequest(body, sender_id=job.state['senderId'], timestamp=datetime.now())
+            retries = app.config.get('JOBS_RETRIES', 3)
+            for attempt in range(retries + 1):
+                response = send_request(request, server, timeout=app.config.get('JOBS_TIMEOUT', 20))
+                if response.get_status() != 429 or response.retry_after is None or attempt == retries:
+                    break
+                time.sleep(response.retry_after)
+        except ErrorResponse as e:
+            return {'status': e.status, 'response': {'message': e.message}}, True
+
+        log_exchange(request, server, response)
+
+    status = response.get_status()
+    result = {
+        'status': status,
+        'took': response.get_time(),
+        'response': response.get_normalized(),
+    }
+    return result, status != 200
+
+
+def get_job_runner():
+    """Get the runner of batch jobs for this worker process, resuming orphaned jobs when it is created"""
+    return get_runner(run_job_item,
+                      root=get_jobs_dir(),
+                      max_workers=app.config.get('JOBS_MAX_WORKERS', 8),
+                      receiver_concurrency=app.config.get('JOBS_RECEIVER_CONCURRENCY', 2))
+
+
+def get_jobs_dir():
+    return app.config.get('JOBS_DIR')
+
+
+def get_job(job_id):
+    """Get the job, raising a 404 error unless it exists and belongs to the authenticated client"""
+    job = Job.load(get_jobs_dir(), job_id)
+    if job is None or job.state['senderId'] != flask.g.server['server_id']:
+        raise ErrorResponse('Job not found: {}'.format(job_id), status=404)
+    return job
+
+
+def read_job_requests(flask_request):
+    """Parse and validate the match requests in the body (one per line)
+
+    Returns the list of requests, each as UTF-8 encoded JSON.
+    """
+    max_items = app.config.get('JOBS_MAX_ITEMS', 10000)
+    requests = []
+    for i, line in enumerate(flask_request.get_data().splitlines(), 1):
+        line = line.strip()
+        if not line:
+            continue
+
+        if len(requests) >= max_items:
+            raise ErrorResponse('Too many requests in job (maximum {})'.format(max_items), status=413)
+
+        try:
+            request_json = serialization.loads(line)
+        except ValueError:
+            raise ErrorResponse('Invalid request JSON on line {}'.format(i), status=400)
+
+        try:
+            validate_request(request_json)
+        except ValidationError as e:
+            raise ErrorResponse('Request on line {} does not conform to API specification: {}'.format(i, e),
+                                status=422)
+
+        requests.append(line)
+
+    if not requests:
+        raise ErrorResponse('No requests in job', status=400)
+    return requests
+
+
+def parse_int(value, name):
+    """Parse a positive integer from a query argument"""
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise ErrorResponse('Invalid {}: {}'.format(name, value), status=400)
+    if number < 1:
+        raise ErrorResponse('Invalid {}: {}'.format(name, value), status=400)
+    return number
+
+
 def get_request(flask_request):
     timestamp = datetime.now()
 
     sender = flask.g.get('server', defaultdict(lambda: None))
     sender_id = sender['server_id']
+    if sender_id is not None:
+        check_client_rate(sender_id)
 
     try:
         logger.info('Getting flask request data')
-        request_json = flask_request.get_json(force=True)
-    except BadRequest:
+        with stage('parse_request'):
+            request_data = flask_request.get_data()
+            request_json = serialization.loads(request_data)
+    except ValueError:
         raise ErrorResponse('Invalid request JSON', status=400)
 
     try:
         logger.info('Validate request syntax')
-        validate_request(request_json)
+        with stage('validate_request'):
+            validate_request(request_json)
     except ValidationError as e:
         raise ErrorResponse('Request does not conform to API specification: {}'.format(e), status=422)
 
-    return MMERequest(request_json, sender_id=sender_id, timestamp=timestamp)
+    return MMERequest(request_json, sender_id=sender_id, timestamp=timestamp, data=request_data)
+
+
+cache_hits = metrics_registry.gauge('mme_cache_hits', 'Cache hits, by cache', labels=('cache',))
+cache_misses = metrics_registry.gauge('mme_cache_misses', 'Cache misses, by cache', labels=('cache',))
+cache_size = metrics_registry.gauge('mme_cache_size', 'Number of entries, by cache', labels=('cache',))
+circuit_open = metrics_registry.gauge('mme_circuit_open', 'Whether requests to the server are being refused',
+                                      labels=('receiver',))
+stats_pending = metrics_registry.gauge('mme_stats_pending', 'Exchange logs waiting to be indexed')
+rate_limited = metrics_registry.counter('mme_rate_limited_total', 'Requests refused for exceeding a rate limit',
+                                        labels=('scope', 'id'))
+outbound_queue_depth = metrics_registry.gauge('mme_outbound_queue_depth',
+                                              'Outgoing requests waiting for a free slot, by client',
+                                              labels=('sender',))
+outbound_active = metrics_registry.gauge('mme_outbound_active', 'Outgoing requests holding a slot')
+stats_dropped = metrics_registry.gauge('mme_stats_dropped', 'Exchange logs dropped because the buffer was full')
+
+
+def collect_metrics():
+    """Update metrics that are read from other components"""
+    for name, stats in get_cache_stats().items():
+        cache_hits.set(stats['hits'], cache=name)
+        cache_misses.set(stats['misses'], cache=name)
+        cache_size.set(stats['size'], cache=name)
+
+    # Don't create the tracker here, as it must be created with the configured settings
+    tracker = get_current_tracker()
+    if tracker is not None:
+        for server_id, stats in tracker.stats().items():
+            circuit_open.set(int(stats['state'] == OPEN), receiver=server_id)
+
+    scheduler = get_current_scheduler()
+    if scheduler is not None:
+        for sender_id, depth in scheduler.depth().items():
+            outbound_queue_depth.set(depth, sender=sender_id)
+        outbound_active.set(scheduler.active)
+
+    writer = get_current_writer()
+    if writer is not None:
+        stats_pending.set(writer.pending())
+        stats_dropped.set(writer.dropped)
+
+
+metrics_registry.add_collector(collect_metrics)
+
+
+@app.before_request
+def start_request_metrics():
+    metrics_dir = app.config.get('METRICS_DIR')
+    if metrics_dir:
+        get_snapshot_writer(metrics_dir, interval=app.config.get('METRICS_WRITE_INTERVAL', 5))
+
+    endpoint = flask_request.endpoint or 'unknown'
+    flask.g.metrics_endpoint = endpoint
+    http_in_flight.inc(endpoint=endpoint)
+
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = flask.g.get('metrics_endpoint', flask_request.endpoint or 'unknown')
+    http_requests.inc(endpoint=endpoint, status=response.status_code)
+    return response
+
+
+@app.teardown_request
+def finish_request_metrics(exception=None):
+    endpoint = flask.g.pop('metrics_endpoint', None)
+    if endpoint is not None:
+        http_in_flight.dec(endpoint=endpoint)
+
+
+def is_server_timing_allowed(sender_id):
+    """Whether the client may see the timings of its requests (see SERVER_TIMING_CLIENTS)"""
+    clients = app.config.get('SERVER_TIMING_CLIENTS', [])
+    return '*' in clients or (sender_id is not None and sender_id in clients)
+
+
+def record_trace(trace, response, sender_id=None):
+    """Add the finished trace to the response's Server-Timing header, if the client may see it, and export it"""
+    trace.attributes.update(status=response.status_code, sender=sender_id)
+    if is_server_timing_allowed(sender_id):
+        response.headers['Server-Timing'] = format_server_timing(trace)
+    get_exporter(app.config.get('TRACE_EXPORTER'), path=app.config.get('TRACE_FILE')).export(trace)
+
+
+@app.before_request
+def start_request_trace():
+    if app.config.get('TRACING_ENABLED', False):
+        start_trace(flask_request.endpoint or 'unknown')
+
+
+@app.after_request
+def finish_request_trace(response):
+    trace = end_trace()
+    if trace is None:
+        return response
+
+    sender = flask.g.get('server')
+    record_trace(trace, response, sender_id=sender['server_id'] if sender else None)
+    return response
+
+
+@app.teardown_request
+def clear_request_trace(exception=None):
+    # The trace is not finished if the request failed
+    end_trace()
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Export the metrics of all worker processes in the Prometheus text format"""
+    token = app.config.get('METRICS_AUTH_TOKEN')
+    if token and not hmac.compare_digest(flask_request.headers.get('X-Auth-Token', ''), token):
+        return ErrorResponse('Unauthorized', status=401).get_response()
+
+    metrics_dir = app.config.get('METRICS_DIR')
+    if metrics_dir and os.path.isdir(metrics_dir):
+        snapshot = read_snapshots(metrics_dir)
+    else:
+        snapshot = metrics_registry.snapshot()
+
+    return app.response_class(export_text(snapshot), mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/', methods=['GET'])
 @produces('text/html')
 def index():
+    registry = get_server_registry()
+    incoming_servers = registry.list(direction='in')
+    outgoing_servers = registry.list(direction='out')
     backend = get_backend()
-    servers = backend.get_manager('servers')
-    incoming_servers = servers.list(direction='in').get('rows', [])
-    outgoing_servers = servers.list(direction='out').get('rows', [])
     stats = backend.get_manager('stats')
     recent_requests = stats.get_recent_requests()
+    rollups = backend.get_manager('rollups')
+    server_stats = rollups.get_stats(since=datetime.now() - timedelta(hours=24), interval='all',
+                                     group_by=['receiver_id'])
     return render_template('index.html',
                            outgoing_servers=outgoing_servers,
                            incoming_servers=incoming_servers,
-                           recent_requests=recent_requests)
+                           recent_requests=recent_requests,
+                           server_stats=server_stats)
 
 
 @app.route('/v1/servers/<server_id>/match', methods=['POST'])
@@ -288,13 +966,14 @@ def match_server(server_id):
         return response
 
     try:
-        timeout = int(flask_request.args.get('timeout', 20))
+        timeout = parse_int(flask_request.args.get('timeout', 20), 'timeout')
 
         request = get_request(flask_request)
 
         server = get_outgoing_server(server_id, required=True)
 
-        response = request.send(server, timeout=timeout)
+        response = send_request(request, server, timeout=timeout,
+                                use_cache=not is_cache_bypassed(flask_request))
 
     except ErrorResponse as error:
         logger.error('Error response: {}'.format(error))
@@ -304,15 +983,285 @@ def match_server(server_id):
         error = ErrorResponse('Unexpected error: {}'.format(error), status=500)
         return error.get_response()
 
-    # Log exchange
+    log_exchange(request, server, response)
+
+    return response.get_response()
+
+
+@app.route('/v1/servers/match', methods=['POST'])
+@consumes(API_MIME_TYPE)
+@produces(API_MIME_TYPE, 'application/json')
+@auth_token_required()
+def match_all_servers():
+    """Proxy the match request to all outgoing servers concurrently
+
+    With ?merge=true, the results from all servers are returned as a single
+    list, ranked by score and with duplicates removed, optionally truncated
+    to ?limit= results.
+    """
+    @after_this_request
+    def add_header(response):
+        response.headers['Content-Type'] = API_MIME_TYPE
+        return response
+
     try:
-        backend = get_backend()
-        stats = backend.get_manager('stats')
-        stats.save_request(request, server, response)
+        timeout = parse_int(flask_request.args.get('timeout', 20), 'timeout')
+        deadline = parse_int(flask_request.args.get('deadline', 30), 'deadline')
+        merge = flask_request.args.get('merge', '').lower() in ['1', 'true', 'yes']
+        limit = flask_request.args.get('limit')
+        if limit is not None:
+            limit = parse_int(limit, 'limit')
+
+        request = get_request(flask_request)
+
+        servers = get_recipients(get_outgoing_servers(), request.get_sender_id())
+
+        max_workers = app.config.get('BROADCAST_MAX_WORKERS', 16)
+        use_cache = not is_cache_bypassed(flask_request)
+
+        def send(request, server, timeout):
+            return send_request(request, server, timeout=timeout, use_cache=use_cache)
+
+        completed, timed_out, failed = broadcast(app, request, servers, timeout=timeout,
+                                                 deadline=deadline, max_workers=max_workers,
+                                                 send=send)
+
+    except ErrorResponse as error:
+        logger.error('Error response: {}'.format(error))
+        return error.get_response()
     except Exception as error:
-        logger.warning('Error logging request: {}'.format(error))
+        logger.exception('Unexpected error')
+        error = ErrorResponse('Unexpected error: {}'.format(error), status=500)
+        return error.get_response()
 
-    return response.get_response()
+    responses = []
+    server_results = []
+    summary = {
+        'answered': [],
+        'timedOut': [server['server_id'] for server in timed_out],
+        'failed': [server['server_id'] for server in failed],
+    }
+    for server, response in completed:
+        server_id = server['server_id']
+        status = response.get_status()
+        if status == 200:
+            summary['answered'].append(server_id)
+        elif status == 504:
+            summary['timedOut'].append(server_id)
+        else:
+            summary['failed'].append(server_id)
+
+        server_response = {
+            'serverId': server_id,
+            'status': status,
+            'took': response.get_time(),
+        }
+        if merge and status == 200:
+            server_results.append((server_id, response.get_normalized().get('results', [])))
+        else:
+            server_response['response'] = response.get_normalized()
+        responses.append(server_response)
+
+        log_exchange(request, server, response)
+
+    data = dict(summary, responses=responses)
+    if merge:
+        with stage('merge_results'):
+            data['results'] = merge_results(server_results, limit=limit)
+    return app.response_class(iter_json(data), mimetype='application/json')
+
+
+@app.route('/v1/jobs', methods=['POST'])
+@consumes('application/x-ndjson')
+@produces('application/json')
+@auth_token_required()
+def submit_job():
+    """Start a batch job, from match requests given one per line (JSON lines)
+
+    Each request is sent to each of the servers given as ?servers=id,id,...
+    (default: all outgoing servers but the client's own). Returns 202 with
+    the job's id; see /v1/jobs/<job_id> for its progress and
+    /v1/jobs/<job_id>/results for the results as they are completed.
+    """
+    try:
+        sender_id = flask.g.server['server_id']
+        check_client_rate(sender_id)
+
+        server_ids = [server_id for server_id in flask_request.args.get('servers', '').split(',') if server_id]
+        if server_ids:
+            servers = [get_outgoing_server(server_id, required=True) for server_id in server_ids]
+        else:
+            servers = get_recipients(get_outgoing_servers(), sender_id)
+        if not servers:
+            raise ErrorResponse('No servers to send requests to', status=400)
+
+        requests = read_job_requests(flask_request)
+
+        remove_expired(get_jobs_dir(), app.config.get('JOBS_TTL', 7 * 24 * 60 * 60))
+        job = Job.create(get_jobs_dir(), sender_id, [server['server_id'] for server in servers], requests)
+        get_job_runner().submit(job)
+
+    except ErrorResponse as error:
+        logger.error('Error response: {}'.format(error))
+        return error.get_response()
+    except Exception as error:
+        logger.exception('Error creating job')
+        error = ErrorResponse('Unexpected error: {}'.format(error), status=500)
+        return error.get_response()
+
+    logger.info('Started job {} with {} items'.format(job.id, job.state['total']))
+    return json_response(job.state, status=202)
+
+
+@app.route('/v1/jobs/<job_id>', methods=['GET'])
+@produces('application/json')
+@auth_token_required()
+def job_status(job_id):
+    """The progress of a batch job"""
+    try:
+        job = get_job(job_id)
+    except ErrorResponse as error:
+        return error.get_response()
+
+    # Resume the job here if the process running it is gone
+    if job.is_orphaned() and get_job_runner().recover_job(job):
+        job = get_job(job_id)
+    return json_response(job.state)
+
+
+@app.route('/v1/jobs/<job_id>/results', methods=['GET'])
+@produces('application/x-ndjson')
+@auth_token_required()
+def job_results(job_id):
+    """The completed results of a batch job so far, one per line (JSON lines)
+
+    Each result has the line number of the request (not counting blank
+    lines), the serverId, and the status, took and response of the exchange,
+    in the order they completed.
+    """
+    try:
+        job = get_job(job_id)
+    except ErrorResponse as error:
+        return error.get_response()
+    return app.response_class(job.iter_results(), mimetype='application/x-ndjson')
+
+
+def parse_time(value, name):
+    """Parse an ISO 8601 date or datetime (without timezone) from a query argument"""
+    for time_format in ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d']:
+        try:
+            return datetime.strptime(value, time_format)
+        except ValueError:
+            pass
+    raise ErrorResponse('Invalid {}: {}'.format(name, value), status=400)
+
+
+@app.route('/v1/stats/exchanges', methods=['GET'])
+@produces('application/json')
+def exchange_stats():
+    """Hourly, daily or total exchange statistics, by sender and receiver
+
+    Query arguments: since, until (ISO 8601, default: the last 24 hours),
+    sender, receiver, interval (hour, day or all), group (a comma-separated
+    list of sender and receiver) and tests (true to include test requests).
+    """
+    args = flask_request.args
+    try:
+        until = parse_time(args['until'], 'until') if args.get('until') else None
+        if args.get('since'):
+            since = parse_time(args['since'], 'since')
+        else:
+            since = (until or datetime.now()) - timedelta(hours=24)
+
+        interval = args.get('interval', 'hour')
+        if interval not in INTERVALS:
+            raise ErrorResponse('Invalid interval: {}'.format(interval), status=400)
+
+        group_by = []
+        for field in [field for field in args.get('group', 'sender,receiver').split(',') if field]:
+            field = '{}_id'.format(field)
+            if field not in GROUP_FIELDS:
+                raise ErrorResponse('Invalid group: {}'.format(args['group']), status=400)
+            group_by.append(field)
+
+        rollups = get_backend().get_manager('rollups')
+        results = rollups.get_stats(since=since, until=until,
+                                    sender_id=args.get('sender'), receiver_id=args.get('receiver'),
+                                    include_tests=args.get('tests', '').lower() == 'true',
+                                    interval=interval, group_by=group_by)
+    except ErrorResponse as error:
+        return error.get_response()
+
+    return json_response({'interval': interval, 'stats': results})
+
+
+def parse_status(value):
+    """Parse an HTTP status (e.g. 404), or a class of them (e.g. 4xx), from a query argument"""
+    try:
+        if len(value) == 3 and value[1:].lower() == 'xx':
+            start = int(value[0]) * 100
+            return (start, start + 100)
+        return int(value)
+    except ValueError:
+        raise ErrorResponse('Invalid status: {}'.format(value), status=400)
+
+
+def parse_flag(value):
+    return (value or '').lower() in ['1', 'true', 'yes']
+
+
+@app.route('/v1/exchanges', methods=['GET'])
+@produces('application/x-ndjson')
+def exchange_log():
+    """Logged exchanges, streamed one per line (JSON lines), oldest first
+
+    Query arguments: since, until (ISO 8601), sender, receiver, status (e.g.
+    200 or 5xx), patient (the query patient or a result), tests (true to
+    include test requests), requests and responses (true to include the
+    decoded payloads), limit, and order (none to skip sorting, which is
+    faster). The exchange log is read with a scroll, so any number of
+    exchanges can be exported. Requires EXCHANGE_LOG_AUTH_TOKEN in the
+    X-Auth-Token header, and is disabled if it is not set.
+    """
+    token = app.config.get('EXCHANGE_LOG_AUTH_TOKEN')
+    if not token:
+        return ErrorResponse('The exchange log API is disabled', status=403).get_response()
+    if not hmac.compare_digest(flask_request.headers.get('X-Auth-Token', ''), token):
+        return ErrorResponse('Unauthorized', status=401).get_response()
+
+    from .replay import iter_logged
+
+    args = flask_request.args
+    try:
+        limit = args.get('limit')
+        if limit is not None:
+            try:
+                limit = int(limit)
+            except ValueError:
+                raise ErrorResponse('Invalid limit: {}'.format(limit), status=400)
+
+        order = args.get('order', 'asc')
+        if order not in ['asc', 'none']:
+            raise ErrorResponse('Invalid order: {}'.format(order), status=400)
+
+        filters = {
+            'since': parse_time(args['since'], 'since') if args.get('since') else None,
+            'until': parse_time(args['until'], 'until') if args.get('until') else None,
+            'sender_id': args.get('sender'),
+            'receiver_id': args.get('receiver'),
+            'status': parse_status(args['status']) if args.get('status') else None,
+            'patient_id': args.get('patient'),
+            'include_tests': parse_flag(args.get('tests')),
+        }
+    except ErrorResponse as error:
+        return error.get_response()
+
+    stats = get_backend().get_manager('stats')
+    records = iter_logged(stats, include_requests=parse_flag(args.get('requests')),
+                          include_responses=parse_flag(args.get('responses')),
+                          ordered=order == 'asc', limit=limit, **filters)
+    return app.response_class(flask.stream_with_context(iter_json_lines(records)),
+                              mimetype='application/x-ndjson')
 
 
 @app.route('/v1/validate/match', methods=['POST'])
@@ -338,5 +1287,5 @@ def normalize_match_request():
         error = ErrorResponse('Unexpected error: {}'.format(error), status=500)
         return error.get_response()
 
-    response = jsonify(normalized)
+    response = json_response(normalized)
     return response
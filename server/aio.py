@@ -0,0 +1,649 @@
+"""
+An asyncio (ASGI) serving engine for the exchange server
+
+Outgoing match requests are sent with non-blocking I/O, so a single process
+can wait on hundreds of slow remote servers at once. Authentication, validation
+and normalization reuse the synchronous Flask code, run in a thread pool so
+that they keep exactly the same semantics. All other routes are served by the
+Flask application itself.
+
+Requires Python 3.7+ (for contextvars), and uvicorn to run.
+"""
+
+import asyncio
+import contextvars
+import io
+import logging
+import re
+import ssl
+import sys
+import time
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from urllib.parse import urlsplit
+
+from flask import request as flask_request
+from flask_negotiate import consumes, produces
+from werkzeug.exceptions import HTTPException
+
+from mme_server.auth import auth_token_required
+from mme_server.server import API_MIME_TYPE
+
+from . import serialization
+from . import (app, ErrorResponse, MMEResponse, cache_response, check_receiver_rate, check_server_health,
+               get_cached_response, get_coalescing_key, get_outbound_scheduler, get_outgoing_server, get_request,
+               get_server_timeout, is_cache_bypassed, log_exchange, parse_int, record_response, record_trace)
+from .jobs import close_runner
+from .managers.bulk import close_writer
+from .metrics import (clock, http_in_flight, http_requests, stage_seconds, upstream_coalesced, upstream_in_flight,
+                      close_snapshot_writer, get_snapshot_writer)
+from .pool import DEFAULT_CONNECT_TIMEOUT, DEFAULT_IDLE_TIMEOUT, DEFAULT_POOL_SIZE
+from .shaping import gunzip_data
+from .streaming import check_size, ResponseTooLarge, CHUNK_SIZE, DEFAULT_MAX_SIZE
+from .tracing import activate, Trace
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_THREADS = 32
+MATCH_SERVER_PATH = re.compile(r'^/v1/servers/([^/]+)/match$')
+
+# The trace of the match request handled by the current task. The tracing
+# module keeps the current trace per thread, so it is activated for each
+# part of the request run in the thread pool (see GatewayApp.run_sync).
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+@contextmanager
+def stage(name, **attributes):
+    """Time the block as a stage of request handling, like tracing.stage
+
+    The block may await, as the span is recorded in the current task's trace.
+    """
+    start = clock()
+    try:
+        yield
+    finally:
+        end = clock()
+        stage_seconds.observe(end - start, stage=name)
+        trace = current_trace.get()
+        if trace is not None:
+            trace.add_span(name, start, end, **attributes)
+
+
+def _run_traced(trace, function, *args):
+    with activate(trace):
+        return function(*args)
+
+
+class AsyncConnectionPool:
+    """A pool of persistent HTTP/1.1 connections built on asyncio streams
+
+    maxsize - the maximum number of idle connections to keep per host
+    idle_timeout - close connections that have been idle for this many seconds
+    connect_timeout - give up connecting after this many seconds
+    """
+    def __init__(self, maxsize=DEFAULT_POOL_SIZE, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self._ssl_context = ssl.create_default_context()
+        # key -> list of (reader, writer, last used time)
+        self._idle = defaultdict(list)
+
+    @classmethod
+    def _get_key(cls, parts):
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        return (parts.scheme, parts.hostname, port)
+
+    async def _connect(self, key):
+        scheme, host, port = key
+        context = self._ssl_context if scheme == 'https' else None
+        connect = asyncio.open_connection(host, port, ssl=context)
+        return await asyncio.wait_for(connect, self.connect_timeout)
+
+    def _get(self, key):
+        now = time.time()
+        idle = self._idle[key]
+        while idle:
+            reader, writer, last_used = idle.pop()
+            if now - last_used < self.idle_timeout and not reader.at_eof():
+                return reader, writer
+            writer.close()
+
+    def _put(self, key, reader, writer):
+        idle = self._idle[key]
+        if len(idle) < self.maxsize:
+            idle.append((reader, writer, time.time()))
+        else:
+            writer.close()
+
+    def clear(self):
+        for idle in self._idle.values():
+            for reader, writer, last_used in idle:
+                writer.close()
+        self._idle.clear()
+
+    async def request(self, method, url, body=b'', headers=None, timeout=None, max_size=DEFAULT_MAX_SIZE):
+        """Issue a request, returning a tuple of (status, headers, body)
+
+        timeout - give up on the whole request after this many seconds
+        max_size - raise ResponseTooLarge if the body is larger than this many bytes
+        """
+        parts = urlsplit(url)
+        key = self._get_key(parts)
+        path = parts.path or '/'
+        if parts.query:
+            path = '{}?{}'.format(path, parts.query)
+
+        lines = ['{} {} HTTP/1.1'.format(method, path), 'Host: {}'.format(parts.netloc)]
+        for name, value in (headers or {}).items():
+            lines.append('{}: {}'.format(name, value))
+        lines.append('Content-Length: {}'.format(len(body)))
+        lines.append('Connection: keep-alive')
+        message = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+        connection = self._get(key)
+        reused = connection is not None
+        if connection is None:
+            connection = await self._connect(key)
+
+        try:
+            return await asyncio.wait_for(self._exchange(key, connection, message, max_size), timeout)
+        except (asyncio.TimeoutError, ResponseTooLarge):
+            connection[1].close()
+            raise
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            connection[1].close()
+            if not reused:
+                raise
+
+            # The server may have closed an idle connection, so retry once
+            logger.debug('Retrying request on a new connection: {}'.format(e))
+            connection = await self._connect(key)
+            try:
+                return await asyncio.wait_for(self._exchange(key, connection, message, max_size), timeout)
+            except Exception:
+                connection[1].close()
+                raise
+
+    async def _exchange(self, key, connection, message, max_size):
+        reader, writer = connection
+        writer.write(message)
+        await writer.drain()
+
+        while True:
+            status_line = await reader.readline()
+            if not status_line:
+                raise ConnectionResetError('Connection closed by server')
+            version, status = status_line.decode('latin-1').split(None, 2)[:2]
+            status = int(status)
+
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, value = line.decode('latin-1').split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+
+            # Skip interim responses (e.g. 100 Continue), which precede the final one
+            if not 100 <= status < 200:
+                break
+
+        keep_alive = headers.get('connection', '').lower() != 'close' and version != 'HTTP/1.0'
+        if status in (204, 304):
+            # Never has a body, whatever the headers say
+            data = b''
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            length = 0
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                length += size
+                check_size(length, max_size=max_size)
+                if size == 0:
+                    # Skip any trailers
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            data = b''.join(chunks)
+        elif 'content-length' in headers:
+            check_size(headers['content-length'], max_size=max_size)
+            data = await reader.readexactly(int(headers['content-length']))
+        else:
+            data = await LimitedStreamReader(reader, max_size).read()
+            keep_alive = False
+
+        if keep_alive:
+            self._put(key, reader, writer)
+        else:
+            writer.close()
+
+        return status, headers, data
+
+
+class LimitedStreamReader:
+    """Reads a stream to EOF, raising ResponseTooLarge after max_size bytes"""
+    def __init__(self, reader, max_size=DEFAULT_MAX_SIZE):
+        self.reader = reader
+        self.max_size = max_size
+
+    async def read(self):
+        chunks = []
+        length = 0
+        while True:
+            chunk = await self.reader.read(CHUNK_SIZE)
+            if not chunk:
+                return b''.join(chunks)
+            length += len(chunk)
+            check_size(length, max_size=self.max_size)
+            chunks.append(chunk)
+
+
+def _wsgi_environ(scope, body):
+    """Build a WSGI environ from an ASGI HTTP scope"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1')
+        value = value.decode('latin-1')
+        if name == 'content-type':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'content-length':
+            key = 'HTTP_{}'.format(name.upper().replace('-', '_'))
+            if key in environ:
+                value = '{},{}'.format(environ[key], value)
+            environ[key] = value
+    return environ
+
+
+@consumes(API_MIME_TYPE)
+@produces(API_MIME_TYPE, 'application/json')
+@auth_token_required()
+def _authorize_match():
+    """Apply the same content negotiation and authentication as match_server"""
+    return None
+
+
+def _set_content_type(response):
+    response.headers['Content-Type'] = API_MIME_TYPE
+    return response
+
+
+def prepare_match(environ, server_id):
+    """Authenticate and normalize a match request
+
+    Returns either a (MMERequest, server, timeout, use_cache) tuple, or a Flask
+    response if the request should not be proxied.
+    """
+    with app.request_context(environ):
+        try:
+            denied = _authorize_match()
+        except HTTPException as error:
+            return error.get_response(environ)
+
+        if denied is not None:
+            return app.make_response(denied)
+
+        try:
+            timeout = parse_int(flask_request.args.get('timeout', 20), 'timeout')
+
+            request = get_request(flask_request)
+
+            server = get_outgoing_server(server_id, required=True)
+
+            use_cache = not is_cache_bypassed(flask_request)
+
+        except ErrorResponse as error:
+            logger.error('Error response: {}'.format(error))
+            return _set_content_type(error.get_response())
+        except Exception as error:
+            logger.exception('Unexpected error')
+            error = ErrorResponse('Unexpected error: {}'.format(error), status=500)
+            return _set_content_type(error.get_response())
+
+    return request, server, timeout, use_cache
+
+
+def lookup_response(request, server, use_cache=True):
+    """Get the cached response from the server, or None"""
+    if not use_cache:
+        return None
+    with app.app_context():
+        return get_cached_response(request, server)
+
+
+def check_rate(request, server):
+    """Get an error response if the server's rate limit is exceeded, else None"""
+    with app.app_context():
+        return check_receiver_rate(request, server)
+
+
+def check_health(request, server):
+    """Get an error response if the server's circuit is open, else None
+
+    This is checked last, just before sending, as it may let this request
+    through as the circuit's only probe, whose outcome must then be recorded.
+    """
+    with app.app_context():
+        return check_server_health(request, server)
+
+
+def lookup_coalescing_key(request, server):
+    with app.app_context():
+        return get_coalescing_key(request, server)
+
+
+def load_response(request, status, data, elapsed_time, content_encoding=None):
+    """Parse and normalize the response data into a MMEResponse
+
+    content_encoding - 'gzip' if the data is compressed
+    """
+    with app.app_context():
+        try:
+            if content_encoding == 'gzip':
+                data = gunzip_data(data, max_size=app.config.get('MAX_RESPONSE_SIZE', DEFAULT_MAX_SIZE))
+            response = serialization.loads(data)
+        except ResponseTooLarge as e:
+            logger.error('Request resulted in error: {}'.format(e))
+            return MMEResponse(request, {'message': str(e)}, status=502)
+        except Exception as e:
+            logger.error('Request resulted in error: {}'.format(e))
+            return MMEResponse(request, {'message': str(e)}, status=500)
+
+        return MMEResponse(request, response, status=status, time=elapsed_time, data=data)
+
+
+def finish_match(request, server, response):
+    """Log the exchange and build the Flask response"""
+    with app.app_context():
+        log_exchange(request, server, response)
+        return _set_content_type(response.get_response())
+
+
+class GatewayApp:
+    """ASGI application serving the exchange server
+
+    max_threads - the number of threads used for the synchronous parts of each
+        request, and separately for requests waiting for an outbound slot
+    """
+    def __init__(self, flask_app=app, max_threads=DEFAULT_MAX_THREADS):
+        self.flask_app = flask_app
+        self.executor = ThreadPoolExecutor(max_workers=max_threads)
+        # Waiting for a slot happens in its own threads, so waiting requests
+        # can't take all the threads that the requests holding slots need
+        self.wait_executor = ThreadPoolExecutor(max_workers=max_threads)
+        # Futures for the responses to requests in flight, by coalescing key
+        self.in_flight = {}
+        self.pool = AsyncConnectionPool(
+            maxsize=flask_app.config.get('HTTP_POOL_SIZE', DEFAULT_POOL_SIZE),
+            idle_timeout=flask_app.config.get('HTTP_POOL_IDLE_TIMEOUT', DEFAULT_IDLE_TIMEOUT),
+            connect_timeout=flask_app.config.get('HTTP_CONNECT_TIMEOUT', DEFAULT_CONNECT_TIMEOUT))
+
+    async def run_sync(self, function, *args):
+        """Run the function in the thread pool, recording its spans in the current task's trace"""
+        loop = asyncio.get_event_loop()
+        trace = current_trace.get()
+        if trace is not None:
+            function = partial(_run_traced, trace, function)
+        return await loop.run_in_executor(self.executor, function, *args)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        elif scope['type'] != 'http':
+            return
+
+        body = await self.read_body(receive)
+        environ = _wsgi_environ(scope, body)
+
+        match = MATCH_SERVER_PATH.match(scope['path'])
+        if match and scope['method'] == 'POST':
+            # Flask's request hooks are not run for this route, so record metrics and traces here
+            trace = None
+            if self.flask_app.config.get('TRACING_ENABLED', False):
+                trace = Trace('match_server')
+                current_trace.set(trace)
+            with http_in_flight.track(endpoint='match_server'):
+                response = await self.match_server(environ, match.group(1))
+            http_requests.inc(endpoint='match_server', status=response.status_code)
+            if trace is not None:
+                trace.finish()
+                current_trace.set(None)
+                await self.run_sync(record_trace, trace, response, trace.attributes.get('sender'))
+            context = None
+        else:
+            # Includes normalize_match_request, which needs no outgoing I/O
+            response, context = await self.run_sync(self.dispatch, environ)
+
+        await self.send_response(send, response, context=context)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                metrics_dir = self.flask_app.config.get('METRICS_DIR')
+                if metrics_dir:
+                    get_snapshot_writer(metrics_dir, interval=self.flask_app.config.get('METRICS_WRITE_INTERVAL', 5))
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.pool.clear()
+                self.executor.shutdown(wait=True)
+                self.wait_executor.shutdown(wait=True)
+                close_runner()
+                close_writer()
+                close_snapshot_writer()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @classmethod
+    async def read_body(cls, receive):
+        chunks = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            chunks.append(message.get('body', b''))
+            more_body = message.get('more_body', False)
+        return b''.join(chunks)
+
+    async def send_response(self, send, response, context=None):
+        """Send the response, streaming its body as it is produced
+
+        Producing each chunk may block (e.g. on the database), so it is done
+        in the thread pool, in the context the response was created in, which
+        streamed views (stream_with_context) need.
+        """
+        headers = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                   for name, value in response.headers.to_wsgi_list()]
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': headers,
+        })
+
+        context = context or contextvars.copy_context()
+        chunks = iter(response.iter_encoded())
+        try:
+            while True:
+                chunk = await self.run_sync(context.run, next, chunks, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({
+                        'type': 'http.response.body',
+                        'body': chunk,
+                        'more_body': True,
+                    })
+            await send({
+                'type': 'http.response.body',
+                'body': b'',
+            })
+        finally:
+            await self.run_sync(context.run, response.close)
+
+    def dispatch(self, environ):
+        """Serve the request with the synchronous Flask application
+
+        Returns the response, with its body not yet produced, and the context
+        it was created in.
+        """
+        context = contextvars.copy_context()
+        response = context.run(self.flask_app.response_class.from_app, self.flask_app, environ)
+        return response, context
+
+    async def match_server(self, environ, server_id):
+        """Proxy the match request to server with id <server_id>"""
+        prepared = await self.run_sync(prepare_match, environ, server_id)
+        if not isinstance(prepared, tuple):
+            return prepared
+
+        request, server, timeout, use_cache = prepared
+        trace = current_trace.get()
+        if trace is not None:
+            trace.attributes['sender'] = request.get_sender_id()
+
+        response = await self.run_sync(lookup_response, request, server, use_cache)
+        if response is None:
+            if self.flask_app.config.get('COALESCE_REQUESTS', True):
+                response = await self.send_coalesced(request, server, timeout=timeout)
+            else:
+                response = await self.send_upstream(request, server, timeout=timeout)
+
+        return await self.run_sync(finish_match, request, server, response)
+
+    async def send_coalesced(self, request, server, timeout=10):
+        """Send the request, or share the response to an identical request already in flight"""
+        key = await self.run_sync(lookup_coalescing_key, request, server)
+        future = self.in_flight.get(key)
+        if future is not None:
+            logger.info('Sharing the response to an identical request in flight')
+            upstream_coalesced.inc(receiver=server['server_id'])
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), timeout)
+            except asyncio.TimeoutError:
+                return MMEResponse(request.get_normalized(), {'message': 'Request timed out'}, status=504)
+
+        future = self.in_flight[key] = asyncio.get_event_loop().create_future()
+        try:
+            response = await self.send_upstream(request, server, timeout=timeout)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(response)
+        finally:
+            del self.in_flight[key]
+        return response
+
+    async def acquire_slot(self, scheduler, sender_id, timeout):
+        """Wait for a slot in the outbound scheduler, returning False if none was free within timeout seconds"""
+        loop = asyncio.get_event_loop()
+        waiting = loop.run_in_executor(self.wait_executor, scheduler.acquire, sender_id, timeout)
+        try:
+            return await asyncio.shield(waiting)
+        except asyncio.CancelledError:
+            # The wait goes on in its thread, so hand the slot on if it gets one
+            def release(future):
+                if not future.cancelled() and future.exception() is None and future.result():
+                    scheduler.release()
+
+            waiting.add_done_callback(release)
+            raise
+
+    async def send_upstream(self, request, server, timeout=10):
+        """Send the request to the server, and record the outcome
+
+        As in the synchronous send_upstream, requests are refused if the
+        server's rate limit is exceeded or its circuit is open, and wait their
+        turn if the worker has too many outgoing requests in flight.
+        """
+        response = await self.run_sync(check_rate, request, server)
+        if response is not None:
+            return response
+
+        scheduler = get_outbound_scheduler()
+        if scheduler is not None and not await self.acquire_slot(scheduler, request.get_sender_id(), timeout):
+            message = 'Too many requests waiting to be sent to {}'.format(server['server_id'])
+            return MMEResponse(request.get_normalized(), {'message': message}, status=503)
+
+        try:
+            response = await self.run_sync(check_health, request, server)
+            if response is not None:
+                return response
+
+            timeout = get_server_timeout(server, timeout)
+            with upstream_in_flight.track(receiver=server['server_id']):
+                response = await self.send(request, server, timeout=timeout)
+        finally:
+            if scheduler is not None:
+                scheduler.release()
+        record_response(server, response)
+        cache_response(request, server, response)
+        return response
+
+    async def send(self, request, server, timeout=10):
+        """Send the request to the given server and return a MMEResponse object
+
+        timeout - terminate the request after this many seconds
+        """
+        normalized = request.get_normalized()
+        # Nothing is awaited here, so the trace can be activated in this thread
+        with activate(current_trace.get()):
+            match_url, headers, request_data = request.prepare(server)
+
+        server_id = server['server_id']
+        logger.info('Opening request to URL: ' + match_url)
+        try:
+            sent_request_at = clock()
+            max_size = self.flask_app.config.get('MAX_RESPONSE_SIZE', DEFAULT_MAX_SIZE)
+            with stage('upstream', server=server_id):
+                status, response_headers, data = await self.pool.request(
+                    'POST', match_url, body=request_data, headers=headers, timeout=timeout, max_size=max_size)
+
+            logger.info('Received HTTP {}'.format(status))
+            elapsed_time = clock() - sent_request_at
+        except asyncio.TimeoutError:
+            logger.error('Request timed out')
+            return MMEResponse(normalized, {'message': 'Request timed out'}, status=504)
+        except ResponseTooLarge as e:
+            logger.error('Request resulted in error: {}'.format(e))
+            return MMEResponse(normalized, {'message': str(e)}, status=502)
+        except Exception as e:
+            logger.error('Request resulted in error: {}'.format(e))
+            return MMEResponse(normalized, {'message': str(e)}, status=500)
+
+        content_encoding = response_headers.get('content-encoding', '').lower() or None
+        return await self.run_sync(load_response, normalized, status, data, elapsed_time, content_encoding)
+
+
+def create_app(flask_app=app):
+    """Create the ASGI application for the given Flask application"""
+    max_threads = flask_app.config.get('ASYNC_MAX_THREADS', DEFAULT_MAX_THREADS)
+    return GatewayApp(flask_app, max_threads=max_threads)
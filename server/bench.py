@@ -0,0 +1,474 @@
+"""
+Benchmarking of the exchange server against local mock MME nodes
+
+The gateway is served in-process on a local port, so that the per-stage
+timings in its metrics registry can be reported alongside the client-side
+latencies.
+"""
+
+from __future__ import with_statement, division, unicode_literals
+
+import json
+import logging
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+from datetime import datetime
+
+from . import serialization
+from .compat import BaseHTTPRequestHandler, HTTPServer, ThreadingMixIn
+from .metrics import clock, stage_seconds
+from .pool import ConnectionPool
+
+logger = logging.getLogger(__name__)
+
+API_MIME_TYPE = 'application/vnd.ga4gh.matchmaker.v1.0+json'
+NODE_ID_PREFIX = 'bench-node-'
+CLIENT_ID = 'bench-client'
+ENDPOINTS = ['match', 'validate']
+PERCENTILES = [50, 95, 99]
+
+
+def get_example_request(patient_id):
+    """Get a test match request for a patient with the given id"""
+    return {
+        'patient': {
+            'id': '{}'.format(patient_id),
+            'contact': {
+                'name': 'Benchmark',
+                'href': 'mailto:benchmark@example.com',
+            },
+            'features': [
+                {'id': 'HP:0001366', 'label': 'Microcephaly'},
+                {'id': 'HP:0000522', 'label': 'Alacrima'},
+            ],
+            'genomicFeatures': [{
+                'gene': {'id': 'EFTUD2'},
+            }],
+            'test': True,
+        }
+    }
+
+
+def get_example_response(results):
+    """Get a match response with the given number of results"""
+    return {
+        'results': [{
+            'score': {'patient': 1 - i / (results + 1)},
+            'patient': {
+                'id': 'bench-{}'.format(i),
+                'contact': {
+                    'name': 'Benchmark',
+                    'href': 'mailto:benchmark@example.com',
+                },
+                'features': [
+                    {'id': 'HP:0001366', 'observed': 'yes'},
+                    {'id': 'HP:0000522', 'observed': 'yes'},
+                ],
+                'genomicFeatures': [{
+                    'gene': {'id': 'ENSG00000108883'},
+                }],
+                'test': True,
+            },
+        } for i in range(results)],
+    }
+
+
+class MockNodeHandler(BaseHTTPRequestHandler):
+    # Keep connections alive, like a real server behind a proxy
+    protocol_version = 'HTTP/1.1'
+    # Don't delay the body, which is written separately from the headers
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        node = self.server.node
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+
+        delay = node.latency + random.uniform(-node.jitter, node.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        if random.random() < node.error_rate:
+            status, body = 500, b'{"message": "Simulated error"}'
+        else:
+            status, body = 200, node.body
+
+        self.send_response(status)
+        self.send_header('Content-Type', API_MIME_TYPE)
+        self.send_header('Content-Length', '{}'.format(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MockNode:
+    """A local MME server that answers every match request with the same results
+
+    latency - the mean time, in seconds, before responding
+    jitter - the latency varies uniformly by up to this many seconds either way
+    error_rate - the fraction of requests answered with an HTTP 500
+    results - the number of results in each response
+    """
+    def __init__(self, latency=0.05, jitter=0.0, error_rate=0.0, results=5, host='127.0.0.1', port=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.body = json.dumps(get_example_response(results)).encode('utf-8')
+        self._server = ThreadingHTTPServer((host, port), MockNodeHandler)
+        self._server.node = self
+        self._thread = threading.Thread(target=self._server.serve_forever, name='mock-node')
+        self._thread.daemon = True
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class Gateway:
+    """The exchange server app, served from a background thread on a local port"""
+    def __init__(self, app, host='127.0.0.1', port=0):
+        from werkzeug.serving import make_server
+
+        self._server = make_server(host, port, app, threaded=True)
+        self._thread = threading.Thread(target=self._server.serve_forever, name='bench-gateway')
+        self._thread.daemon = True
+
+    @property
+    def base_url(self):
+        return 'http://{}:{}'.format(self._server.host, self._server.port)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def register_nodes(nodes, client_key, stamp_file=None):
+    """Add the mock nodes as outgoing servers, and a client to query them"""
+    from mme_server.cli import main as mme_server_main
+    from .registry import invalidate
+
+    for i, node in enumerate(nodes):
+        mme_server_main(['servers', 'add', '{}{}'.format(NODE_ID_PREFIX, i),
+                         '--label', 'Benchmark node {}'.format(i),
+                         '--base-url', node.base_url,
+                         '--key', uuid.uuid4().hex])
+    mme_server_main(['clients', 'add', CLIENT_ID, '--label', 'Benchmark client', '--key', client_key])
+    invalidate(stamp_file)
+
+
+def unregister_nodes(nodes, stamp_file=None):
+    """Remove the servers and client added by register_nodes"""
+    from mme_server.cli import main as mme_server_main
+    from .registry import invalidate
+
+    for i in range(len(nodes)):
+        mme_server_main(['servers', 'rm', '{}{}'.format(NODE_ID_PREFIX, i)])
+    mme_server_main(['clients', 'rm', CLIENT_ID])
+    invalidate(stamp_file)
+
+
+def percentile(values, p):
+    """Get the p-th percentile (0-100) of sorted values, by the nearest-rank method"""
+    if not values:
+        return None
+    index = int(math.ceil(p / 100 * len(values))) - 1
+    return values[max(index, 0)]
+
+
+def run_load(urls, headers, bodies, concurrency=10, requests=1000, timeout=60):
+    """Send requests from concurrent clients, each waiting for its previous response
+
+    Request i is sent to urls[i % len(urls)] with bodies[i % len(bodies)].
+
+    Returns a summary of the throughput, latencies and response statuses.
+    """
+    pool = ConnectionPool(maxsize=concurrency)
+    lock = threading.Lock()
+    counter = iter(range(requests))
+    latencies = []
+    statuses = {}
+
+    def client():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+
+            start = clock()
+            try:
+                with pool.urlopen('POST', urls[i % len(urls)], body=bodies[i % len(bodies)],
+                                  headers=headers, timeout=timeout) as response:
+                    response.read()
+                    status = '{}'.format(response.getcode())
+            except Exception as e:
+                logger.debug('Request failed: {}'.format(e))
+                status = 'error'
+            elapsed = clock() - start
+
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    threads = [threading.Thread(target=client, name='bench-client-{}'.format(i)) for i in range(concurrency)]
+    start = clock()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = clock() - start
+    pool.clear()
+
+    return summarize(latencies, statuses, elapsed)
+
+
+def summarize(latencies, statuses, elapsed):
+    """Summarize the throughput, latencies (in seconds) and status counts of a run"""
+    latencies = sorted(latencies)
+    summary = {
+        'requests': len(latencies),
+        'errors': sum(count for status, count in statuses.items() if status != '200'),
+        'statuses': statuses,
+        'seconds': elapsed,
+        'throughput': len(latencies) / elapsed if elapsed else None,
+        'mean': sum(latencies) / len(latencies) if latencies else None,
+        'max': latencies[-1] if latencies else None,
+    }
+    for p in PERCENTILES:
+        summary['p{}'.format(p)] = percentile(latencies, p)
+    return summary
+
+
+def get_stage_timings(before, after):
+    """Get the count and mean time of each stage between two stage_seconds snapshots"""
+    previous = dict((tuple(key), value) for key, value in before['series'])
+    timings = {}
+    for key, value in after['series']:
+        old = previous.get(tuple(key), {'sum': 0.0, 'count': 0})
+        count = value['count'] - old['count']
+        if count:
+            timings[key[0]] = {
+                'count': count,
+                'mean': (value['sum'] - old['sum']) / count,
+            }
+    return timings
+
+
+def get_cpu_time():
+    """Get the user and system CPU time used by this process, in seconds"""
+    times = os.times()
+    return times[0] + times[1]
+
+
+def get_version():
+    """Get the git commit of the working tree, if available"""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD']).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(app, nodes=1, latency=0.05, jitter=0.0, error_rate=0.0, results=5, concurrency=10,
+                  requests=1000, distinct=100, endpoints=None, timeout=60, use_cache=False, json_backend=None):
+    """Benchmark the exchange server against local mock MME nodes
+
+    The mock nodes are registered as outgoing servers (and removed again
+    afterwards) in the configured backend, and queried through the gateway.
+
+    distinct - the number of distinct request bodies to cycle through
+    endpoints - which of 'match' (/v1/servers/<id>/match) and 'validate'
+        (/v1/validate/match) to benchmark, one after the other (default: both)
+    json_backend - the JSON library for the gateway to use (default: as configured)
+
+    CPU time per request is that of the whole process, which includes the
+    load generator and mock nodes, so it is only meaningful in comparison.
+
+    Returns the results, as a JSON-serializable dict.
+    """
+    if json_backend:
+        serialization.configure(json_backend)
+    client_key = uuid.uuid4().hex
+    stamp_file = app.config.get('SERVER_REGISTRY_STAMP_FILE')
+    mock_nodes = [MockNode(latency=latency, jitter=jitter, error_rate=error_rate, results=results).start()
+                  for i in range(nodes)]
+    gateway = Gateway(app).start()
+    headers = {
+        'X-Auth-Token': client_key,
+        'Content-Type': API_MIME_TYPE,
+        'Accept': API_MIME_TYPE,
+    }
+    bodies = [json.dumps(get_example_request(i)).encode('utf-8') for i in range(max(distinct, 1))]
+
+    report = {
+        'version': get_version(),
+        'createdAt': datetime.now().isoformat(),
+        'options': {
+            'nodes': nodes,
+            'latency': latency,
+            'jitter': jitter,
+            'errorRate': error_rate,
+            'results': results,
+            'concurrency': concurrency,
+            'requests': requests,
+            'distinct': distinct,
+            'timeout': timeout,
+            'cache': use_cache,
+            'jsonBackend': serialization.get_serializer().backend,
+        },
+        'endpoints': {},
+    }
+
+    register_nodes(mock_nodes, client_key, stamp_file=stamp_file)
+    try:
+        for endpoint in endpoints or ENDPOINTS:
+            if endpoint == 'match':
+                query = '?timeout={}{}'.format(timeout, '' if use_cache else '&cache=false')
+                urls = ['{}/v1/servers/{}{}/match{}'.format(gateway.base_url, NODE_ID_PREFIX, i, query)
+                        for i in range(nodes)]
+            else:
+                urls = ['{}/v1/validate/match'.format(gateway.base_url)]
+
+            before = stage_seconds.snapshot()
+            cpu_before = get_cpu_time()
+            summary = run_load(urls, headers, bodies, concurrency=concurrency, requests=requests,
+                               timeout=timeout + 5)
+            summary['cpuPerRequest'] = (get_cpu_time() - cpu_before) / max(summary['requests'], 1)
+            summary['stages'] = get_stage_timings(before, stage_seconds.snapshot())
+            report['endpoints'][endpoint] = summary
+    finally:
+        unregister_nodes(mock_nodes, stamp_file=stamp_file)
+        gateway.stop()
+        for node in mock_nodes:
+            node.stop()
+
+    return report
+
+
+# Run in a new interpreter by measure_startup, with the mode as its argument
+STARTUP_SCRIPT = """
+import json, os, resource, sys, time
+start = time.time()
+import server
+imported = time.time()
+if sys.argv[1] == 'preload':
+    server.warm_up()
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        sys.exit(0)
+    # Time the forked worker, as gunicorn's preload_app does
+    start = imported = time.time()
+client = server.app.test_client()
+response = client.post('/v1/validate/match', data=json.dumps(json.loads(sys.argv[2])),
+                       headers={'Content-Type': sys.argv[3], 'Accept': sys.argv[3]})
+served = time.time()
+print(json.dumps({'import': imported - start, 'firstRequest': served - imported, 'total': served - start,
+                  'status': response.status_code, 'maxRss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+sys.stdout.flush()
+os._exit(0)
+"""
+STARTUP_MODES = ['cold', 'preload']
+
+
+def run_startup(mode, root):
+    """Start a new interpreter, and measure how long it takes to serve a first request"""
+    args = [sys.executable, '-c', STARTUP_SCRIPT, mode, json.dumps(get_example_request('startup')), API_MIME_TYPE]
+    output = subprocess.check_output(args, cwd=root).decode('utf-8')
+    result = json.loads(output.strip().splitlines()[-1])
+    if result['status'] != 200:
+        raise RuntimeError('First request failed with status {}'.format(result['status']))
+    # Kilobytes on Linux, bytes on macOS
+    if sys.platform == 'darwin':
+        result['maxRss'] //= 1024
+    return result
+
+
+def measure_startup(repeat=5, modes=None):
+    """Measure how long a new worker takes to serve its first request (/v1/validate/match)
+
+    'cold' starts a new interpreter that imports the application; 'preload'
+    imports and warms it up first, then times a forked child, as gunicorn
+    workers are started with preload_app. Each is repeated, and the median
+    times (in seconds) and peak memory (in kilobytes) are reported.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    report = {
+        'version': get_version(),
+        'createdAt': datetime.now().isoformat(),
+        'options': {'repeat': repeat},
+        'startup': {},
+    }
+    for mode in modes or STARTUP_MODES:
+        runs = [run_startup(mode, root) for i in range(repeat)]
+        report['startup'][mode] = dict((name, percentile(sorted(run[name] for run in runs), 50))
+                                       for name in ['import', 'firstRequest', 'total', 'maxRss'])
+    return report
+
+
+def format_startup_report(report, baseline=None):
+    """Format startup benchmark results as text, with the change from baseline results if given"""
+    lines = []
+    for mode, summary in sorted(report['startup'].items()):
+        previous = (baseline or {}).get('startup', {}).get(mode, {})
+        lines.append('{}:'.format(mode))
+        for name in ['import', 'firstRequest', 'total', 'maxRss']:
+            value = summary[name]
+            if name == 'maxRss':
+                line = '  {:<28} {:10.0f} KB'.format(name, value)
+            else:
+                line = '  {:<28} {:10.1f} ms'.format(name, value * 1000)
+            if previous.get(name):
+                line += '  ({:+.1f}%)'.format((value / previous[name] - 1) * 100)
+            lines.append(line)
+    return '\n'.join(lines)
+
+
+def format_report(report, baseline=None):
+    """Format benchmark results as text, with the change from baseline results if given"""
+    lines = []
+    for endpoint, summary in sorted(report['endpoints'].items()):
+        previous = (baseline or {}).get('endpoints', {}).get(endpoint, {})
+        lines.append('{}: {} requests, {} errors in {:.1f}s'.format(
+            endpoint, summary['requests'], summary['errors'], summary['seconds']))
+
+        for name in ['throughput'] + ['p{}'.format(p) for p in PERCENTILES] + ['cpuPerRequest']:
+            value = summary.get(name)
+            if value is None:
+                continue
+            if name == 'throughput':
+                line = '  {:<28} {:10.1f} req/s'.format(name, value)
+            else:
+                line = '  {:<28} {:10.1f} ms'.format(name, value * 1000)
+            if previous.get(name):
+                line += '  ({:+.1f}%)'.format((value / previous[name] - 1) * 100)
+            lines.append(line)
+
+        for stage, timing in sorted(summary['stages'].items()):
+            lines.append('  {:<28} {:10.1f} ms (x{})'.format(stage, timing['mean'] * 1000, timing['count']))
+    return '\n'.join(lines)
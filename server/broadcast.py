@@ -0,0 +1,87 @@
+"""
+Concurrent fan-out of a single match request to many servers
+"""
+
+from __future__ import with_statement, division, unicode_literals
+
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from .tracing import activate, get_current_trace
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_WORKERS = 16
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor(max_workers=DEFAULT_MAX_WORKERS):
+    """Get the process-wide executor used for outgoing requests"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=max_workers)
+        return _executor
+
+
+def get_recipients(servers, sender_id):
+    """Get the servers to broadcast a request to, never including the one it came from"""
+    return [server for server in servers if server['server_id'] != sender_id]
+
+
+def _send(app, send, request, server, timeout, trace=None):
+    # Each thread needs its own application context for backend access, and
+    # the trace of the request, to record its spans
+    with app.app_context(), activate(trace):
+        return send(request, server, timeout=timeout)
+
+
+def _send_request(request, server, timeout=10):
+    return request.send(server, timeout=timeout)
+
+
+def broadcast(app, request, servers, timeout=10, deadline=None, max_workers=DEFAULT_MAX_WORKERS,
+              send=_send_request):
+    """Send the request to every server concurrently
+
+    Returns a tuple of (completed, timed_out, failed), where completed is a
+    list of (server, MMEResponse) pairs, timed_out is a list of the servers that
+    did not respond before the deadline, and failed is a list of the servers
+    for which the request could not be sent at all.
+
+    timeout - terminate each individual request after this many seconds
+    deadline - stop waiting for any responses after this many seconds
+    send - a function(request, server, timeout) that returns a MMEResponse
+    """
+    executor = get_executor(max_workers=max_workers)
+    trace = get_current_trace()
+    futures = {}
+    for server in servers:
+        future = executor.submit(_send, app, send, request, server, timeout, trace)
+        futures[future] = server
+
+    logger.info('Broadcasting request to {} servers'.format(len(futures)))
+    done, not_done = wait(futures, timeout=deadline)
+
+    completed = []
+    failed = []
+    for future in done:
+        server = futures[future]
+        try:
+            completed.append((server, future.result()))
+        except Exception as e:
+            # send() handles its own errors, so this should not happen
+            logger.error('Error sending request to {}: {}'.format(server['server_id'], e))
+            failed.append(server)
+
+    timed_out = []
+    for future in not_done:
+        # Do not start requests that are still queued
+        future.cancel()
+        timed_out.append(futures[future])
+
+    return completed, timed_out, failed
@@ -0,0 +1,118 @@
+"""
+Process-local caches
+"""
+
+from __future__ import with_statement, division, unicode_literals
+
+import hashlib
+import json
+import threading
+import time
+
+from collections import OrderedDict
+
+
+def canonical_hash(obj):
+    """Get a hash of a JSON-serializable object that ignores key order and whitespace"""
+    data = json.dumps(obj, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+
+class LRUCache:
+    """A thread-safe, size-bounded cache that evicts the least recently used entries
+
+    maxsize - the maximum number of entries (0 to disable caching)
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            # Re-insert to mark as most recently used
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        """Get the hit/miss counters and size of the cache"""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+        }
+
+
+class TTLCache(LRUCache):
+    """A LRU cache whose entries also expire after a per-entry time-to-live
+
+    maxsize - the maximum number of entries (0 to disable caching)
+    """
+    def get(self, key, default=None):
+        entry = LRUCache.get(self, key)
+        if entry is None:
+            return default
+
+        expires_at, value = entry
+        if expires_at < time.time():
+            self.delete(key)
+            # Count as a miss, not a hit
+            with self._lock:
+                self.hits -= 1
+                self.misses += 1
+            return default
+        return value
+
+    def set(self, key, value, ttl=60):
+        if ttl <= 0:
+            return
+        LRUCache.set(self, key, (time.time() + ttl, value))
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(name, factory=LRUCache, **kwargs):
+    """Get the named cache for this process, creating it with the given arguments on first use"""
+    with _caches_lock:
+        if name not in _caches:
+            _caches[name] = factory(**kwargs)
+        return _caches[name]
+
+
+def get_cache_stats():
+    """Get the stats for all caches, by name"""
+    with _caches_lock:
+        return dict((name, cache.stats()) for name, cache in _caches.items())
@@ -0,0 +1,84 @@
+"""
+Coalescing of identical concurrent calls
+"""
+
+from __future__ import with_statement, division, unicode_literals
+
+import threading
+
+
+class CallTimeout(Exception):
+    """Raised when waiting for another caller's result takes too long"""
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+class SingleFlight:
+    """Runs at most one call at a time per key
+
+    Callers that arrive while a call for the same key is in progress wait for
+    it and share its result (or its exception), instead of making their own.
+    The result is not kept after the call finishes.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, function, *args, **kwargs):
+        """Call function(*args, **kwargs), or wait for the call already in progress for the key
+
+        Pass wait_timeout (seconds) to raise CallTimeout if the call in progress
+        does not finish in time.
+
+        Returns a (result, shared) tuple, where shared is whether the result
+        came from another caller's call.
+        """
+        wait_timeout = kwargs.pop('wait_timeout', None)
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.followers += 1
+
+        if not leader:
+            if not call.event.wait(wait_timeout):
+                raise CallTimeout()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = function(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result, False
+
+    def in_flight(self):
+        """The number of calls in progress"""
+        with self._lock:
+            return len(self._calls)
+
+
+_single_flights = {}
+_single_flights_lock = threading.Lock()
+
+
+def get_single_flight(name):
+    """Get the named SingleFlight for this process"""
+    with _single_flights_lock:
+        if name not in _single_flights:
+            _single_flights[name] = SingleFlight()
+        return _single_flights[name]
@@ -2,17 +2,48 @@
 Compatibility code
 """
 
+import importlib
+
 try:
-    from urllib import urlretrieve
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
 except ImportError:
-    from urllib.request import urlretrieve
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
 
 try:
-    from urllib2 import urlopen, Request
+    from urlparse import urlsplit
 except ImportError:
-    from urllib.request import urlopen, Request
+    from urllib.parse import urlsplit
 
 try:
-    from urllib2 import HTTPError
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
 except ImportError:
-    from urllib.error import HTTPError
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+
+def import_optional(name):
+    """Import the module, or return None if it is not installed"""
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
+
+class LazyModule:
+    """An optional module, imported when it is first needed
+
+    Optional dependencies that only some configurations use are imported
+    this way, so that worker processes that don't need them start faster.
+    """
+    def __init__(self, name):
+        self.name = name
+        self._module = None
+        self._imported = False
+
+    def get(self):
+        """Get the module, or None if it is not installed"""
+        if not self._imported:
+            self._module = import_optional(self.name)
+            self._imported = True
+        return self._module
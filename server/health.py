@@ -0,0 +1,170 @@
+"""
+Health tracking of outgoing servers, with circuit breaking and adaptive timeouts
+"""
+
+from __future__ import with_statement, division, unicode_literals
+
+import logging
+import math
+import threading
+import time
+
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+DEFAULT_WINDOW = 100
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30
+
+
+def is_failure(status):
+    """Whether the response status indicates the server is unhealthy"""
+    return status >= 500
+
+
+class ServerHealth:
+    """Tracks recent requests to a server and decides whether to send more
+
+    After failure_threshold consecutive failures the circuit opens and requests
+    are refused. After reset_timeout seconds, a single probe request is let
+    through (half-open): if it succeeds the circuit closes again, otherwise it
+    stays open for another reset_timeout.
+
+    server_id - the id of the server, for logging
+    window - the number of recent requests used for latency and error stats
+    """
+    def __init__(self, server_id=None, window=DEFAULT_WINDOW, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT):
+        self.server_id = server_id
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+        self._outcomes = deque(maxlen=window)
+        self._opened_at = None
+        self._probe_started_at = None
+
+    def allow_request(self):
+        """Whether a request may be sent to the server now"""
+        now = time.time()
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+
+            if self.state == OPEN:
+                if now - self._opened_at < self.reset_timeout:
+                    return False
+                self.state = HALF_OPEN
+                self._probe_started_at = now
+                return True
+
+            # Half-open: only one probe at a time, unless it was lost
+            if now - self._probe_started_at >= self.reset_timeout:
+                self._probe_started_at = now
+                return True
+            return False
+
+    def record(self, status, elapsed_time=None):
+        """Record the outcome of a request to the server"""
+        failed = is_failure(status)
+        with self._lock:
+            self._outcomes.append(failed)
+            if failed:
+                self.consecutive_failures += 1
+                if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                    if self.state != OPEN:
+                        logger.warning('Opening circuit for {} after {} failures'.format(
+                            self.server_id, self.consecutive_failures))
+                    self.state = OPEN
+                    self._opened_at = time.time()
+            else:
+                if elapsed_time:
+                    self._latencies.append(elapsed_time)
+                self.consecutive_failures = 0
+                self.state = CLOSED
+
+    def get_percentile(self, percentile):
+        """Get the given percentile (0-100) of recent successful request latencies"""
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if not latencies:
+            return None
+        index = int(math.ceil(percentile / 100 * len(latencies))) - 1
+        return latencies[max(index, 0)]
+
+    def get_error_rate(self):
+        """Get the fraction of recent requests that failed"""
+        with self._lock:
+            if not self._outcomes:
+                return 0.0
+            return sum(self._outcomes) / len(self._outcomes)
+
+    def get_timeout(self, timeout, percentile=99, multiplier=3, min_timeout=2, min_samples=20):
+        """Get a timeout adapted to the server's observed latency
+
+        The timeout is a multiple of the given latency percentile, bounded
+        below by min_timeout and above by the requested timeout. The requested
+        timeout is used until there are enough samples.
+        """
+        with self._lock:
+            samples = len(self._latencies)
+        if samples < min_samples:
+            return timeout
+        adaptive = self.get_percentile(percentile) * multiplier
+        return min(timeout, max(min_timeout, adaptive))
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'consecutiveFailures': self.consecutive_failures,
+            'errorRate': self.get_error_rate(),
+            'p50': self.get_percentile(50),
+            'p95': self.get_percentile(95),
+            'p99': self.get_percentile(99),
+        }
+
+
+class HealthTracker:
+    """The health of every outgoing server, by server id"""
+    def __init__(self, **kwargs):
+        self._kwargs = kwargs
+        self._lock = threading.Lock()
+        self._servers = {}
+
+    def get(self, server_id):
+        with self._lock:
+            health = self._servers.get(server_id)
+            if health is None:
+                health = self._servers[server_id] = ServerHealth(server_id=server_id, **self._kwargs)
+            return health
+
+    def stats(self):
+        with self._lock:
+            servers = dict(self._servers)
+        return dict((server_id, health.stats()) for server_id, health in servers.items())
+
+
+_tracker = None
+_tracker_lock = threading.Lock()
+
+
+def get_tracker(**kwargs):
+    """Get the health tracker for this process, creating it with the given arguments on first use"""
+    global _tracker
+    with _tracker_lock:
+        if _tracker is None:
+            _tracker = HealthTracker(**kwargs)
+        return _tracker
+
+
+def get_current_tracker():
+    """Get the health tracker for this process, or None if it was not used yet"""
+    with _tracker_lock:
+        return _tracker
@@ -0,0 +1,359 @@
+"""
+Batch match jobs, run in the background by a bounded pool of threads
+
+Each job is kept in its own directory: the submitted requests, the results
+as they are completed (both as JSON lines), and the job's state. The job is
+run by the worker process that accepted it, but any process can report its
+state and stream its results. If that process exits before the job is done,
+another process resumes the job's remaining items.
+"""
+
+from __future__ import with_statement, division, unicode_literals
+
+import fcntl
+import io
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from . import serialization
+from .metrics import _is_alive
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_RECEIVER_CONCURRENCY = 2
+CHUNK_SIZE = 64 * 1024
+LOCK_FILENAME = 'jobs.lock'
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+
+
+class Job:
+    """A batch of match requests, each sent to one or more servers"""
+    REQUESTS_FILE = 'requests.ndjson'
+    RESULTS_FILE = 'results.ndjson'
+    STATE_FILE = 'job.json'
+
+    def __init__(self, directory, state):
+        self.directory = directory
+        self.state = state
+        self._lock = threading.Lock()
+
+    @property
+    def id(self):
+        return self.state['jobId']
+
+    def _path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    @classmethod
+    def create(cls, root, sender_id, servers, requests):
+        """Store a new job
+
+        requests - the serialized requests (UTF-8 encoded JSON, one per request)
+        """
+        job_id = uuid.uuid4().hex
+        directory = os.path.join(root, job_id)
+        os.makedirs(directory)
+
+        offsets = []
+        with open(os.path.join(directory, cls.REQUESTS_FILE), 'wb') as ofp:
+            for data in requests:
+                offsets.append(ofp.tell())
+                ofp.write(data.replace(b'\n', b' ') + b'\n')
+
+        now = time.time()
+        job = cls(directory, {
+            'jobId': job_id,
+            'senderId': sender_id,
+            'servers': list(servers),
+            'state': QUEUED,
+            'total': len(offsets) * len(servers),
+            'completed': 0,
+            'failed': 0,
+            'ownerPid': os.getpid(),
+            'createdAt': now,
+            'updatedAt': now,
+        })
+        job.offsets = offsets
+        job.save()
+        open(job._path(cls.RESULTS_FILE), 'wb').close()
+        return job
+
+    @classmethod
+    def load(cls, root, job_id):
+        """Get the job with the given id, or None if it does not exist"""
+        if not job_id.isalnum():
+            return None
+
+        directory = os.path.join(root, job_id)
+        try:
+            with open(os.path.join(directory, cls.STATE_FILE)) as ifp:
+                return cls(directory, json.load(ifp))
+        except (IOError, OSError, ValueError):
+            return None
+
+    def save(self):
+        """Write the job's state, atomically"""
+        path = self._path(self.STATE_FILE)
+        tmp_path = '{}.{}.tmp'.format(path, threading.current_thread().ident)
+        with open(tmp_path, 'w') as ofp:
+            json.dump(self.state, ofp)
+        os.rename(tmp_path, path)
+
+    def read_request(self, offset):
+        """Get the parsed request stored at the offset in the requests file"""
+        with open(self._path(self.REQUESTS_FILE), 'rb') as ifp:
+            ifp.seek(offset)
+            return serialization.loads(ifp.readline())
+
+    def read_offsets(self):
+        """Get the offset of each request in the requests file"""
+        offsets = []
+        with open(self._path(self.REQUESTS_FILE), 'rb') as ifp:
+            while True:
+                offset = ifp.tell()
+                if not ifp.readline():
+                    return offsets
+                offsets.append(offset)
+
+    def is_orphaned(self):
+        """Whether the job is unfinished and the process running it is gone"""
+        if self.state['state'] not in (QUEUED, RUNNING):
+            return False
+        pid = self.state.get('ownerPid')
+        return pid is None or not _is_alive(pid)
+
+    def get_remaining(self):
+        """Get the items not completed yet, as lists of (line, offset) pairs by server id
+
+        A result the previous owner was writing when it exited is discarded,
+        and the counts are updated from the results file.
+        """
+        done = set()
+        failed = 0
+        with self._lock:
+            with open(self._path(self.RESULTS_FILE), 'rb+') as fp:
+                data = fp.read()
+                end = data.rfind(b'\n') + 1
+                fp.truncate(end)
+            for line in data[:end].splitlines():
+                result = serialization.loads(line)
+                done.add((result['serverId'], result['line']))
+                failed += int(result['status'] != 200)
+            self.state['completed'] = len(done)
+            self.state['failed'] = failed
+
+        offsets = self.read_offsets()
+        return dict((server_id, [(line, offset) for line, offset in enumerate(offsets, 1)
+                                 if (server_id, line) not in done])
+                    for server_id in self.state['servers'])
+
+    def set_state(self, state):
+        with self._lock:
+            self.state['state'] = state
+            self.state['ownerPid'] = os.getpid()
+            self.state['updatedAt'] = time.time()
+            self.save()
+
+    def add_result(self, result, failed=False):
+        """Append a result to the results file, and count it"""
+        data = serialization.dumps(result) + b'\n'
+        with self._lock:
+            with open(self._path(self.RESULTS_FILE), 'ab') as ofp:
+                ofp.write(data)
+            self.state['completed'] += 1
+            self.state['failed'] += int(failed)
+            self.state['updatedAt'] = time.time()
+            if self.state['completed'] >= self.state['total']:
+                self.state['state'] = DONE
+            self.save()
+
+    def iter_results(self, chunk_size=CHUNK_SIZE):
+        """Yield the results file (JSON lines) in chunks, up to the last complete line"""
+        with io.open(self._path(self.RESULTS_FILE), 'rb') as ifp:
+            pending = b''
+            while True:
+                chunk = ifp.read(chunk_size)
+                if not chunk:
+                    break
+                chunk = pending + chunk
+                end = chunk.rfind(b'\n') + 1
+                pending = chunk[end:]
+                if end:
+                    yield chunk[:end]
+
+
+class JobRunner:
+    """Runs job items on a bounded pool of threads
+
+    Each (request, server) pair of a job is an item. At most
+    receiver_concurrency items are sent to any one server at a time, across
+    all jobs run by this process.
+
+    process - a function (job, request, server_id) -> (result dict, failed)
+    """
+    def __init__(self, process, max_workers=DEFAULT_MAX_WORKERS,
+                 receiver_concurrency=DEFAULT_RECEIVER_CONCURRENCY):
+        self.process = process
+        self.receiver_concurrency = receiver_concurrency
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._receiver_slots = {}
+        self._stopping = threading.Event()
+
+    def _get_slots(self, server_id):
+        with self._lock:
+            slots = self._receiver_slots.get(server_id)
+            if slots is None:
+                slots = self._receiver_slots[server_id] = threading.BoundedSemaphore(self.receiver_concurrency)
+            return slots
+
+    def submit(self, job, remaining=None):
+        """Start running the job's items in the background
+
+        remaining - the (line, offset) items to run for each server id, if not all of them
+        """
+        if remaining is not None and not any(remaining.values()):
+            job.set_state(DONE)
+            return
+
+        job.set_state(RUNNING)
+        for server_id in job.state['servers']:
+            # Each server's items are drained by a few threads, so other
+            # servers' items don't wait behind a slow server
+            server_items = remaining[server_id] if remaining is not None else list(enumerate(job.offsets, 1))
+            items = iter(server_items)
+            lock = threading.Lock()
+            for i in range(min(self.receiver_concurrency, len(server_items))):
+                self.executor.submit(self._drain, job, server_id, items, lock)
+
+    def recover(self, root):
+        """Resume the jobs left unfinished by processes that are gone, returning how many"""
+        if not os.path.isdir(root):
+            return 0
+
+        recovered = 0
+        for job_id in os.listdir(root):
+            job = Job.load(root, job_id)
+            if job is not None and self.recover_job(job):
+                recovered += 1
+        return recovered
+
+    def recover_job(self, job):
+        """Resume the job if it was left unfinished by a process that is gone, returning whether it was"""
+        if not job.is_orphaned():
+            return False
+
+        # Claim the job, so only one process resumes it
+        root = os.path.dirname(job.directory)
+        with _locked(root):
+            job = Job.load(root, job.id)
+            if job is None or not job.is_orphaned():
+                return False
+            job.set_state(RUNNING)
+
+        logger.info('Resuming job {}'.format(job.id))
+        self.submit(job, remaining=job.get_remaining())
+        return True
+
+    def _drain(self, job, server_id, items, lock):
+        slots = self._get_slots(server_id)
+        while not self._stopping.is_set():
+            with lock:
+                item = next(items, None)
+            if item is None:
+                return
+
+            line, offset = item
+            with slots:
+                try:
+                    result, failed = self.process(job, job.read_request(offset), server_id)
+                except Exception as e:
+                    logger.exception('Error running job item')
+                    result, failed = {'status': 500, 'response': {'message': str(e)}}, True
+            result = dict(result, line=line, serverId=server_id)
+            job.add_result(result, failed=failed)
+
+    def shutdown(self, wait=True, finish=True):
+        """Stop the runner
+
+        finish - run all submitted items first, rather than only those in
+            progress; the rest are resumed by another process
+        """
+        if not finish:
+            self._stopping.set()
+        self.executor.shutdown(wait=wait)
+
+
+@contextmanager
+def _locked(root):
+    """Hold an exclusive lock on the jobs directory, across processes"""
+    with open(os.path.join(root, LOCK_FILENAME), 'a') as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+def remove_expired(root, ttl):
+    """Delete jobs last updated more than ttl seconds ago"""
+    if not os.path.isdir(root):
+        return
+
+    cutoff = time.time() - ttl
+    for job_id in os.listdir(root):
+        job = Job.load(root, job_id)
+        if job is not None and job.state['updatedAt'] < cutoff:
+            shutil.rmtree(job.directory, ignore_errors=True)
+
+
+_runner = None
+_runner_pid = None
+_runner_lock = threading.Lock()
+
+
+def get_runner(process, root=None, **kwargs):
+    """Get the job runner for the current process, creating it on first use
+
+    root - the jobs directory, whose orphaned jobs the new runner resumes
+    """
+    global _runner, _runner_pid
+    pid = os.getpid()
+    with _runner_lock:
+        if _runner is None or _runner_pid != pid:
+            _runner = JobRunner(process, **kwargs)
+            _runner_pid = pid
+            if root:
+                _runner.recover(root)
+        return _runner
+
+
+def get_current_runner():
+    """Get the job runner for the current process, or None if it was not used yet"""
+    with _runner_lock:
+        if _runner_pid == os.getpid():
+            return _runner
+
+
+def close_runner():
+    """Stop the job runner for the current process, if any, after the items in progress
+
+    The jobs' remaining items are left to be resumed by another process.
+    """
+    global _runner
+    with _runner_lock:
+        if _runner is not None and _runner_pid == os.getpid():
+            _runner.shutdown(finish=False)
+        _runner = None
@@ -4,4 +4,7 @@ Database managers
 from __future__ import with_statement, division, unicode_literals
 
 
+from .payloads import PayloadManager
+from .profiles import ProfileManager
+from .rollups import RollupManager
 from .stats import StatsManager
@@ -0,0 +1,61 @@
+"""
+Compact encoding of JSON payloads for storage in binary fields.
+"""
+
+from __future__ import with_statement, division, unicode_literals
+
+import zlib
+
+from base64 import b64decode, b64encode
+
+from .. import serialization
+from ..compat import LazyModule
+
+zstandard = LazyModule('zstandard')
+
+# Encoding of documents logged before compression was introduced
+LEGACY_ENCODING = 'json'
+ENCODINGS = [LEGACY_ENCODING, 'zlib', 'zstd']
+
+
+def _compress(data, encoding):
+    if encoding == 'zlib':
+        return zlib.compress(data, 6)
+    elif encoding == 'zstd':
+        return zstandard.get().ZstdCompressor(level=3).compress(data)
+    elif encoding == LEGACY_ENCODING:
+        return data
+    raise ValueError('Unknown encoding: {}'.format(encoding))
+
+
+def _decompress(data, encoding):
+    if encoding == 'zlib':
+        return zlib.decompress(data)
+    elif encoding == 'zstd':
+        return zstandard.get().ZstdDecompressor().decompress(data)
+    elif encoding == LEGACY_ENCODING:
+        return data
+    raise ValueError('Unknown encoding: {}'.format(encoding))
+
+
+def get_encoding(preferred='zlib'):
+    """Get the preferred encoding, falling back to zlib if zstd is not installed"""
+    if preferred == 'zstd' and zstandard.get() is None:
+        return 'zlib'
+    return preferred
+
+
+def encode(obj, encoding='zlib'):
+    """Serialize the object as compact JSON, compressed and base64-encoded for a binary field"""
+    return encode_data(serialization.dumps(obj), encoding=encoding)
+
+
+def encode_data(data, encoding='zlib'):
+    """Compress and base64-encode already serialized JSON (UTF-8 bytes) for a binary field"""
+    return b64encode(_compress(data, encoding)).decode()
+
+
+def decode(blob, encoding=None):
+    """Decode a blob produced by encode (or by the legacy, uncompressed format)"""
+    data = _decompress(b64decode(blob), encoding or LEGACY_ENCODING)
+    return serialization.loads(data)
@@ -0,0 +1,232 @@
+"""
+Write-behind buffering of documents, indexed in bulk from a background thread.
+"""
+
+from __future__ import with_statement, division, unicode_literals
+
+import atexit
+import logging
+import os
+import threading
+import time
+
+from elasticsearch.helpers import bulk
+
+try:
+    from Queue import Queue, Empty, Full
+except ImportError:
+    from queue import Queue, Empty, Full
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUFFER_SIZE = 10000
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_FLUSH_INTERVAL = 1.0
+# How often the background thread checks whether it was stopped, at most (seconds)
+STOP_POLL_INTERVAL = 0.5
+
+
+def index_actions(client, actions):
+    """Index the actions with the bulk API, returning (number indexed, errors)
+
+    Creating a document that already exists is not an error.
+    """
+    indexed, errors = bulk(client, actions, raise_on_error=False)
+    errors = [error for error in errors if error.get('create', {}).get('status') != 409]
+    return indexed, errors
+
+
+def get_failed_ids(errors):
+    """Get the ids of the documents in the bulk API errors"""
+    return set(info.get('_id') for error in errors for info in error.values())
+
+
+class BulkWriter:
+    """Buffers documents and indexes them in batches with the bulk API
+
+    client - the Elasticsearch client
+    buffer_size - the maximum number of documents waiting to be indexed
+    batch_size - index the buffered documents once this many are waiting
+    flush_interval - index the buffered documents at least this often (seconds)
+    block_timeout - when the buffer is full, wait up to this many seconds for
+        space before dropping the document (0 to drop immediately)
+    """
+    def __init__(self, client, buffer_size=DEFAULT_BUFFER_SIZE, batch_size=DEFAULT_BATCH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, block_timeout=0):
+        self.client = client
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.block_timeout = block_timeout
+        self.indexed = 0
+        self.dropped = 0
+        self.failed = 0
+        self._queue = Queue(maxsize=buffer_size)
+        self._counter_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='bulk-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, index, doc_type, doc):
+        """Queue the document to be indexed, returning False if it was dropped"""
+        return self.put_action({
+            '_index': index,
+            '_type': doc_type,
+            '_source': doc,
+        })
+
+    def put_action(self, action, callback=None):
+        """Queue a bulk API action, returning False if it was dropped
+
+        callback - a function called with whether the action succeeded, once
+            it was indexed (not if it was dropped)
+        """
+        item = (action, callback)
+        try:
+            # Never wait for space from the background thread, which is the one making space
+            if self.block_timeout and threading.current_thread() is not self._thread:
+                self._queue.put(item, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(item)
+        except Full:
+            with self._counter_lock:
+                self.dropped += 1
+            logger.warning('Write buffer full, dropped document ({} dropped so far)'.format(self.dropped))
+            return False
+        return True
+
+    def pending(self):
+        """The approximate number of documents waiting to be indexed"""
+        return self._queue.qsize()
+
+    def _take(self, timeout=None):
+        """Take up to batch_size (action, callback) items from the queue, waiting up to timeout for the first"""
+        items = []
+        try:
+            items.append(self._queue.get(timeout=timeout) if timeout else self._queue.get_nowait())
+            while len(items) < self.batch_size:
+                items.append(self._queue.get_nowait())
+        except Empty:
+            pass
+        return items
+
+    def _index(self, items):
+        if not items:
+            return
+
+        actions = [action for action, callback in items]
+        try:
+            indexed, errors = index_actions(self.client, actions)
+            self.indexed += indexed
+            if errors:
+                self.failed += len(errors)
+                logger.warning('Error indexing {} documents: {}'.format(len(errors), errors[:1]))
+            failed_ids = get_failed_ids(errors)
+        except Exception as e:
+            self.failed += len(actions)
+            logger.warning('Error indexing {} documents: {}'.format(len(actions), e))
+            failed_ids = None
+
+        for action, callback in items:
+            if callback is not None:
+                try:
+                    callback(failed_ids is not None and action.get('_id') not in failed_ids)
+                except Exception as e:
+                    logger.warning('Error in bulk writer callback: {}'.format(e))
+
+    def _run(self):
+        deadline = time.time() + self.flush_interval
+        items = []
+        while not self._stopped.is_set():
+            timeout = min(max(deadline - time.time(), 0.01), STOP_POLL_INTERVAL)
+            items.extend(self._take(timeout=timeout))
+            if len(items) >= self.batch_size or time.time() >= deadline:
+                with self._flush_lock:
+                    self._index(items)
+                items = []
+                if time.time() >= deadline:
+                    _run_hooks(_periodic_hooks, self)
+                deadline = time.time() + self.flush_interval
+
+        with self._flush_lock:
+            self._index(items)
+
+    def flush(self):
+        """Index all queued documents now"""
+        with self._flush_lock:
+            while True:
+                items = self._take()
+                if not items:
+                    break
+                self._index(items)
+
+    def close(self):
+        """Stop the background thread and index all remaining documents"""
+        self._stopped.set()
+        self._thread.join(timeout=self.flush_interval + 1)
+        self.flush()
+
+
+_writer = None
+_writer_pid = None
+_writer_lock = threading.Lock()
+_periodic_hooks = []
+_close_hooks = []
+
+
+def _run_hooks(hooks, writer):
+    for hook in hooks:
+        try:
+            hook(writer)
+        except Exception as e:
+            logger.warning('Error in bulk writer hook: {}'.format(e))
+
+
+def get_writer(client, **kwargs):
+    """Get the bulk writer for the current process
+
+    The writer is created on first use with the given arguments, and again after
+    a fork, since its background thread does not survive forking.
+    """
+    global _writer, _writer_pid
+    pid = os.getpid()
+    with _writer_lock:
+        if _writer is None or _writer_pid != pid:
+            _writer = BulkWriter(client, **kwargs)
+            _writer_pid = pid
+        return _writer
+
+
+def get_current_writer():
+    """Get the bulk writer for the current process, or None if it was not used yet"""
+    with _writer_lock:
+        if _writer_pid == os.getpid():
+            return _writer
+
+
+def add_periodic_hook(hook):
+    """Add a function to be called with the writer from its background thread, every flush interval
+
+    The function can queue documents that are due, even when no others are
+    being written.
+    """
+    _periodic_hooks.append(hook)
+
+
+def add_close_hook(hook):
+    """Add a function to be called with the writer just before it is closed, to queue any final documents"""
+    _close_hooks.append(hook)
+
+
+def close_writer():
+    """Flush and stop the bulk writer for the current process, if any"""
+    global _writer
+    with _writer_lock:
+        if _writer is not None and _writer_pid == os.getpid():
+            _run_hooks(_close_hooks, _writer)
+            _writer.close()
+        _writer = None
+
+
+atexit.register(close_writer)
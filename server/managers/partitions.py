@@ -0,0 +1,72 @@
+"""
+Time-partitioned indices: one index per day or month, named <prefix>-<date>.
+"""
+
+from __future__ import with_statement, division, unicode_literals
+
+from datetime import datetime, timedelta
+
+PARTITION_FORMATS = {
+    'day': '%Y.%m.%d',
+    'month': '%Y.%m',
+}
+
+# Beyond this many partitions, query them all with a wildcard instead
+MAX_LISTED_PARTITIONS = 62
+
+
+def get_partition_start(timestamp, partitioning='month'):
+    """Get the start of the partition containing the timestamp"""
+    if partitioning == 'day':
+        return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    return timestamp.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def get_next_partition_start(start, partitioning='month'):
+    """Get the start of the partition after the one starting at start"""
+    if partitioning == 'day':
+        return start + timedelta(days=1)
+    return (start + timedelta(days=32)).replace(day=1)
+
+
+def get_partition_name(prefix, timestamp, partitioning='month'):
+    """Get the name of the index for documents with the given timestamp"""
+    return '{}-{}'.format(prefix, timestamp.strftime(PARTITION_FORMATS[partitioning]))
+
+
+def get_pattern(prefix):
+    """Get the wildcard pattern matching every partition"""
+    return '{}-*'.format(prefix)
+
+
+def parse_partition_name(prefix, name):
+    """Get the (start, partitioning) of a partition from its index name, or None if it isn't one"""
+    start = '{}-'.format(prefix)
+    if not name.startswith(start):
+        return None
+
+    for partitioning, date_format in PARTITION_FORMATS.items():
+        try:
+            return datetime.strptime(name[len(start):], date_format), partitioning
+        except ValueError:
+            pass
+
+
+def get_partition_names(prefix, since=None, until=None, partitioning='month'):
+    """Get the names of the partitions covering since (inclusive) to until (exclusive)
+
+    Returns None if the range is unbounded, or covers too many partitions to
+    list, in which case all partitions should be queried.
+    """
+    if since is None:
+        return None
+
+    names = []
+    start = get_partition_start(since, partitioning)
+    until = until or datetime.now()
+    while start < until:
+        if len(names) >= MAX_LISTED_PARTITIONS:
+            return None
+        names.append(get_partition_name(prefix, start, partitioning))
+        start = get_next_partition_start(start, partitioning)
+    return names
@@ -0,0 +1,77 @@
+"""
+A database manager for deduplicated exchange payloads.
+"""
+
+from __future__ import with_statement, division, unicode_literals
+
+import logging
+
+from elasticsearch.exceptions import NotFoundError
+
+from mme_server.managers.base import BaseManager
+from mme_server.managers import Managers
+
+from . import blobs
+
+logger = logging.getLogger(__name__)
+
+
+class PayloadManager(BaseManager):
+    """Stores each distinct request body once, keyed by its content hash
+
+    With partitioned exchange logs, payloads are stored once per partition, in
+    exchange_payloads-<date>, alongside the exchanges that refer to them.
+    Payloads logged before partitioning are in the `exchange_payloads` index.
+    """
+    NAME = 'exchange_payloads'
+    DOC_TYPE = 'payload'
+    CONFIG = {
+        'mappings': {
+            'payload': {
+                'properties': {
+                    'payload': {
+                        'type': 'binary',
+                        'doc_values': False,
+                    },
+                    'encoding': {
+                        'type': 'string',
+                        'index': 'not_analyzed',
+                    },
+                }
+            }
+        }
+    }
+
+    @classmethod
+    def get_action(cls, content_hash, blob, encoding, index=None):
+        """Get the bulk action to store the payload, if not already stored
+
+        index - the partition to store it in, if not the unpartitioned index
+        """
+        return {
+            '_op_type': 'create',
+            '_index': index or cls.NAME,
+            '_type': cls.DOC_TYPE,
+            '_id': content_hash,
+            '_source': {
+                'payload': blob,
+                'encoding': encoding,
+            },
+        }
+
+    def get_payload(self, content_hash, index=None):
+        """Get the decoded payload with the given hash, or None if not found
+
+        index - the partition it is stored in, if not the unpartitioned index
+        """
+        try:
+            doc = self._db.get(index=index or self.NAME, doc_type=self.DOC_TYPE, id=content_hash)
+        except NotFoundError:
+            return None
+
+        source = doc['_source']
+        return blobs.decode(source['payload'], source.get('encoding'))
+
+
+# Register manager
+Managers.add_manager('payloads', PayloadManager)
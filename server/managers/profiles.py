@@ -0,0 +1,78 @@
+"""
+A database manager for the capability profiles of outgoing servers.
+"""
+
+from __future__ import with_statement, division, unicode_literals
+
+import logging
+
+from elasticsearch.exceptions import NotFoundError
+
+from mme_server.managers.base import BaseManager
+from mme_server.managers import Managers
+
+from ..shaping import validate_profile
+
+logger = logging.getLogger(__name__)
+
+
+class ProfileManager(BaseManager):
+    """Stores each server's capability profile, keyed by server id
+
+    A profile has the optional request fields the server uses (fields, or
+    None for all) and whether it accepts gzip-compressed requests
+    (gzip_requests) and responses (gzip_responses). See server.shaping.
+    """
+    NAME = 'exchange_server_profiles'
+    DOC_TYPE = 'profile'
+    CONFIG = {
+        'mappings': {
+            'profile': {
+                'properties': {
+                    'fields': {
+                        'type': 'string',
+                        'index': 'not_analyzed',
+                    },
+                    'gzip_requests': {
+                        'type': 'boolean',
+                    },
+                    'gzip_responses': {
+                        'type': 'boolean',
+                    },
+                }
+            }
+        }
+    }
+
+    def get_profiles(self):
+        """Get all profiles, as a dict of server id -> profile"""
+        if not self.index_exists():
+            return {}
+
+        s = self.search()
+        return dict((hit.meta.id, hit.to_dict()) for hit in s.scan())
+
+    def get_profile(self, server_id):
+        """Get the server's profile, or None if it has none"""
+        try:
+            doc = self._db.get(index=self.NAME, doc_type=self.DOC_TYPE, id=server_id)
+        except NotFoundError:
+            return None
+        return doc['_source']
+
+    def set_profile(self, server_id, profile):
+        """Store the server's profile, raising ValueError if it is not valid"""
+        validate_profile(profile)
+        self._db.index(index=self.NAME, doc_type=self.DOC_TYPE, id=server_id, body=profile, refresh=True)
+
+    def delete_profile(self, server_id):
+        """Delete the server's profile, returning whether it had one"""
+        try:
+            self._db.delete(index=self.NAME, doc_type=self.DOC_TYPE, id=server_id, refresh=True)
+        except NotFoundError:
+            return False
+        return True
+
+
+# Register manager
+Managers.add_manager('profiles', ProfileManager)
@@ -0,0 +1,359 @@
+"""
+A database manager for pre-aggregated exchange statistics.
+"""
+
+from __future__ import with_statement, division, unicode_literals
+
+import itertools
+import logging
+import os
+import threading
+import time
+import uuid
+
+from datetime import datetime, timedelta
+
+from elasticsearch.helpers import bulk
+from elasticsearch_dsl import Q
+
+from mme_server.backend import get_backend
+from mme_server.managers.base import BaseManager
+from mme_server.managers import Managers
+
+from .bulk import add_close_hook, add_periodic_hook
+from ..sketch import LatencySketch
+
+logger = logging.getLogger(__name__)
+
+HOUR_FORMAT = '%Y-%m-%dT%H:00:00'
+DEFAULT_FLUSH_INTERVAL = 10
+INTERVALS = ['hour', 'day', 'all']
+GROUP_FIELDS = ['sender_id', 'receiver_id']
+BACKFILL_SOURCE = 'backfill'
+
+
+def get_hour(timestamp):
+    """Get the start of the hour of a datetime or ISO 8601 string, as an ISO 8601 string"""
+    if isinstance(timestamp, datetime):
+        return timestamp.strftime(HOUR_FORMAT)
+    return '{}:00:00'.format(timestamp[:13])
+
+
+def get_period(hour, interval='hour'):
+    """Get the period of the given interval that the hour falls in"""
+    if interval == 'day':
+        return hour[:10]
+    elif interval == 'all':
+        return None
+    return hour
+
+
+def is_error(status):
+    return status is None or status >= 400
+
+
+class Bucket:
+    """Counts, latency totals and a latency sketch for a group of exchanges"""
+    def __init__(self, key, id=None):
+        self.key = key
+        self.id = id
+        self.count = 0
+        self.errors = 0
+        self.took_sum = 0.0
+        self.took_max = 0.0
+        self.sketch = LatencySketch()
+
+    def add(self, status, took):
+        took = took or 0.0
+        self.count += 1
+        self.errors += int(is_error(status))
+        self.took_sum += took
+        self.took_max = max(self.took_max, took)
+        self.sketch.add(took)
+
+    def merge(self, doc):
+        """Add the totals from a rollup document"""
+        self.count += doc['count']
+        self.errors += doc['errors']
+        self.took_sum += doc['took_sum']
+        self.took_max = max(self.took_max, doc['took_max'])
+        self.sketch.merge(doc.get('sketch') or {})
+
+    def to_doc(self, source):
+        hour, sender_id, receiver_id, is_test = self.key
+        return {
+            'hour': hour,
+            'sender_id': sender_id,
+            'receiver_id': receiver_id,
+            'is_test': is_test,
+            'source': source,
+            'count': self.count,
+            'errors': self.errors,
+            'took_sum': self.took_sum,
+            'took_max': self.took_max,
+            'sketch': self.sketch.to_dict(),
+        }
+
+
+class RollupBuffer:
+    """The statistics of exchanges logged by this process, by hour and server
+
+    Each bucket is indexed as its own document, overwritten with the latest
+    totals whenever it changes, so the statistics across processes are the sum
+    of the documents. Buckets for past hours are dropped once indexed; a late
+    exchange for one of those hours starts a new document.
+
+    retain_hours - the number of past hours to keep buckets for
+    flush_interval - how often the changed buckets should be indexed (seconds)
+    """
+    def __init__(self, retain_hours=1, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        self.retain_hours = retain_hours
+        self.flush_interval = flush_interval
+        self.source = uuid.uuid4().hex
+        self.last_drain = time.time()
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._buckets = {}
+        self._changed = set()
+
+    def add(self, hour, sender_id, receiver_id, is_test, status, took):
+        key = (hour, sender_id, receiver_id, is_test)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket_id = '{}-{}'.format(self.source, next(self._ids))
+                bucket = self._buckets[key] = Bucket(key, id=bucket_id)
+            bucket.add(status, took)
+            self._changed.add(key)
+
+    def is_due(self, interval=None):
+        if interval is None:
+            interval = self.flush_interval
+        return time.time() - self.last_drain >= interval
+
+    def drain(self):
+        """Get (id, document) pairs for the buckets that changed since the last drain"""
+        cutoff = get_hour(datetime.now() - timedelta(hours=self.retain_hours))
+        with self._lock:
+            docs = [(self._buckets[key].id, self._buckets[key].to_doc(self.source)) for key in self._changed]
+            self._changed.clear()
+            for key in list(self._buckets):
+                if key[0] < cutoff:
+                    del self._buckets[key]
+            self.last_drain = time.time()
+        return docs
+
+
+_buffer = None
+_buffer_pid = None
+_buffer_lock = threading.Lock()
+
+
+def get_buffer():
+    """Get the rollup buffer for the current process"""
+    global _buffer, _buffer_pid
+    pid = os.getpid()
+    with _buffer_lock:
+        if _buffer is None or _buffer_pid != pid:
+            _buffer = RollupBuffer()
+            _buffer_pid = pid
+        return _buffer
+
+
+def get_current_buffer():
+    """Get the rollup buffer for the current process, or None if it was not used yet"""
+    with _buffer_lock:
+        if _buffer_pid == os.getpid():
+            return _buffer
+
+
+def _flush_buffer(writer):
+    """Queue the remaining buckets of this process before the bulk writer closes"""
+    buffer = get_current_buffer()
+    if buffer is not None:
+        for action in RollupManager.get_actions(buffer.drain()):
+            writer.put_action(action)
+
+
+def _flush_due_buffer(writer):
+    """Queue the changed buckets of this process once they are due, even if no more exchanges are logged"""
+    buffer = get_current_buffer()
+    if buffer is not None and buffer.is_due():
+        _flush_buffer(writer)
+
+
+add_periodic_hook(_flush_due_buffer)
+add_close_hook(_flush_buffer)
+
+
+class RollupManager(BaseManager):
+    """Hourly exchange statistics per sender and receiver, from each process"""
+    NAME = 'exchange_rollups'
+    DOC_TYPE = 'rollup'
+    CONFIG = {
+        'mappings': {
+            'rollup': {
+                'properties': {
+                    'hour': {
+                        'type': 'date',
+                    },
+                    'sender_id': {
+                        'type': 'string',
+                        'index': 'not_analyzed',
+                    },
+                    'receiver_id': {
+                        'type': 'string',
+                        'index': 'not_analyzed',
+                    },
+                    'is_test': {
+                        'type': 'boolean',
+                    },
+                    'source': {
+                        'type': 'string',
+                        'index': 'not_analyzed',
+                    },
+                    'count': {
+                        'type': 'integer',
+                    },
+                    'errors': {
+                        'type': 'integer',
+                    },
+                    'took_sum': {
+                        'type': 'double',
+                    },
+                    'took_max': {
+                        'type': 'float',
+                    },
+                    'sketch': {
+                        'type': 'object',
+                        'enabled': False,
+                    },
+                }
+            }
+        }
+    }
+
+    @classmethod
+    def get_actions(cls, docs):
+        """Get the bulk actions to index (id, document) pairs"""
+        return [{
+            '_index': cls.NAME,
+            '_type': cls.DOC_TYPE,
+            '_id': doc_id,
+            '_source': doc,
+        } for doc_id, doc in docs]
+
+    def record(self, doc, writer=None, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        """Add a logged exchange to the statistics
+
+        The changed buckets are queued on the bulk writer every flush_interval
+        seconds (from the writer's background thread if no more exchanges are
+        logged) or, without a writer, indexed immediately.
+
+        doc - the exchange log document
+        """
+        buffer = get_buffer()
+        buffer.flush_interval = flush_interval
+        buffer.add(get_hour(doc['created_at']), doc['sender_id'], doc['receiver_id'], doc['is_test'],
+                   doc['status'], doc['took'])
+
+        if writer is None:
+            bulk(self._db, self.get_actions(buffer.drain()), raise_on_error=False)
+        elif buffer.is_due():
+            for action in self.get_actions(buffer.drain()):
+                writer.put_action(action)
+
+    def get_stats(self, since=None, until=None, sender_id=None, receiver_id=None, include_tests=False,
+                  interval='hour', group_by=GROUP_FIELDS):
+        """Get exchange statistics, merged across processes
+
+        since, until - datetimes; statistics are for the hours overlapping [since, until)
+        interval - group by 'hour', 'day', or 'all' to merge the whole time range
+        group_by - the fields (of sender_id and receiver_id) to group by
+
+        Returns a list of dicts, sorted by period and group.
+        """
+        if not self.index_exists():
+            return []
+
+        s = self.search()
+        if since:
+            s = s.filter('range', hour={'gte': get_hour(since)})
+        if until:
+            s = s.filter('range', hour={'lt': until.strftime('%Y-%m-%dT%H:%M:%S')})
+        if sender_id:
+            s = s.filter('term', sender_id=sender_id)
+        if receiver_id:
+            s = s.filter('term', receiver_id=receiver_id)
+        if not include_tests:
+            s = s.filter('term', is_test=False)
+
+        groups = {}
+        for hit in s.scan():
+            doc = hit.to_dict()
+            key = (get_period(doc['hour'], interval),) + tuple(doc[field] for field in group_by)
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = Bucket(key)
+            group.merge(doc)
+
+        results = []
+        for key in sorted(groups, key=lambda key: tuple('{}'.format(part) for part in key)):
+            group = groups[key]
+            result = {
+                'period': key[0],
+                'count': group.count,
+                'errors': group.errors,
+                'meanTook': group.took_sum / group.count if group.count else None,
+                'maxTook': group.took_max,
+                'p50': group.sketch.quantile(0.5),
+                'p95': group.sketch.quantile(0.95),
+                'p99': group.sketch.quantile(0.99),
+            }
+            for field, value in zip(group_by, key[1:]):
+                result['senderId' if field == 'sender_id' else 'receiverId'] = value
+            results.append(result)
+        return results
+
+    def backfill(self, since=None, until=None, batch_size=500):
+        """Compute the statistics of exchanges logged before statistics were recorded
+
+        Only exchanges not already counted are included, in whole hours, and
+        the documents have fixed ids, so this can safely be re-run.
+
+        Returns the number of exchanges counted.
+        """
+        stats = get_backend().get_manager('stats')
+        s = stats.search_exchanges(since=since, until=until)
+        if s is None:
+            return 0
+
+        s = s.filter(~Q('term', rolled_up=True))
+        if since:
+            s = s.filter('range', created_at={'gte': get_hour(since)})
+        if until:
+            s = s.filter('range', created_at={'lt': get_hour(until)})
+        s = s.source(['sender_id', 'receiver_id', 'is_test', 'status', 'took', 'created_at'])
+
+        buckets = {}
+        counted = 0
+        for hit in s.scan():
+            doc = hit.to_dict()
+            key = (get_hour(doc['created_at']), doc.get('sender_id'), doc.get('receiver_id'),
+                   doc.get('is_test', False))
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket_id = '|'.join([BACKFILL_SOURCE] + ['{}'.format(part) for part in key])
+                bucket = buckets[key] = Bucket(key, id=bucket_id)
+            bucket.add(doc.get('status'), doc.get('took'))
+            counted += 1
+
+        docs = [(bucket.id, bucket.to_doc(BACKFILL_SOURCE)) for bucket in buckets.values()]
+        indexed, errors = bulk(self._db, self.get_actions(docs), chunk_size=batch_size, raise_on_error=False)
+        if errors:
+            logger.warning('Error indexing {} rollups: {}'.format(len(errors), errors[:1]))
+        return counted
+
+
+# Register manager
+Managers.add_manager('rollups', RollupManager)
@@ -4,19 +4,42 @@ A database manager for exchange server statistics.
 
 from __future__ import with_statement, division, unicode_literals
 
-import json
 import logging
+import os
 
-from base64 import b64encode
+from copy import deepcopy
+from datetime import datetime, timedelta
+from elasticsearch.exceptions import NotFoundError, RequestError
+from elasticsearch.helpers import bulk
+from elasticsearch_dsl import Q, Search
+from flask import current_app, has_app_context
 
+from mme_server.backend import get_backend
 from mme_server.managers.base import BaseManager
 from mme_server.managers import Managers
 
+from . import blobs, partitions
+from .bulk import get_failed_ids, get_writer, index_actions, DEFAULT_BUFFER_SIZE, DEFAULT_BATCH_SIZE, DEFAULT_FLUSH_INTERVAL
+from .payloads import PayloadManager
+from .rollups import DEFAULT_FLUSH_INTERVAL as DEFAULT_ROLLUP_FLUSH_INTERVAL
+from ..cache import LRUCache, TTLCache
+
 logger = logging.getLogger(__name__)
 
 
 class StatsManager(BaseManager):
+    """Logs exchanges, in an index per day or month (see STATS_PARTITION)
+
+    The partitions are named exchange-<date>, are created automatically from
+    an index template when first written to, and are all in the `exchanges`
+    alias. Queries only search the partitions covering their time range.
+    Exchanges logged before partitioning are kept in the `exchange` index,
+    which is searched as well while it exists. Deduplicated request payloads
+    are partitioned the same way (see PayloadManager), so they are deleted
+    along with the exchanges that refer to them.
+    """
     NAME = 'exchange'
+    ALIAS = 'exchanges'
     DOC_TYPE = 'request'
     CONFIG = {
         'mappings': {
@@ -45,10 +68,22 @@ class StatsManager(BaseManager):
                         'type': 'binary',
                         'doc_values': False,
                     },
+                    'request_hash': {
+                        'type': 'string',
+                        'index': 'not_analyzed',
+                    },
+                    'payload_index': {
+                        'type': 'string',
+                        'index': 'not_analyzed',
+                    },
                     'response': {
                         'type': 'binary',
                         'doc_values': False,
                     },
+                    'encoding': {
+                        'type': 'string',
+                        'index': 'not_analyzed',
+                    },
                     'created_at': {
                         'type': 'date',
                     },
@@ -58,50 +93,431 @@ class StatsManager(BaseManager):
                     'took': {
                         'type': 'float',
                     },
+                    'rolled_up': {
+                        'type': 'boolean',
+                    },
                 }
             }
         }
     }
 
 
+    # Names of the existing indices, briefly cached
+    _existing_indices = TTLCache(maxsize=1)
+    # The process that last installed the index template
+    _template_pid = None
+
+    @classmethod
+    def get_partitioning(cls):
+        """Get the partitioning ('day' or 'month'), or None to log to a single index"""
+        partitioning = cls._get_config('STATS_PARTITION', 'month')
+        if partitioning and partitioning not in partitions.PARTITION_FORMATS:
+            raise ValueError('Unknown STATS_PARTITION: {}'.format(partitioning))
+        return partitioning
+
+    @classmethod
+    def get_index(cls, timestamp):
+        """Get the name of the index to log an exchange at the given time to"""
+        partitioning = cls.get_partitioning()
+        if not partitioning:
+            return cls.NAME
+        return partitions.get_partition_name(cls.NAME, timestamp, partitioning)
+
+    @classmethod
+    def get_payload_index(cls, timestamp):
+        """Get the name of the index to store the request payload of an exchange at the given time in"""
+        partitioning = cls.get_partitioning()
+        if not partitioning:
+            return PayloadManager.NAME
+        return partitions.get_partition_name(PayloadManager.NAME, timestamp, partitioning)
+
+    def ensure_template(self):
+        """Install the index templates for partitions, once per process"""
+        if self._template_pid == os.getpid() or not self.get_partitioning():
+            return
+
+        self._db.indices.put_template(name=self.NAME, body={
+            'template': partitions.get_pattern(self.NAME),
+            'settings': self.CONFIG.get('settings', {}),
+            'mappings': self.CONFIG['mappings'],
+            'aliases': {self.ALIAS: {}},
+        })
+        self._db.indices.put_template(name=PayloadManager.NAME, body={
+            'template': partitions.get_pattern(PayloadManager.NAME),
+            'settings': PayloadManager.CONFIG.get('settings', {}),
+            'mappings': PayloadManager.CONFIG['mappings'],
+        })
+        StatsManager._template_pid = os.getpid()
+
+    def get_existing_indices(self):
+        """Get the names of the existing partitions and legacy index"""
+        indices = self._existing_indices.get('indices')
+        if indices is None:
+            indices = set(self._db.indices.get_settings(index=partitions.get_pattern(self.NAME)))
+            if self._db.indices.exists(index=self.NAME):
+                indices.add(self.NAME)
+            self._existing_indices.set('indices', indices, ttl=30)
+        return indices
+
+    def get_indices(self, since=None, until=None):
+        """Get the names of the existing indices that may have exchanges from the time range"""
+        existing = self.get_existing_indices()
+        partitioning = self.get_partitioning()
+        if not partitioning:
+            return [index for index in [self.NAME] if index in existing]
+
+        names = partitions.get_partition_names(self.NAME, since=since, until=until, partitioning=partitioning)
+        if names is None:
+            return sorted(existing)
+
+        # The current partition may have been created since the list was cached
+        current = self.get_index(datetime.now())
+        return [index for index in names if index in existing or index == current] + \
+            [index for index in [self.NAME] if index in existing]
+
+    def index_exists(self):
+        return bool(self.get_existing_indices())
+
+    def search_exchanges(self, since=None, until=None):
+        """Get a search of the indices covering the time range, or None if there are none"""
+        indices = self.get_indices(since=since, until=until)
+        if not indices:
+            return None
+        s = Search(using=self._db, index=indices, doc_type=self.DOC_TYPE)
+        return s.params(ignore_unavailable=True)
+
     def get_recent_requests(self, n=10):
-        if self.index_exists():
-            s = self.search()
+        # Look in the latest partitions first, and only search them all if there are too few
+        since = datetime.now() - timedelta(days=1)
+        for indices_since in [since, None]:
+            s = self.search_exchanges(since=indices_since)
+            if s is None:
+                continue
             s = s.filter('term', is_test=False)
             s = s.sort('-created_at')
             s = s[:n]
             results = s.execute()
-            return results.hits
-        else:
-            return []
+            if len(results.hits) >= n or indices_since is None:
+                return results.hits
+        return []
+
+    # Request payloads recently stored by this process, by index and hash
+    _stored_payloads = LRUCache(maxsize=10000)
+    # Recently read request payloads, by hash
+    _loaded_payloads = LRUCache(maxsize=1000)
 
     @classmethod
-    def _object_to_blob(cls, object):
-        return b64encode(json.dumps(object).encode('utf-8')).decode()
+    def _payload_stored(cls, payload_key):
+        """Get a callback that remembers the payload as stored, if it was indexed
+
+        Until then, identical requests queue the payload again (creating it
+        twice is harmless), so a failed or dropped write is never relied on.
+        """
+        def callback(indexed):
+            if indexed:
+                cls._stored_payloads.set(payload_key, True)
+        return callback
+
+    @classmethod
+    def _get_encoding(cls):
+        return blobs.get_encoding(cls._get_config('STATS_COMPRESSION', 'zlib'))
+
+    @classmethod
+    def _object_to_blob(cls, object, encoding='zlib', data=None):
+        """Encode the object, or its serialized JSON data if given, for storage"""
+        if data is not None:
+            return blobs.encode_data(data, encoding=encoding)
+        return blobs.encode(object, encoding=encoding)
+
+    @classmethod
+    def _blob_to_object(cls, blob, encoding=None):
+        return blobs.decode(blob, encoding=encoding)
+
+    def get_request(self, doc):
+        """Get the decoded request from a logged exchange document"""
+        encoding = doc.get('encoding')
+        if doc.get('request'):
+            return self._blob_to_object(doc['request'], encoding=encoding)
+        elif doc.get('request_hash'):
+            content_hash = doc['request_hash']
+            payload = self._loaded_payloads.get(content_hash)
+            if payload is None:
+                payloads = get_backend().get_manager('payloads')
+                payload = payloads.get_payload(content_hash, index=doc.get('payload_index'))
+                if payload is not None:
+                    self._loaded_payloads.set(content_hash, payload)
+            return deepcopy(payload)
+
+    def get_response(self, doc):
+        """Get the decoded response from a logged exchange document"""
+        if doc.get('response'):
+            return self._blob_to_object(doc['response'], encoding=doc.get('encoding'))
+
+    def scan_exchanges(self, since=None, until=None, sender_id=None, receiver_id=None, include_tests=True,
+                       ordered=True, status=None, patient_id=None, include_payloads=True):
+        """Iterate over logged exchange documents, without holding them all in memory
+
+        Documents are read in pages with a scroll, so deep result sets cost
+        Elasticsearch no more than shallow ones.
+
+        since, until - datetimes bounding created_at (until exclusive)
+        ordered - yield the documents in order of created_at (slower)
+        status - an HTTP status, or a (min, max) range of them (max exclusive)
+        patient_id - only exchanges about this patient, as the query patient or in the results
+        include_payloads - if false, the encoded request and response are not fetched
+        """
+        s = self.search_exchanges(since=since, until=until)
+        if s is None:
+            return
+
+        if not include_payloads:
+            s = s.source(exclude=['request', 'response'])
+        if isinstance(status, tuple):
+            s = s.filter('range', status={'gte': status[0], 'lt': status[1]})
+        elif status is not None:
+            s = s.filter('term', status=status)
+        if patient_id:
+            s = s.filter(Q('term', query_patient_id=patient_id) | Q('term', response_patient_ids=patient_id))
+        if since:
+            s = s.filter('range', created_at={'gte': since})
+        if until:
+            s = s.filter('range', created_at={'lt': until})
+        if sender_id:
+            s = s.filter('term', sender_id=sender_id)
+        if receiver_id:
+            s = s.filter('term', receiver_id=receiver_id)
+        if not include_tests:
+            s = s.filter('term', is_test=False)
+        if ordered:
+            s = s.sort('created_at').params(preserve_order=True)
+
+        for hit in s.scan():
+            yield hit.to_dict()
+
+    def migrate(self, batch_size=500):
+        """Re-encode documents logged in the legacy uncompressed format
+
+        Returns the number of documents migrated.
+        """
+        s = self.search_exchanges()
+        if s is None:
+            return 0
+
+        encoding = self._get_encoding()
+        s = s.filter(~Q('exists', field='encoding'))
+
+        def actions():
+            for hit in s.scan():
+                doc = hit.to_dict()
+                for field in ['request', 'response']:
+                    if doc.get(field):
+                        payload = self._blob_to_object(doc[field], encoding=blobs.LEGACY_ENCODING)
+                        doc[field] = self._object_to_blob(payload, encoding=encoding)
+                doc['encoding'] = encoding
+                yield {
+                    '_index': hit.meta.index,
+                    '_type': hit.meta.doc_type,
+                    '_id': hit.meta.id,
+                    '_source': doc,
+                }
+
+        migrated, errors = bulk(self._db, actions(), chunk_size=batch_size, raise_on_error=False)
+        if errors:
+            logger.warning('Error migrating {} documents: {}'.format(len(errors), errors[:1]))
+        return migrated
+
+    @classmethod
+    def _get_config(cls, key, default=None):
+        if has_app_context():
+            return current_app.config.get(key, default)
+        return default
+
+    def get_writer(self):
+        """Get the write-behind buffer for exchange logs in this process"""
+        return get_writer(self._db,
+                          buffer_size=self._get_config('STATS_BUFFER_SIZE', DEFAULT_BUFFER_SIZE),
+                          batch_size=self._get_config('STATS_BATCH_SIZE', DEFAULT_BATCH_SIZE),
+                          flush_interval=self._get_config('STATS_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL),
+                          block_timeout=self._get_config('STATS_BLOCK_TIMEOUT', 0))
 
     def save_request(self, request, recipient, response):
         """Store the provided request/response for quality assurance
 
+        Unless STATS_WRITE_BEHIND is disabled, the document is queued and
+        indexed in bulk in the background, off the response path. The exchange
+        is also added to the hourly statistics, unless ROLLUPS_ENABLED is off.
+
         request - a MMERequest object
         recipient - a server object for the queried server
         response - a MMEResponse object
         """
+        encoding = self._get_encoding()
         doc = {
             'sender_id': request.get_sender_id(),
             'receiver_id': recipient['server_id'],
             'query_patient_id': request.get_patient_id(),
             'is_test': request.is_test(),
             'response_patient_ids': response.get_patient_ids(),
-            'request': self._object_to_blob(request.get_raw()),
-            'response': self._object_to_blob(response.get_raw()),
+            'request_hash': request.get_hash(),
+            'response': self._object_to_blob(response.get_raw(), encoding=encoding, data=response.get_raw_data()),
+            'encoding': encoding,
             'created_at': request.get_timestamp(),
             'status': response.get_status(),
             'took': response.get_time(),
         }
+
+        # Store identical request bodies only once
+        payload_action = None
+        if self._get_config('STATS_DEDUPLICATE_REQUESTS', True):
+            content_hash = request.get_hash()
+            doc['payload_index'] = self.get_payload_index(doc['created_at'])
+            payload_key = '{}/{}'.format(doc['payload_index'], content_hash)
+            if self._stored_payloads.get(payload_key) is None:
+                blob = self._object_to_blob(request.get_raw(), encoding=encoding, data=request.get_raw_data())
+                payload_action = PayloadManager.get_action(content_hash, blob, encoding, index=doc['payload_index'])
+        else:
+            doc['request'] = self._object_to_blob(request.get_raw(), encoding=encoding, data=request.get_raw_data())
+
+        rollups_enabled = self._get_config('ROLLUPS_ENABLED', True)
+        if rollups_enabled:
+            doc['rolled_up'] = True
+
+        index = self.get_index(doc['created_at'])
+        self.ensure_template()
+        if not self._get_config('STATS_WRITE_BEHIND', True):
+            writer = None
+            try:
+                if payload_action:
+                    indexed, errors = index_actions(self._db, [payload_action])
+                    if errors:
+                        logger.warning('Error storing request payload: {}'.format(errors[0]))
+                    self._payload_stored(payload_key)(not get_failed_ids(errors))
+                self._db.index(index=index, doc_type=self.DOC_TYPE, body=doc)
+            except Exception as e:
+                logger.warning('Error logging request: {}'.format(e))
+        else:
+            writer = self.get_writer()
+            if payload_action:
+                writer.put_action(payload_action, callback=self._payload_stored(payload_key))
+            writer.put(index, self.DOC_TYPE, doc)
+
+        if rollups_enabled:
+            rollups = get_backend().get_manager('rollups')
+            rollups.record(doc, writer=writer,
+                           flush_interval=self._get_config('ROLLUP_FLUSH_INTERVAL', DEFAULT_ROLLUP_FLUSH_INTERVAL))
+
+
+    def rollover(self):
+        """Create the current and next partitions ahead of time, if they don't exist
+
+        Partitions are created automatically when first written to, so this is
+        optional, but avoids the delay of creating them on the request path.
+        Returns the names of the partitions created.
+        """
+        partitioning = self.get_partitioning()
+        if not partitioning:
+            return []
+
+        self.ensure_template()
+        current = partitions.get_partition_start(datetime.now(), partitioning)
+        created = []
+        for start in [current, partitions.get_next_partition_start(current, partitioning)]:
+            for prefix in [self.NAME, PayloadManager.NAME]:
+                index = partitions.get_partition_name(prefix, start, partitioning)
+                try:
+                    self._db.indices.create(index=index)
+                    created.append(index)
+                except RequestError:
+                    # Already exists
+                    pass
+        self._existing_indices.clear()
+        return created
+
+    def get_partitions(self, prefix):
+        """Get the names of the existing partitions with the prefix"""
         try:
-            self.save(doc)
-        except Exception as e:
-            logger.warning('Error logging request: {}'.format(e))
+            return sorted(self._db.indices.get_settings(index=partitions.get_pattern(prefix)))
+        except NotFoundError:
+            return []
+
+    def get_unmerged(self, indices):
+        """Get those of the indices with more than one segment in a shard"""
+        if not indices:
+            return []
+
+        segments = self._db.indices.segments(index=','.join(indices))['indices']
+        return [index for index in indices
+                if any(copy['num_search_segments'] > 1
+                       for copies in segments.get(index, {}).get('shards', {}).values() for copy in copies)]
+
+    def apply_retention(self, keep_days=None, forcemerge_days=None, drop_legacy=False, dry_run=False):
+        """Delete or compact old partitions
+
+        keep_days - delete partitions that ended more than this many days ago
+        forcemerge_days - merge partitions that ended more than this many days
+            ago into a single segment, which makes them smaller and faster
+            to search (they are not written to any more); partitions already
+            merged by an earlier run are skipped
+        drop_legacy - also delete the unpartitioned index, if its latest
+            exchange is older than keep_days
+
+        Request payloads are partitioned like the exchanges, so their
+        partitions are deleted along with them. Payloads logged before
+        partitioning are deleted once no remaining exchange refers to them.
+        Returns a list of (action, index) pairs.
+        """
+        now = datetime.now()
+        actions = []
+        exchange_indices = []
+        to_merge = []
+        for prefix in [self.NAME, PayloadManager.NAME]:
+            for index in self.get_partitions(prefix):
+                parsed = partitions.parse_partition_name(prefix, index)
+                if parsed is None:
+                    continue
+                end = partitions.get_next_partition_start(*parsed)
+                if keep_days is not None and end < now - timedelta(days=keep_days):
+                    actions.append(('delete', index))
+                else:
+                    if prefix == self.NAME:
+                        exchange_indices.append(index)
+                    if forcemerge_days is not None and end < now - timedelta(days=forcemerge_days):
+                        to_merge.append(index)
+        actions.extend(('forcemerge', index) for index in self.get_unmerged(to_merge))
+
+        legacy = self._db.indices.exists(index=self.NAME)
+        if legacy and drop_legacy and keep_days is not None:
+            s = Search(using=self._db, index=self.NAME).sort('-created_at')[:1]
+            hits = s.execute().hits
+            latest = hits[0].created_at if hits else None
+            if isinstance(latest, datetime):
+                latest = latest.isoformat()
+            # ISO 8601 timestamps sort in time order
+            if latest is None or latest < (now - timedelta(days=keep_days)).isoformat():
+                actions.append(('delete', self.NAME))
+                legacy = False
+        if legacy:
+            exchange_indices.append(self.NAME)
+
+        # New payloads are only stored in the unpartitioned index without partitioning
+        if self.get_partitioning() and self._db.indices.exists(index=PayloadManager.NAME):
+            referenced = False
+            if exchange_indices:
+                s = Search(using=self._db, index=exchange_indices).params(ignore_unavailable=True)
+                s = s.filter('exists', field='request_hash')
+                s = s.filter(~Q('exists', field='payload_index') | Q('term', payload_index=PayloadManager.NAME))
+                referenced = s[:0].execute().hits.total > 0
+            if not referenced:
+                actions.append(('delete', PayloadManager.NAME))
+
+        if not dry_run:
+            for action, index in actions:
+                if action == 'delete':
+                    self._db.indices.delete(index=index)
+                else:
+                    self._db.indices.forcemerge(index=index, max_num_segments=1)
+            self._existing_indices.clear()
+        return actions
 
 
 # Register manager
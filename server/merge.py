@@ -0,0 +1,56 @@
+"""
+Merging of match results from several servers into a single ranked list
+"""
+
+from __future__ import with_statement, division, unicode_literals
+
+import heapq
+
+
+def get_score(result):
+    """Get the patient score of a result, or 0 if it has none"""
+    score = result.get('score')
+    if isinstance(score, dict):
+        try:
+            return float(score.get('patient') or 0)
+        except (TypeError, ValueError):
+            pass
+    return 0.0
+
+
+def iter_unique_results(server_id, results):
+    """Yield the best-scoring result for each patient, annotated with the server id
+
+    Results are copied rather than modified. Results without a patient id
+    are all kept.
+    """
+    best = {}
+    unidentified = []
+    for result in results:
+        if not isinstance(result, dict):
+            continue
+        patient_id = (result.get('patient') or {}).get('id')
+        if patient_id is None:
+            unidentified.append(result)
+        elif patient_id not in best or get_score(result) > get_score(best[patient_id]):
+            best[patient_id] = result
+
+    for result in list(best.values()) + unidentified:
+        yield dict(result, _server=server_id)
+
+
+def merge_results(responses, limit=None):
+    """Merge results from several servers, best first
+
+    Duplicate results for the same patient from the same server are dropped,
+    keeping the one with the highest score. With a limit, only the top results
+    are kept, using a heap rather than sorting them all.
+
+    responses - a list of (server id, list of results) pairs
+    limit - the maximum number of results to return
+    """
+    results = (result for server_id, server_results in responses
+               for result in iter_unique_results(server_id, server_results))
+    if limit is not None:
+        return heapq.nlargest(limit, results, key=get_score)
+    return sorted(results, key=get_score, reverse=True)
@@ -0,0 +1,425 @@
+"""
+In-process metrics, exposed in the Prometheus text format
+
+Each worker process keeps its own metrics in memory. If a metrics directory is
+configured, every worker also writes a snapshot of its metrics there
+periodically, and the metrics from all workers (including ones that have
+exited) are merged when the metrics are exported, so that any worker can serve
+the totals. The snapshots of workers that have exited are folded into a single
+file by compact_snapshots, so they don't accumulate.
+"""
+
+from __future__ import with_statement, division, unicode_literals
+
+import errno
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# A monotonic high-resolution clock, where available
+clock = getattr(time, 'perf_counter', time.time)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30)
+
+# In a snapshot directory: the merged metrics of processes that have exited,
+# and the file locked while snapshots are read or compacted
+EXITED_FILENAME = 'exited.json'
+LOCK_FILENAME = 'snapshots.lock'
+
+
+class Metric:
+    """A metric with a separate series for each combination of label values
+
+    name - the metric name
+    description - a one-line description of the metric
+    labels - the names of the labels that distinguish each series
+    """
+    TYPE = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        # label values -> value
+        self._series = {}
+
+    def _key(self, labels):
+        return tuple('{}'.format(labels.get(label, '')) for label in self.labels)
+
+    def snapshot(self):
+        """Get a JSON-serializable copy of the metric"""
+        with self._lock:
+            series = [[list(key), self._copy(value)] for key, value in self._series.items()]
+        return {
+            'type': self.TYPE,
+            'help': self.description,
+            'labels': list(self.labels),
+            'series': series,
+        }
+
+    @classmethod
+    def _copy(cls, value):
+        return value
+
+
+class Counter(Metric):
+    """A value that only increases"""
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that can go up and down"""
+    TYPE = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = value
+
+    @contextmanager
+    def track(self, **labels):
+        """Increment the gauge for the duration of the block"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(Metric):
+    """Counts observed values in buckets, with their sum and count"""
+    TYPE = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, description, labels=labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][i] += 1
+                    break
+            series['sum'] += value
+            series['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the time, in seconds, spent in the block"""
+        start = clock()
+        try:
+            yield
+        finally:
+            self.observe(clock() - start, **labels)
+
+    def snapshot(self):
+        snapshot = Metric.snapshot(self)
+        snapshot['buckets'] = list(self.buckets)
+        return snapshot
+
+    @classmethod
+    def _copy(cls, value):
+        return {'buckets': list(value['buckets']), 'sum': value['sum'], 'count': value['count']}
+
+
+class Registry:
+    """A collection of named metrics"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._collectors = []
+
+    def _get_or_create(self, metric_class, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = metric_class(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name, description, labels=()):
+        return self._get_or_create(Counter, name, description, labels=labels)
+
+    def gauge(self, name, description, labels=()):
+        return self._get_or_create(Gauge, name, description, labels=labels)
+
+    def histogram(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, description, labels=labels, buckets=buckets)
+
+    def add_collector(self, collector):
+        """Add a function that is called to update metrics just before each snapshot"""
+        with self._lock:
+            self._collectors.append(collector)
+
+    def snapshot(self):
+        """Get a JSON-serializable copy of all metrics, by name"""
+        with self._lock:
+            collectors = list(self._collectors)
+        for collector in collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.warning('Error collecting metrics: {}'.format(e))
+
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return dict((metric.name, metric.snapshot()) for metric in metrics)
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def merge_snapshots(snapshots):
+    """Merge snapshots from several processes into one
+
+    snapshots - a list of (snapshot, is_alive) pairs. Gauges from processes
+        that are no longer alive are ignored.
+    """
+    merged = {}
+    for snapshot, alive in snapshots:
+        for name, metric in snapshot.items():
+            if metric['type'] == 'gauge' and not alive:
+                continue
+
+            target = merged.get(name)
+            if target is None:
+                target = merged[name] = dict(metric, series={})
+
+            for key, value in metric['series']:
+                key = tuple(key)
+                existing = target['series'].get(key)
+                if existing is None:
+                    target['series'][key] = Histogram._copy(value) if metric['type'] == 'histogram' else value
+                elif metric['type'] == 'histogram':
+                    existing['buckets'] = [a + b for a, b in zip(existing['buckets'], value['buckets'])]
+                    existing['sum'] += value['sum']
+                    existing['count'] += value['count']
+                else:
+                    target['series'][key] = existing + value
+
+    for metric in merged.values():
+        metric['series'] = [[list(key), value] for key, value in metric['series'].items()]
+    return merged
+
+
+def write_snapshot(directory, source=None):
+    """Write this process's metrics to the directory"""
+    source = source or registry
+    pid = os.getpid()
+    path = os.path.join(directory, '{}.json'.format(pid))
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'w') as ofp:
+        json.dump(source.snapshot(), ofp)
+    os.rename(tmp_path, path)
+
+
+@contextmanager
+def _locked(directory, exclusive=False):
+    with open(os.path.join(directory, LOCK_FILENAME), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _get_pid(filename):
+    """Get the pid of the process that wrote the snapshot file, or None if it is the exited processes' file"""
+    if filename == EXITED_FILENAME:
+        return None
+    return int(filename.split('.')[0])
+
+
+def read_snapshots(directory, source=None):
+    """Get the merged metrics of all processes that wrote to the directory"""
+    source = source or registry
+    pid = os.getpid()
+    snapshots = [(source.snapshot(), True)]
+    with _locked(directory):
+        for filename in os.listdir(directory):
+            if not filename.endswith('.json'):
+                continue
+            other_pid = _get_pid(filename)
+            if other_pid == pid:
+                continue
+            try:
+                with open(os.path.join(directory, filename)) as ifp:
+                    snapshots.append((json.load(ifp), other_pid is not None and _is_alive(other_pid)))
+            except (IOError, ValueError) as e:
+                logger.warning('Error reading metrics from {}: {}'.format(filename, e))
+    return merge_snapshots(snapshots)
+
+
+def compact_snapshots(directory):
+    """Fold the snapshots of processes that have exited into a single file
+
+    Returns the number of snapshot files removed.
+    """
+    if not os.path.isdir(directory):
+        return 0
+
+    with _locked(directory, exclusive=True):
+        snapshots = []
+        exited_paths = []
+        for filename in os.listdir(directory):
+            if not filename.endswith('.json'):
+                continue
+            path = os.path.join(directory, filename)
+            other_pid = _get_pid(filename)
+            if other_pid is not None:
+                if _is_alive(other_pid):
+                    continue
+                exited_paths.append(path)
+            try:
+                with open(path) as ifp:
+                    snapshots.append((json.load(ifp), False))
+            except (IOError, ValueError) as e:
+                logger.warning('Error reading metrics from {}: {}'.format(filename, e))
+
+        if not exited_paths:
+            return 0
+
+        path = os.path.join(directory, EXITED_FILENAME)
+        tmp_path = '{}.tmp'.format(path)
+        with open(tmp_path, 'w') as ofp:
+            json.dump(merge_snapshots(snapshots), ofp)
+        os.rename(tmp_path, path)
+        for exited_path in exited_paths:
+            os.remove(exited_path)
+    return len(exited_paths)
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{{{}}}'.format(','.join('{}="{}"'.format(name, _escape(value)) for name, value in pairs))
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def export_text(snapshot):
+    """Format the metrics snapshot in the Prometheus text exposition format"""
+    lines = []
+    for name in sorted(snapshot):
+        metric = snapshot[name]
+        labels = metric['labels']
+        lines.append('# HELP {} {}'.format(name, metric['help']))
+        lines.append('# TYPE {} {}'.format(name, metric['type']))
+        for key, value in sorted(metric['series']):
+            if metric['type'] == 'histogram':
+                cumulative = 0
+                for bound, count in zip(metric['buckets'], value['buckets']):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(
+                        name, _format_labels(labels, key, [('le', _format_value(float(bound)))]), cumulative))
+                lines.append('{}_bucket{} {}'.format(
+                    name, _format_labels(labels, key, [('le', '+Inf')]), value['count']))
+                lines.append('{}_sum{} {}'.format(name, _format_labels(labels, key), _format_value(value['sum'])))
+                lines.append('{}_count{} {}'.format(name, _format_labels(labels, key), value['count']))
+            else:
+                lines.append('{}{} {}'.format(name, _format_labels(labels, key), _format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+class SnapshotWriter:
+    """Periodically writes this process's metrics to a directory"""
+    def __init__(self, directory, interval=5, source=None):
+        self.directory = directory
+        self.interval = interval
+        self.source = source or registry
+        self._thread = threading.Thread(target=self._run, name='metrics-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self):
+        try:
+            write_snapshot(self.directory, source=self.source)
+        except (IOError, OSError) as e:
+            logger.warning('Error writing metrics: {}'.format(e))
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.write()
+
+
+_snapshot_writer = None
+_snapshot_writer_pid = None
+_snapshot_writer_lock = threading.Lock()
+
+
+def get_snapshot_writer(directory, interval=5):
+    """Get the metrics snapshot writer for this process, starting it on first use"""
+    global _snapshot_writer, _snapshot_writer_pid
+    pid = os.getpid()
+    with _snapshot_writer_lock:
+        if _snapshot_writer is None or _snapshot_writer_pid != pid:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            _snapshot_writer = SnapshotWriter(directory, interval=interval)
+            _snapshot_writer_pid = pid
+        return _snapshot_writer
+
+
+def close_snapshot_writer():
+    """Write a final snapshot for this process, if snapshots are being written"""
+    with _snapshot_writer_lock:
+        if _snapshot_writer is not None and _snapshot_writer_pid == os.getpid():
+            _snapshot_writer.write()
+
+
+registry = Registry()
+
+stage_seconds = registry.histogram('mme_stage_seconds', 'Time spent in each stage of handling a request',
+                                   labels=('stage',))
+upstream_seconds = registry.histogram('mme_upstream_seconds', 'Latency of requests to outgoing servers',
+                                      labels=('receiver',))
+upstream_requests = registry.counter('mme_upstream_requests_total', 'Requests to outgoing servers, by response status',
+                                     labels=('receiver', 'status'))
+upstream_coalesced = registry.counter('mme_upstream_coalesced_total',
+                                      'Requests that shared the response to an identical request in flight',
+                                      labels=('receiver',))
+upstream_in_flight = registry.gauge('mme_upstream_in_flight', 'Requests to outgoing servers awaiting a response',
+                                    labels=('receiver',))
+http_requests = registry.counter('mme_http_requests_total', 'Requests handled, by endpoint and response status',
+                                 labels=('endpoint', 'status'))
+http_in_flight = registry.gauge('mme_http_in_flight', 'Requests being handled, by endpoint',
+                                labels=('endpoint',))
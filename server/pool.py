@@ -0,0 +1,252 @@
+"""
+A keep-alive HTTP connection pool for outgoing requests
+"""
+
+from __future__ import with_statement, division, unicode_literals
+
+import logging
+import os
+import socket
+import threading
+import time
+
+from collections import defaultdict
+from functools import partial
+
+from .compat import HTTPConnection, HTTPSConnection, HTTPException, urlsplit
+from .metrics import clock
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_IDLE_TIMEOUT = 60
+DEFAULT_CONNECT_TIMEOUT = 5
+
+
+def _create_connection(address, timeout=None, source_address=None, timings=None):
+    """Open a TCP connection like socket.create_connection, timing the DNS lookup and connection
+
+    The (start, end) clock times are added to timings as 'dns' and 'tcp'.
+    """
+    host, port = address
+    start = clock()
+    addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    resolved = clock()
+    timings['dns'] = (start, resolved)
+
+    error = socket.error('getaddrinfo returned no addresses')
+    for family, socktype, proto, canonname, sockaddr in addresses:
+        sock = None
+        try:
+            sock = socket.socket(family, socktype, proto)
+            if isinstance(timeout, (int, float)):
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+            timings['tcp'] = (resolved, clock())
+            return sock
+        except socket.error as e:
+            error = e
+            if sock is not None:
+                sock.close()
+    raise error
+
+
+class PooledResponse:
+    """A file-like HTTP response that returns its connection to the pool once read
+
+    timings - the (start, end) clock times of the phases of the request: 'dns',
+        'tcp' and 'tls' (if a new connection was opened), and 'ttfb' (from
+        sending the request to receiving the response headers)
+    """
+    def __init__(self, pool, key, connection, response, timings=None):
+        self._pool = pool
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self.timings = timings or {}
+
+    def getcode(self):
+        return self._response.status
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def read(self, amt=None):
+        data = self._response.read(amt)
+        if amt is None or not data:
+            self.release()
+        return data
+
+    def release(self):
+        """Return the connection to the pool, or close it if it can't be reused"""
+        if self._connection is None:
+            return
+
+        connection = self._connection
+        self._connection = None
+        if self._response.isclosed() and not self._response.will_close:
+            self._pool._put(self._key, connection)
+        else:
+            connection.close()
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ConnectionPool:
+    """A thread-safe pool of persistent HTTP(S) connections, keyed by host
+
+    maxsize - the maximum number of idle connections to keep per host
+    idle_timeout - close connections that have been idle for this many seconds
+    connect_timeout - give up connecting after this many seconds
+    """
+    def __init__(self, maxsize=DEFAULT_POOL_SIZE, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self._lock = threading.Lock()
+        # key -> list of (connection, last used time)
+        self._idle = defaultdict(list)
+
+    @classmethod
+    def _get_key(cls, url):
+        parts = urlsplit(url)
+        return (parts.scheme, parts.netloc)
+
+    def _new_connection(self, key, timeout, timings=None):
+        scheme, netloc = key
+        connection_class = HTTPSConnection if scheme == 'https' else HTTPConnection
+        connect_timeout = self.connect_timeout
+        if timeout is not None:
+            connect_timeout = min(connect_timeout, timeout)
+
+        logger.debug('Opening new connection to {}'.format(netloc))
+        connection = connection_class(netloc, timeout=connect_timeout)
+        if timings is not None and hasattr(connection, '_create_connection'):
+            connection._create_connection = partial(_create_connection, timings=timings)
+        connection.connect()
+        if timings and 'tcp' in timings and scheme == 'https':
+            timings['tls'] = (timings['tcp'][1], clock())
+        return connection
+
+    def _get(self, key):
+        """Get an idle connection for the key, or None if there are none"""
+        now = time.time()
+        with self._lock:
+            idle = self._idle[key]
+            while idle:
+                connection, last_used = idle.pop()
+                if now - last_used < self.idle_timeout:
+                    return connection
+                connection.close()
+
+    def _put(self, key, connection):
+        with self._lock:
+            idle = self._idle[key]
+            if len(idle) < self.maxsize:
+                idle.append((connection, time.time()))
+                return
+
+        connection.close()
+
+    def evict_idle(self):
+        """Close all connections that have been idle for too long"""
+        now = time.time()
+        with self._lock:
+            for key, idle in self._idle.items():
+                expired = [c for c, last_used in idle if now - last_used >= self.idle_timeout]
+                idle[:] = [(c, last_used) for c, last_used in idle if now - last_used < self.idle_timeout]
+                for connection in expired:
+                    connection.close()
+
+    def clear(self):
+        """Close all idle connections"""
+        with self._lock:
+            for idle in self._idle.values():
+                for connection, last_used in idle:
+                    connection.close()
+            self._idle.clear()
+
+    def urlopen(self, method, url, body=None, headers=None, timeout=None):
+        """Issue a request, returning a PooledResponse
+
+        timeout - the read timeout, in seconds, for the response
+        """
+        key = self._get_key(url)
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path = '{}?{}'.format(path, parts.query)
+
+        headers = dict(headers or {})
+        headers.setdefault('Connection', 'keep-alive')
+
+        self.evict_idle()
+        timings = {}
+        connection = self._get(key)
+        reused = connection is not None
+        if connection is None:
+            connection = self._new_connection(key, timeout, timings=timings)
+
+        try:
+            return self._request(key, connection, method, path, body, headers, timeout, timings)
+        except socket.timeout:
+            connection.close()
+            raise
+        except (HTTPException, socket.error) as e:
+            connection.close()
+            if not reused:
+                raise
+
+            # The server may have closed an idle connection, so retry once
+            logger.debug('Retrying request on a new connection: {}'.format(e))
+            timings = {}
+            connection = self._new_connection(key, timeout, timings=timings)
+            try:
+                return self._request(key, connection, method, path, body, headers, timeout, timings)
+            except Exception:
+                connection.close()
+                raise
+
+    def _request(self, key, connection, method, path, body, headers, timeout, timings):
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+        start = clock()
+        connection.request(method, path, body=body, headers=headers)
+        # The connection may have been re-opened with the connect timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+        response = connection.getresponse()
+        timings['ttfb'] = (start, clock())
+        return PooledResponse(self, key, connection, response, timings=timings)
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(**kwargs):
+    """Get the connection pool for the current process
+
+    The pool is created on first use with the given keyword arguments, and is
+    re-created after a fork so that worker processes never share sockets.
+    """
+    global _pool, _pool_pid
+    pid = os.getpid()
+    with _pool_lock:
+        if _pool is None or _pool_pid != pid:
+            _pool = ConnectionPool(**kwargs)
+            _pool_pid = pid
+        return _pool
@@ -0,0 +1,215 @@
+"""
+Rate limiting per client and per server, and fair queuing of outgoing requests
+
+Token buckets can be kept in a SQLite file, so that all worker processes on a
+host share the same limits.
+"""
+
+from __future__ import with_statement, division, unicode_literals
+
+import heapq
+import itertools
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def refill(tokens, updated, now, rate, burst, cost=1):
+    """Apply a request to a token bucket
+
+    Returns (tokens, retry_after): the tokens left, and 0 if the request is
+    allowed, or else the number of seconds until it would be.
+    """
+    if tokens is None:
+        tokens = burst
+    else:
+        tokens = min(burst, tokens + max(now - updated, 0) * rate)
+
+    if tokens >= cost:
+        return tokens - cost, 0
+    return tokens, (cost - tokens) / rate
+
+
+class MemoryBucketStore:
+    """Token buckets for a single process"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key -> (tokens, updated)
+        self._buckets = {}
+
+    def take(self, key, rate, burst, cost=1):
+        """Take tokens from the bucket, returning 0, or the seconds to wait if there are too few"""
+        now = time.time()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (None, now))
+            tokens, retry_after = refill(tokens, updated, now, rate, burst, cost=cost)
+            self._buckets[key] = (tokens, now)
+        return retry_after
+
+
+class SQLiteBucketStore:
+    """Token buckets in a SQLite file, shared by all processes that use the same path
+
+    timeout - how long to wait for another process to release the database;
+        after that (or on any database error), requests are allowed
+    """
+    def __init__(self, path, timeout=1):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS buckets '
+                               '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def take(self, key, rate, burst, cost=1):
+        """Take tokens from the bucket, returning 0, or the seconds to wait if there are too few"""
+        try:
+            connection = self._connect()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                now = time.time()
+                row = connection.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+                tokens, updated = row if row else (None, now)
+                tokens, retry_after = refill(tokens, updated, now, rate, burst, cost=cost)
+                connection.execute('INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)',
+                                   (key, tokens, now))
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+        except sqlite3.Error as e:
+            logger.warning('Error checking rate limit, allowing request: {}'.format(e))
+            return 0
+        return retry_after
+
+
+class RateLimiter:
+    """Limits the rate of requests by key, with a token bucket per key
+
+    limits - a dict of key -> (requests per second, burst)
+    default - the (requests per second, burst) for other keys, or None for no limit
+    prefix - prepended to keys in the store, to separate limiters sharing it
+    """
+    def __init__(self, store, limits=None, default=None, prefix=''):
+        self.store = store
+        self.limits = limits or {}
+        self.default = default
+        self.prefix = prefix
+
+    def check(self, key, cost=1):
+        """Count a request, returning 0 if it is allowed, or else the seconds until it would be"""
+        limit = self.limits.get(key, self.default)
+        if not limit:
+            return 0
+        rate, burst = limit
+        return self.store.take('{}{}'.format(self.prefix, key), rate, burst, cost=cost)
+
+
+class FairScheduler:
+    """Limits concurrent calls, admitting waiting calls in weighted fair order
+
+    When all slots are busy, calls wait in a queue, and each freed slot goes
+    to the waiting call with the earliest virtual finish time. A sender with
+    twice the weight of another gets twice as many slots while both are
+    waiting, however many calls each has queued.
+
+    max_concurrency - the number of calls allowed at once
+    weights - a dict of sender -> weight (default 1)
+    """
+    def __init__(self, max_concurrency, weights=None):
+        self.max_concurrency = max_concurrency
+        self.weights = weights or {}
+        self.active = 0
+        self._lock = threading.Lock()
+        self._sequence = itertools.count()
+        # Heap of [finish time, sequence, sender, event, cancelled]
+        self._waiting = []
+        self._virtual_time = 0.0
+        self._last_finish = {}
+
+    def acquire(self, sender, timeout=None):
+        """Wait for a slot, returning False if none was free within timeout seconds"""
+        with self._lock:
+            if self.active < self.max_concurrency and not self._waiting:
+                self.active += 1
+                return True
+
+            weight = self.weights.get(sender, 1)
+            finish = max(self._virtual_time, self._last_finish.get(sender, 0)) + 1 / weight
+            self._last_finish[sender] = finish
+            waiter = [finish, next(self._sequence), sender, threading.Event(), False]
+            heapq.heappush(self._waiting, waiter)
+
+        if waiter[3].wait(timeout):
+            return True
+
+        with self._lock:
+            if waiter[3].is_set():
+                # Granted just as we timed out
+                return True
+            waiter[4] = True
+            return False
+
+    def release(self):
+        """Free a slot, handing it to the next waiting call, if any"""
+        with self._lock:
+            while self._waiting:
+                waiter = heapq.heappop(self._waiting)
+                if waiter[4]:
+                    continue
+                self._virtual_time = waiter[0]
+                waiter[3].set()
+                return
+            self.active -= 1
+
+    def depth(self):
+        """Get the number of waiting calls, by sender (including senders with none)"""
+        with self._lock:
+            depth = dict.fromkeys(self._last_finish, 0)
+            for waiter in self._waiting:
+                if not waiter[4]:
+                    depth[waiter[2]] = depth.get(waiter[2], 0) + 1
+        return depth
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(path=None):
+    """Get the bucket store for the SQLite file at path, or for this process if None"""
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = SQLiteBucketStore(path) if path else MemoryBucketStore()
+        return _stores[path]
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler(max_concurrency, weights=None):
+    """Get the scheduler of outgoing requests for this process, creating it on first use"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = FairScheduler(max_concurrency, weights=weights)
+        return _scheduler
+
+
+def get_current_scheduler():
+    """Get the scheduler of outgoing requests for this process, or None if it was not used yet"""
+    with _scheduler_lock:
+        return _scheduler
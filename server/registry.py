@@ -0,0 +1,137 @@
+"""
+A process-local cache of the server registry
+
+Server records change rarely, so they are loaded all at once and kept in
+memory, keyed by direction and server id. A background thread reloads them
+periodically, and every process reloads them immediately after the stamp file
+is touched (see `invalidate`), so lookups on the request path never need to
+query the database.
+"""
+
+from __future__ import with_statement, division, unicode_literals
+
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 300
+DEFAULT_STAMP_FILE = os.path.join(tempfile.gettempdir(), 'mme-exchange-servers.stamp')
+
+
+def invalidate(stamp_file=DEFAULT_STAMP_FILE):
+    """Signal all processes using the stamp file to reload their registry"""
+    with open(stamp_file, 'a'):
+        os.utime(stamp_file, None)
+
+
+def _get_stamp(stamp_file):
+    try:
+        return os.stat(stamp_file).st_mtime
+    except OSError:
+        return None
+
+
+class ServerRegistry:
+    """A cache of server records
+
+    loader - a function returning a list of all server records (as dicts)
+    ttl - reload the records after this many seconds
+    stamp_file - reload the records whenever this file is modified
+    """
+    def __init__(self, loader, ttl=DEFAULT_TTL, stamp_file=DEFAULT_STAMP_FILE):
+        self.loader = loader
+        self.ttl = ttl
+        self.stamp_file = stamp_file
+        self._lock = threading.Lock()
+        # direction -> server_id -> server record
+        self._servers = None
+        self._loaded_at = None
+        self._stamp = None
+        self._refresher = None
+
+    def refresh(self):
+        """Reload all server records"""
+        stamp = _get_stamp(self.stamp_file)
+        logger.info('Loading server registry')
+        servers = defaultdict(dict)
+        for server in self.loader():
+            servers[server.get('direction')][server['server_id']] = server
+
+        with self._lock:
+            self._servers = servers
+            self._loaded_at = time.time()
+            self._stamp = stamp
+
+        return servers
+
+    def invalidate(self):
+        """Drop the cached records, so they are reloaded on next use"""
+        with self._lock:
+            self._servers = None
+
+    def is_stale(self):
+        with self._lock:
+            if self._servers is None:
+                return True
+            if _get_stamp(self.stamp_file) != self._stamp:
+                return True
+            # Only expire here if the background refresh has fallen behind
+            return time.time() - self._loaded_at > 2 * self.ttl
+
+    def _get_servers(self, direction):
+        servers = self._servers
+        if servers is None or self.is_stale():
+            servers = self.refresh()
+        return servers.get(direction, {})
+
+    def get(self, server_id, direction='out'):
+        """Get the record for the server, or None if not found"""
+        return self._get_servers(direction).get(server_id)
+
+    def list(self, direction='out'):
+        """Get the records for all servers in the given direction"""
+        return list(self._get_servers(direction).values())
+
+    def start(self):
+        """Start refreshing the records in a background thread"""
+        if self._refresher is not None and self._refresher.is_alive():
+            return
+
+        self._refresher = threading.Thread(target=self._run, name='server-registry')
+        self._refresher.daemon = True
+        self._refresher.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.ttl)
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.warning('Error refreshing server registry: {}'.format(e))
+
+
+_registry = None
+_registry_pid = None
+_registry_lock = threading.Lock()
+
+
+def get_registry(loader, **kwargs):
+    """Get the server registry for the current process
+
+    The registry is created (and its background refresh started) on first use,
+    and again after a fork, since threads do not survive forking.
+    """
+    global _registry, _registry_pid
+    pid = os.getpid()
+    with _registry_lock:
+        if _registry is None or _registry_pid != pid:
+            _registry = ServerRegistry(loader, **kwargs)
+            _registry.start()
+            _registry_pid = pid
+        return _registry
@@ -0,0 +1,188 @@
+"""
+Replay of logged exchanges through the exchange server
+
+Exchanges are read, in order, from the exchange log or from a JSON lines
+export of it, and sent to a gateway with their original inter-arrival times,
+optionally sped up. Records are streamed throughout, so memory use does not
+grow with the number of exchanges.
+"""
+
+from __future__ import with_statement, division, unicode_literals
+
+import json
+import logging
+import threading
+import time
+
+from datetime import datetime
+
+from .bench import summarize
+from .metrics import clock
+from .pool import ConnectionPool
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+logger = logging.getLogger(__name__)
+
+API_MIME_TYPE = 'application/vnd.ga4gh.matchmaker.v1.0+json'
+EXPORT_FIELDS = ['created_at', 'sender_id', 'receiver_id', 'is_test', 'status', 'took',
+                 'query_patient_id', 'response_patient_ids']
+
+
+def parse_timestamp(value):
+    """Parse a logged created_at timestamp (ISO 8601, without timezone)"""
+    if isinstance(value, datetime):
+        return value
+    for time_format in ['%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S']:
+        try:
+            return datetime.strptime(value, time_format)
+        except ValueError:
+            pass
+    raise ValueError('Invalid timestamp: {}'.format(value))
+
+
+def iter_logged(stats, include_requests=True, include_responses=False, ordered=True, limit=None, **filters):
+    """Iterate over exchange records from the exchange log, in order
+
+    Payloads are only fetched and decoded if they are included.
+
+    stats - the stats manager
+    limit - the maximum number of records
+    filters - keyword arguments for StatsManager.scan_exchanges
+    """
+    docs = stats.scan_exchanges(ordered=ordered, include_payloads=include_requests or include_responses,
+                                **filters)
+    for i, doc in enumerate(docs):
+        if limit is not None and i >= limit:
+            break
+        record = dict((field, doc.get(field)) for field in EXPORT_FIELDS)
+        if include_requests:
+            record['request'] = stats.get_request(doc)
+        if include_responses:
+            record['response'] = stats.get_response(doc)
+        yield record
+
+
+def iter_jsonl(fileobj):
+    """Iterate over exchange records from a JSON lines export"""
+    for line in fileobj:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def export(records, fileobj):
+    """Write the records to the file as JSON lines, returning the number written"""
+    count = 0
+    for record in records:
+        fileobj.write(json.dumps(record, sort_keys=True, separators=(',', ':')))
+        fileobj.write('\n')
+        count += 1
+    return count
+
+
+def schedule(records, speed=1.0):
+    """Yield the records at their original relative times, divided by speed
+
+    With a speed of 0, records are yielded as fast as they are consumed. Each
+    record is yielded with how late it is, in seconds.
+    """
+    first = None
+    start = clock()
+    for record in records:
+        if not speed:
+            yield record, 0.0
+            continue
+
+        created_at = parse_timestamp(record['created_at'])
+        if first is None:
+            first = created_at
+        due = start + (created_at - first).total_seconds() / speed
+        delay = due - clock()
+        if delay > 0:
+            time.sleep(delay)
+        yield record, max(-delay, 0.0)
+
+
+def replay(records, base_url, auth_token, speed=1.0, concurrency=10, receiver_id=None, timeout=20,
+           mark_test=True, use_cache=True):
+    """Send the records' requests to the gateway at base_url, on their original schedule
+
+    All requests are sent as the client with the given auth token.
+
+    receiver_id - send every request to this server, instead of the original receiver
+    mark_test - flag every request as a test request, so that receivers don't
+        treat replayed patients as new queries
+    concurrency - the maximum number of requests in flight; when all are busy,
+        requests are sent late, and the lag is reported
+
+    Returns a summary of the throughput, latencies, response statuses and lag.
+    """
+    pool = ConnectionPool(maxsize=concurrency)
+    queue = Queue(maxsize=concurrency)
+    lock = threading.Lock()
+    latencies = []
+    statuses = {}
+    lags = []
+    headers = {
+        'X-Auth-Token': auth_token,
+        'Content-Type': API_MIME_TYPE,
+        'Accept': API_MIME_TYPE,
+    }
+    query = '?timeout={}{}'.format(timeout, '' if use_cache else '&cache=false')
+
+    def worker():
+        while True:
+            record = queue.get()
+            if record is None:
+                return
+
+            request = record['request']
+            if mark_test and isinstance(request.get('patient'), dict):
+                request['patient']['test'] = True
+            url = '{}/v1/servers/{}/match{}'.format(base_url, receiver_id or record['receiver_id'], query)
+            body = json.dumps(request).encode('utf-8')
+
+            start = clock()
+            try:
+                with pool.urlopen('POST', url, body=body, headers=headers, timeout=timeout + 5) as response:
+                    response.read()
+                    status = '{}'.format(response.getcode())
+            except Exception as e:
+                logger.debug('Request failed: {}'.format(e))
+                status = 'error'
+            elapsed = clock() - start
+
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    threads = [threading.Thread(target=worker, name='replay-{}'.format(i)) for i in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    start = clock()
+    skipped = 0
+    for record, lag in schedule(records, speed=speed):
+        if not record.get('request'):
+            skipped += 1
+            continue
+        lags.append(lag)
+        queue.put(record)
+
+    for thread in threads:
+        queue.put(None)
+    for thread in threads:
+        thread.join()
+    elapsed = clock() - start
+    pool.clear()
+
+    summary = summarize(latencies, statuses, elapsed)
+    summary['skipped'] = skipped
+    summary['meanLag'] = sum(lags) / len(lags) if lags else None
+    summary['maxLag'] = max(lags) if lags else None
+    return summary
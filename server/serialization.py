@@ -0,0 +1,103 @@
+"""
+JSON serialization, with the fastest available library
+
+orjson or ujson are used if installed, and the standard library otherwise.
+Only the library that is used is imported.
+All backends produce compact UTF-8 encoded JSON, so their output is
+interchangeable, but not byte-for-byte identical; hashes of content
+(see cache.canonical_hash) always use the standard library, so that they stay
+stable whichever backend is installed.
+"""
+
+from __future__ import with_statement, division, unicode_literals
+
+import json
+
+from .compat import LazyModule
+
+orjson = LazyModule('orjson')
+ujson = LazyModule('ujson')
+
+BACKENDS = ['orjson', 'ujson', 'json']
+
+
+def _json_dumps(obj):
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def _json_loads(data):
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return json.loads(data)
+
+
+def _ujson_dumps(obj):
+    return ujson.get().dumps(obj, ensure_ascii=False, escape_forward_slashes=False).encode('utf-8')
+
+
+def _get_functions(name):
+    if name == 'orjson' and orjson.get() is not None:
+        return orjson.get().dumps, orjson.get().loads
+    elif name == 'ujson' and ujson.get() is not None:
+        return _ujson_dumps, ujson.get().loads
+    elif name == 'json':
+        return _json_dumps, _json_loads
+
+
+def get_available_backends():
+    """Get the names of the installed backends, fastest first"""
+    return [name for name in BACKENDS if _get_functions(name)]
+
+
+class Serializer:
+    """Encodes and decodes JSON with one of the backends
+
+    backend - 'orjson', 'ujson', 'json', or 'auto' for the fastest installed
+    """
+    def __init__(self, backend='auto'):
+        if backend == 'auto':
+            # Stop at the first installed, rather than importing them all
+            backend = next(name for name in BACKENDS if _get_functions(name))
+        functions = _get_functions(backend)
+        if functions is None:
+            raise ValueError('JSON backend not available: {}'.format(backend))
+
+        self.backend = backend
+        self._dumps, self._loads = functions
+
+    @property
+    def is_fast(self):
+        """Whether the backend is faster than the standard library"""
+        return self.backend != 'json'
+
+    def dumps(self, obj):
+        """Serialize the object as compact JSON, returning UTF-8 encoded bytes"""
+        return self._dumps(obj)
+
+    def loads(self, data):
+        """Parse JSON from bytes (UTF-8) or text"""
+        return self._loads(data)
+
+
+_serializer = Serializer()
+
+
+def configure(backend='auto'):
+    """Set the backend used by dumps and loads"""
+    global _serializer
+    _serializer = Serializer(backend)
+    return _serializer
+
+
+def get_serializer():
+    return _serializer
+
+
+def dumps(obj):
+    """Serialize the object as compact JSON, returning UTF-8 encoded bytes"""
+    return _serializer.dumps(obj)
+
+
+def loads(data):
+    """Parse JSON from bytes (UTF-8) or text"""
+    return _serializer.loads(data)
@@ -0,0 +1,112 @@
+"""
+Shaping of outgoing requests to each server's capability profile
+
+A profile says which of the optional fields of a match request a server
+uses, and whether it accepts gzip-compressed requests; the other optional
+fields are left out of the requests sent to it, to save bandwidth. Required
+fields, and fields whose absence would change the meaning of a request
+(like a feature's `observed`, or `test`), are always sent.
+"""
+
+from __future__ import with_statement, division, unicode_literals
+
+import gzip
+import io
+import zlib
+
+from .streaming import ResponseTooLarge
+
+# The optional fields of a match request (API v1.0) that can be left out
+OPTIONAL_FIELDS = [
+    'patient.label',
+    'patient.species',
+    'patient.sex',
+    'patient.ageOfOnset',
+    'patient.inheritanceMode',
+    'patient.disorders',
+    'patient.contact.institution',
+    'patient.features.label',
+    'patient.features.ageOfOnset',
+    'patient.genomicFeatures.gene.label',
+    'patient.genomicFeatures.variant',
+    'patient.genomicFeatures.zygosity',
+    'patient.genomicFeatures.type',
+]
+
+PROFILE_KEYS = ['fields', 'gzip_requests', 'gzip_responses']
+
+DEFAULT_GZIP_MIN_SIZE = 1024
+
+
+def validate_profile(profile):
+    """Raise ValueError if the profile is not valid"""
+    unknown = set(profile) - set(PROFILE_KEYS)
+    if unknown:
+        raise ValueError('Unknown profile settings: {}'.format(', '.join(sorted(unknown))))
+
+    fields = profile.get('fields')
+    if fields is not None:
+        unknown = set(fields) - set(OPTIONAL_FIELDS)
+        if unknown:
+            raise ValueError('Not optional fields: {}'.format(', '.join(sorted(unknown))))
+
+
+def get_stripped_fields(profile):
+    """Get the optional fields to leave out of requests to a server with the profile, in a stable order"""
+    fields = (profile or {}).get('fields')
+    if fields is None:
+        return ()
+    return tuple(field for field in OPTIONAL_FIELDS if field not in fields)
+
+
+def _strip(obj, path):
+    if isinstance(obj, list):
+        return [_strip(item, path) for item in obj]
+    if not isinstance(obj, dict):
+        return obj
+
+    name = path[0]
+    if name not in obj:
+        return obj
+
+    obj = dict(obj)
+    if len(path) == 1:
+        del obj[name]
+    else:
+        obj[name] = _strip(obj[name], path[1:])
+    return obj
+
+
+def strip_fields(obj, fields):
+    """Get a copy of the object without the given fields
+
+    Fields are dotted paths, which apply to each item of lists along the way.
+    Only the dicts and lists containing stripped fields are copied; the rest
+    are shared with the original object.
+    """
+    for field in fields:
+        obj = _strip(obj, field.split('.'))
+    return obj
+
+
+def gzip_data(data, level=6):
+    """Compress the data in the gzip format"""
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=level, mtime=0) as ofp:
+        ofp.write(data)
+    return buffer.getvalue()
+
+
+def gunzip_data(data, max_size=None):
+    """Decompress gzip data, raising ResponseTooLarge if it expands beyond max_size bytes"""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if not max_size:
+        return decompressor.decompress(data) + decompressor.flush()
+
+    decompressed = decompressor.decompress(data, max_size + 1)
+    if decompressor.unconsumed_tail:
+        raise ResponseTooLarge(max_size)
+    decompressed += decompressor.flush()
+    if len(decompressed) > max_size:
+        raise ResponseTooLarge(max_size)
+    return decompressed
@@ -0,0 +1,75 @@
+"""
+Mergeable latency sketches, for quantiles of pre-aggregated statistics
+"""
+
+from __future__ import with_statement, division, unicode_literals
+
+import math
+
+# Quantiles are accurate to within this relative error
+RELATIVE_ACCURACY = 0.02
+# Values at or below this many seconds share the lowest bucket
+MIN_VALUE = 0.001
+
+_GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+_LOG_GAMMA = math.log(_GAMMA)
+
+
+def bucket_index(value):
+    """Get the index of the logarithmic bucket that holds the value"""
+    if value <= MIN_VALUE:
+        return 0
+    return int(math.ceil(math.log(value / MIN_VALUE) / _LOG_GAMMA))
+
+
+def bucket_value(index):
+    """Get the representative value of the bucket with the given index"""
+    if index <= 0:
+        return MIN_VALUE
+    return MIN_VALUE * 2 * _GAMMA ** index / (_GAMMA + 1)
+
+
+class LatencySketch:
+    """Counts values in logarithmic buckets of fixed relative width
+
+    Since the bucket boundaries are the same for every sketch, sketches from
+    different processes and time periods can be merged by adding their counts,
+    and the merged sketch is as accurate as one built from all of the values.
+
+    counts - bucket counts, by bucket index (as returned by to_dict)
+    """
+    def __init__(self, counts=None):
+        self.counts = {}
+        self.count = 0
+        if counts:
+            self.merge(counts)
+
+    def add(self, value, count=1):
+        index = bucket_index(value)
+        self.counts[index] = self.counts.get(index, 0) + count
+        self.count += count
+
+    def merge(self, other):
+        """Add the counts of another sketch, or of its to_dict() form"""
+        counts = other.counts if isinstance(other, LatencySketch) else other
+        for index, count in counts.items():
+            index = int(index)
+            self.counts[index] = self.counts.get(index, 0) + count
+            self.count += count
+
+    def quantile(self, q):
+        """Get the approximate q-quantile (0-1) of the values, or None if empty"""
+        if not self.count:
+            return None
+
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen > rank:
+                return bucket_value(index)
+        return bucket_value(max(self.counts))
+
+    def to_dict(self):
+        """Get a JSON-serializable copy of the bucket counts"""
+        return dict(('{}'.format(index), count) for index, count in self.counts.items())
@@ -0,0 +1,128 @@
+"""
+Streaming JSON parsing and serialization for large payloads
+"""
+
+from __future__ import with_statement, division, unicode_literals
+
+import json
+import logging
+
+from . import serialization
+from .compat import LazyModule
+
+ijson = LazyModule('ijson')
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+DEFAULT_MAX_SIZE = 16 * 1024 * 1024
+
+
+class ResponseTooLarge(Exception):
+    """Raised when a response body exceeds the maximum allowed size"""
+    def __init__(self, max_size):
+        super(ResponseTooLarge, self).__init__('Response exceeds maximum size of {} bytes'.format(max_size))
+        self.max_size = max_size
+
+
+class LimitedReader:
+    """A file-like wrapper that raises ResponseTooLarge after max_size bytes"""
+    def __init__(self, fileobj, max_size=DEFAULT_MAX_SIZE):
+        self.fileobj = fileobj
+        self.max_size = max_size
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunks = []
+            while True:
+                chunk = self.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            return b''.join(chunks)
+
+        data = self.fileobj.read(size)
+        self.bytes_read += len(data)
+        if self.max_size and self.bytes_read > self.max_size:
+            raise ResponseTooLarge(self.max_size)
+        return data
+
+
+def check_size(content_length, max_size=DEFAULT_MAX_SIZE):
+    """Raise ResponseTooLarge early if the declared length is too large"""
+    if max_size and content_length and int(content_length) > max_size:
+        raise ResponseTooLarge(max_size)
+
+
+def load_json(fileobj, max_size=DEFAULT_MAX_SIZE, content_length=None):
+    """Parse JSON from the file-like object, reading at most max_size bytes
+
+    If ijson is installed, and no JSON library faster than the standard
+    library is, the document is parsed incrementally as it is read, so the raw
+    body is never held in memory in full.
+    """
+    return read_json(fileobj, max_size=max_size, content_length=content_length)[0]
+
+
+def read_json(fileobj, max_size=DEFAULT_MAX_SIZE, content_length=None):
+    """Parse JSON from the file-like object, like load_json
+
+    Returns an (object, data) tuple, where data is the raw body, or None if
+    the document was parsed incrementally.
+    """
+    check_size(content_length, max_size=max_size)
+    reader = LimitedReader(fileobj, max_size=max_size)
+    if not serialization.get_serializer().is_fast and ijson.get() is not None:
+        for obj in ijson.get().items(reader, '', use_float=True):
+            return obj, None
+        raise ValueError('No JSON object could be decoded')
+
+    data = reader.read()
+    return serialization.loads(data), data
+
+
+def iter_json(obj, chunk_size=CHUNK_SIZE):
+    """Serialize the object to JSON, yielding UTF-8 encoded chunks of about chunk_size"""
+    serializer = serialization.get_serializer()
+    if serializer.is_fast:
+        # Encoding in one go is quicker than the standard library's incremental encoder
+        data = serializer.dumps(obj)
+        for start in range(0, len(data), chunk_size):
+            yield data[start:start + chunk_size]
+        return
+
+    encoder = json.JSONEncoder(separators=(',', ':'))
+    buffered = []
+    length = 0
+    for part in encoder.iterencode(obj):
+        buffered.append(part)
+        length += len(part)
+        if length >= chunk_size:
+            yield ''.join(buffered).encode('utf-8')
+            buffered = []
+            length = 0
+
+    if buffered:
+        yield ''.join(buffered).encode('utf-8')
+
+
+def iter_json_lines(objs, chunk_size=CHUNK_SIZE):
+    """Serialize each object to a line of JSON, yielding UTF-8 encoded chunks of whole lines
+
+    Lines are buffered up to about chunk_size, so that a long stream of small
+    objects is not written one line at a time.
+    """
+    buffered = []
+    length = 0
+    for obj in objs:
+        line = serialization.dumps(obj) + b'\n'
+        buffered.append(line)
+        length += len(line)
+        if length >= chunk_size:
+            yield b''.join(buffered)
+            buffered = []
+            length = 0
+
+    if buffered:
+        yield b''.join(buffered)
@@ -0,0 +1,361 @@
+import json
+import sys
+import unittest
+
+if sys.version_info < (3, 7):
+    raise unittest.SkipTest('The async engine requires Python 3.7+')
+
+import asyncio
+
+import flask
+
+from flask import Flask, stream_with_context
+
+from server.ratelimit import FairScheduler
+from server.streaming import ResponseTooLarge
+from server.tests.test_app import API_MIME_TYPE, EXAMPLE_REQUEST
+from server.tests.test_validation import FakeModel
+
+RESULTS = json.dumps({'results': []}).encode('utf-8')
+CLIENT_TOKEN = 'client-token'
+
+
+def make_response(body=RESULTS, status='200 OK', headers=()):
+    """Get a raw HTTP/1.1 response with a Content-Length"""
+    lines = ['HTTP/1.1 {}'.format(status), 'Content-Length: {}'.format(len(body))] + list(headers)
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+
+def make_chunked_response(chunks, status='200 OK'):
+    lines = ['HTTP/1.1 {}'.format(status), 'Transfer-Encoding: chunked']
+    data = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+    for chunk in chunks:
+        data += '{:x}\r\n'.format(len(chunk)).encode('latin-1') + chunk + b'\r\n'
+    return data + b'0\r\n\r\n'
+
+
+class ScriptedServer:
+    """A local HTTP server answering each request with the next of the given raw responses
+
+    A response of None closes the connection instead, as a server does with an
+    idle connection, and a callable is awaited for the response.
+    """
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+        self.connections = 0
+        self.handlers = set()
+
+    async def __aenter__(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        self.base_url = 'http://127.0.0.1:{}'.format(self.server.sockets[0].getsockname()[1])
+        self.url = '{}/match'.format(self.base_url)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.server.close()
+        await self.server.wait_closed()
+        for handler in self.handlers:
+            handler.cancel()
+        await asyncio.gather(*self.handlers, return_exceptions=True)
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        connection = self.connections
+        self.handlers.add(asyncio.current_task())
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    return
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b''):
+                        break
+                    name, value = line.decode('latin-1').split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                self.requests.append((connection, request_line.decode('latin-1').strip(), headers, body))
+
+                response = self.responses.pop(0)
+                if callable(response):
+                    response = await response()
+                if response is None:
+                    return
+                writer.write(response)
+                await writer.drain()
+                if b'connection: close' in response.lower():
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+class AsyncConnectionPoolTests(unittest.TestCase):
+    def setUp(self):
+        from server.aio import AsyncConnectionPool
+
+        self.pool = AsyncConnectionPool()
+
+    def request(self, responses, count=1, **kwargs):
+        """Send count requests to a server with the given responses, returning (results, server)"""
+        async def send():
+            async with ScriptedServer(responses) as server:
+                try:
+                    results = []
+                    kwargs.setdefault('timeout', 5)
+                    for i in range(count):
+                        results.append(await self.pool.request('POST', server.url, body=b'{}', **kwargs))
+                    return results, server
+                finally:
+                    # The connections belong to this event loop
+                    self.pool.clear()
+        return run(send())
+
+    def test_content_length(self):
+        [(status, headers, body)], server = self.request([make_response()])
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['content-length'], str(len(RESULTS)))
+        self.assertEqual(body, RESULTS)
+
+        [(connection, request_line, headers, body)] = server.requests
+        self.assertEqual(request_line, 'POST /match HTTP/1.1')
+        self.assertEqual(headers['content-length'], '2')
+        self.assertEqual(body, b'{}')
+
+    def test_chunked(self):
+        [(status, headers, body)], server = self.request([make_chunked_response([RESULTS[:5], RESULTS[5:]])])
+        self.assertEqual(status, 200)
+        self.assertEqual(body, RESULTS)
+
+    def test_read_to_eof(self):
+        response = b'HTTP/1.1 200 OK\r\nConnection: close\r\n\r\n' + RESULTS
+        [(status, headers, body)], server = self.request([response])
+        self.assertEqual(body, RESULTS)
+
+    def test_no_body(self):
+        # None of these waits for the connection to close
+        results, server = self.request([b'HTTP/1.1 204 No Content\r\n\r\n',
+                                        b'HTTP/1.1 304 Not Modified\r\nContent-Length: 10\r\n\r\n',
+                                        b'HTTP/1.1 100 Continue\r\n\r\n' + make_response()], count=3)
+        self.assertEqual([(status, body) for status, headers, body in results],
+                         [(204, b''), (304, b''), (200, RESULTS)])
+        self.assertEqual(server.connections, 1)
+
+    def test_keep_alive(self):
+        results, server = self.request([make_response(), make_chunked_response([RESULTS]), make_response()], count=3)
+        self.assertEqual([body for status, headers, body in results], [RESULTS] * 3)
+        self.assertEqual(server.connections, 1)
+
+    def test_connection_close(self):
+        results, server = self.request([make_response(headers=['Connection: close']), make_response()], count=2)
+        self.assertEqual(server.connections, 2)
+
+    def test_stale_connection_retried(self):
+        # The server closes the idle connection just as the second request is sent
+        results, server = self.request([make_response(), None, make_response()], count=2)
+        self.assertEqual([status for status, headers, body in results], [200, 200])
+        self.assertEqual([connection for connection, request_line, headers, body in server.requests], [1, 1, 2])
+
+    def test_new_connection_not_retried(self):
+        with self.assertRaises(ConnectionError):
+            self.request([None])
+
+    def test_max_size(self):
+        for response in [make_response(), make_chunked_response([RESULTS[:5], RESULTS[5:]]),
+                         b'HTTP/1.1 200 OK\r\n\r\n' + RESULTS]:
+            with self.assertRaises(ResponseTooLarge):
+                self.request([response], max_size=len(RESULTS) - 1)
+
+        [(status, headers, body)], server = self.request([make_response()], max_size=len(RESULTS))
+        self.assertEqual(body, RESULTS)
+
+    def test_timeout(self):
+        async def never():
+            await asyncio.sleep(5)
+
+        with self.assertRaises(asyncio.TimeoutError):
+            self.request([never], timeout=0.1)
+
+
+class GatewayAppTests(unittest.TestCase):
+    def setUp(self):
+        import server
+        import server.aio as aio_module
+
+        self.server = server
+        self.aio = aio_module
+        self.logged = []
+        for name in ['MatchRequest', 'MatchResponse']:
+            self.addCleanup(setattr, server, name, getattr(server, name))
+        server.MatchRequest = server.MatchResponse = FakeModel
+        for name in ['_authorize_match', 'get_outgoing_server', 'log_exchange']:
+            self.addCleanup(setattr, aio_module, name, getattr(aio_module, name))
+        aio_module._authorize_match = self.authorize
+        aio_module.get_outgoing_server = self.get_outgoing_server
+        aio_module.log_exchange = lambda request, server, response: self.logged.append(response.get_status())
+
+        self.base_url = None
+        self.app = aio_module.GatewayApp(server.app, max_threads=4)
+        self.addCleanup(self.app.wait_executor.shutdown)
+        self.addCleanup(self.app.executor.shutdown)
+
+    def authorize(self):
+        """Stands in for the token check, which looks up the client in the database"""
+        if flask.request.headers.get('X-Auth-Token') != CLIENT_TOKEN:
+            return self.server.ErrorResponse('Authentication required', status=401).get_response()
+        flask.g.server = {'server_id': 'client'}
+
+    def get_outgoing_server(self, server_id, required=False):
+        if server_id != 'remote':
+            raise self.server.ErrorResponse('Bad server id: {}'.format(server_id), status=400)
+        return {'server_id': server_id, 'base_url': self.base_url, 'server_key': 'remote-token'}
+
+    async def call(self, method, path, body=b'', query=b'', token=CLIENT_TOKEN):
+        """Call the ASGI application, returning (status, headers, list of body chunks)"""
+        headers = [(b'content-type', API_MIME_TYPE.encode('latin-1')), (b'accept', API_MIME_TYPE.encode('latin-1'))]
+        if token:
+            headers.append((b'x-auth-token', token.encode('latin-1')))
+        scope = {
+            'type': 'http',
+            'method': method,
+            'path': path,
+            'query_string': query,
+            'headers': headers,
+            'http_version': '1.1',
+            'scheme': 'http',
+            'root_path': '',
+        }
+        messages = [{'type': 'http.request', 'body': body}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        await self.app(scope, receive, send)
+        start = sent[0]
+        self.assertEqual(start['type'], 'http.response.start')
+        self.assertFalse(sent[-1].get('more_body', False))
+        return start['status'], dict(start['headers']), [message['body'] for message in sent[1:]]
+
+    def match(self, responses, query=b'', token=CLIENT_TOKEN, request=EXAMPLE_REQUEST):
+        """Send a match request for the remote server, returning (status, headers, body, upstream server)"""
+        async def send():
+            async with ScriptedServer(responses) as upstream:
+                self.base_url = upstream.base_url
+                body = json.dumps(request).encode('utf-8')
+                try:
+                    status, headers, chunks = await self.call('POST', '/v1/servers/remote/match', body=body,
+                                                              query=query, token=token)
+                finally:
+                    # The connections belong to this event loop
+                    self.app.pool.clear()
+                return status, headers, b''.join(chunks), upstream
+        return run(send())
+
+    def test_match(self):
+        status, headers, body, upstream = self.match([make_response()])
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b'content-type'], API_MIME_TYPE.encode('latin-1'))
+        self.assertEqual(json.loads(body.decode('utf-8'))['results'], [])
+        self.assertEqual(self.logged, [200])
+
+        [(connection, request_line, headers, data)] = upstream.requests
+        self.assertEqual(request_line, 'POST /match HTTP/1.1')
+        self.assertEqual(headers['x-auth-token'], 'remote-token')
+        self.assertEqual(json.loads(data.decode('utf-8')), EXAMPLE_REQUEST)
+
+    def test_unauthorized(self):
+        status, headers, body, upstream = self.match([], token=None)
+        self.assertEqual(status, 401)
+        self.assertEqual(upstream.requests, [])
+
+    def test_bad_request(self):
+        for query in [b'timeout=abc', b'timeout=0']:
+            status, headers, body, upstream = self.match([], query=query)
+            self.assertEqual(status, 400)
+            self.assertEqual(json.loads(body.decode('utf-8')), {'message': 'Invalid timeout: {}'.format(
+                query.decode('latin-1').split('=')[1])})
+
+        body = json.dumps(EXAMPLE_REQUEST).encode('utf-8')
+        status, headers, chunks = run(self.call('POST', '/v1/servers/other/match', body=body))
+        self.assertEqual(status, 400)
+        self.assertEqual(json.loads(b''.join(chunks).decode('utf-8')), {'message': 'Bad server id: other'})
+
+        status, headers, chunks = run(self.call('POST', '/v1/servers/remote/match', body=b'{'))
+        self.assertEqual(status, 400)
+        self.assertEqual(json.loads(b''.join(chunks).decode('utf-8')), {'message': 'Invalid request JSON'})
+        self.assertEqual(self.logged, [])
+
+    def test_timeout(self):
+        async def never():
+            await asyncio.sleep(5)
+
+        status, headers, body, upstream = self.match([never], query=b'timeout=1')
+        self.assertEqual(status, 504)
+        self.assertEqual(json.loads(body.decode('utf-8')), {'message': 'Request timed out'})
+        self.assertEqual(self.logged, [504])
+
+    def test_other_routes_streamed(self):
+        flask_app = Flask(__name__)
+
+        @flask_app.route('/stream')
+        def stream():
+            def generate():
+                # Produced in the thread pool, in the request's context
+                for i in range(3):
+                    yield '{}:{}\n'.format(flask.request.path, i)
+            return flask_app.response_class(stream_with_context(generate()), mimetype='text/plain')
+
+        app = self.aio.GatewayApp(flask_app, max_threads=2)
+        self.addCleanup(app.wait_executor.shutdown)
+        self.addCleanup(app.executor.shutdown)
+        self.app = app
+        status, headers, chunks = run(self.call('GET', '/stream'))
+        self.assertEqual(status, 200)
+        self.assertEqual([chunk for chunk in chunks if chunk], [b'/stream:0\n', b'/stream:1\n', b'/stream:2\n'])
+
+    def test_outbound_scheduler(self):
+        scheduler = FairScheduler(1)
+        self.addCleanup(setattr, self.aio, 'get_outbound_scheduler', self.aio.get_outbound_scheduler)
+        self.aio.get_outbound_scheduler = lambda: scheduler
+        active = []
+
+        def slow_response():
+            async def respond():
+                active.append(scheduler.active)
+                await asyncio.sleep(0.1)
+                return make_response()
+            return respond
+
+        async def send():
+            async with ScriptedServer([slow_response(), slow_response()]) as upstream:
+                self.base_url = upstream.base_url
+                requests = []
+                for patient_id in ['1', '2']:
+                    # Different requests, so they aren't coalesced
+                    request = dict(EXAMPLE_REQUEST, patient=dict(EXAMPLE_REQUEST['patient'], id=patient_id))
+                    requests.append(self.call('POST', '/v1/servers/remote/match',
+                                              body=json.dumps(request).encode('utf-8')))
+                try:
+                    results = await asyncio.gather(*requests)
+                finally:
+                    self.app.pool.clear()
+                return results, upstream
+
+        results, upstream = run(send())
+        self.assertEqual([status for status, headers, chunks in results], [200, 200])
+        # The second request waited for the first to release its slot
+        self.assertEqual([connection for connection, request_line, headers, body in upstream.requests], [1, 1])
+        self.assertEqual(active, [1, 1])
+        self.assertEqual(scheduler.active, 0)
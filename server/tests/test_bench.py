@@ -0,0 +1,52 @@
+import json
+import unittest
+
+from server.bench import MockNode, format_startup_report, get_stage_timings, percentile, run_load
+
+
+class MockNodeTests(unittest.TestCase):
+    def setUp(self):
+        self.node = MockNode(latency=0, results=3).start()
+
+    def tearDown(self):
+        self.node.stop()
+
+    def test_responses(self):
+        summary = run_load([self.node.base_url + '/match'], {'Content-Type': 'application/json'}, [b'{}'],
+                           concurrency=4, requests=20)
+        self.assertEqual(summary['requests'], 20)
+        self.assertEqual(summary['statuses'], {'200': 20})
+        self.assertTrue(summary['p50'] <= summary['p99'])
+        self.assertEqual(len(json.loads(self.node.body.decode('utf-8'))['results']), 3)
+
+    def test_errors(self):
+        self.node.error_rate = 1
+        summary = run_load([self.node.base_url + '/match'], {}, [b'{}'], concurrency=2, requests=5)
+        self.assertEqual(summary['errors'], 5)
+
+
+class SummaryTests(unittest.TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertIsNone(percentile([], 50))
+
+    def test_stage_timings(self):
+        before = {'series': [[['upstream'], {'sum': 1.0, 'count': 2}]]}
+        after = {'series': [[['upstream'], {'sum': 4.0, 'count': 5}], [['parse_request'], {'sum': 0, 'count': 0}]]}
+        self.assertEqual(get_stage_timings(before, after), {'upstream': {'count': 3, 'mean': 1.0}})
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+    def test_startup_report(self):
+        summary = {'import': 0.5, 'firstRequest': 0.25, 'total': 0.75, 'maxRss': 1024}
+        report = {'startup': {'cold': summary}}
+        baseline = {'startup': {'cold': dict(summary, total=1.5)}}
+        lines = format_startup_report(report, baseline=baseline).splitlines()
+        self.assertEqual(lines[0], 'cold:')
+        self.assertIn('750.0 ms  (-50.0%)', lines[3])
+        self.assertIn('1024 KB', lines[4])
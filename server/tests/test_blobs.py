@@ -0,0 +1,36 @@
+import json
+import unittest
+
+from base64 import b64encode
+
+from server.managers import blobs
+
+
+EXAMPLE_PAYLOAD = {
+    'results': [{
+        'score': {'patient': 0.8},
+        'patient': {
+            'id': str(i),
+            'contact': {'name': 'First Last', 'href': 'mailto:first.last@example.com'},
+            'features': [{'id': 'HP:0000522', 'observed': 'yes'}],
+        },
+    } for i in range(20)],
+}
+
+
+class BlobTests(unittest.TestCase):
+    def test_round_trip(self):
+        blob = blobs.encode(EXAMPLE_PAYLOAD, encoding='zlib')
+        self.assertEqual(blobs.decode(blob, encoding='zlib'), EXAMPLE_PAYLOAD)
+
+    def test_compressed_smaller_than_legacy(self):
+        legacy = b64encode(json.dumps(EXAMPLE_PAYLOAD).encode('utf-8')).decode()
+        self.assertTrue(len(blobs.encode(EXAMPLE_PAYLOAD)) < len(legacy) / 4)
+
+    def test_legacy_format(self):
+        legacy = b64encode(json.dumps(EXAMPLE_PAYLOAD).encode('utf-8')).decode()
+        self.assertEqual(blobs.decode(legacy), EXAMPLE_PAYLOAD)
+
+
+if __name__ == '__main__':
+    unittest.main()
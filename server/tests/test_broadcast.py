@@ -0,0 +1,84 @@
+import sys
+import threading
+import time
+import unittest
+
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask
+
+from server.broadcast import broadcast, get_recipients
+from server.tracing import end_trace, get_current_trace, span, start_trace
+
+# Not `from server import broadcast`, which is the function of the same name
+broadcast_module = sys.modules['server.broadcast']
+
+
+class BroadcastTests(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.servers = [{'server_id': 'a'}, {'server_id': 'b'}, {'server_id': 'slow'}]
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        end_trace()
+
+    def send(self, request, server, timeout):
+        if server['server_id'] == 'slow':
+            self.release.wait(5)
+        elif server['server_id'] == 'b':
+            raise RuntimeError('Connection refused')
+        return 'response from {}'.format(server['server_id'])
+
+    def test_deadline(self):
+        start = time.time()
+        completed, timed_out, failed = broadcast(self.app, 'request', self.servers, timeout=10, deadline=0.2,
+                                                 send=self.send)
+        self.assertTrue(time.time() - start < 2)
+        self.assertEqual(completed, [({'server_id': 'a'}, 'response from a')])
+        self.assertEqual(timed_out, [{'server_id': 'slow'}])
+        self.assertEqual(failed, [{'server_id': 'b'}])
+
+    def test_queued_requests_cancelled_at_deadline(self):
+        sent = []
+
+        def send(request, server, timeout):
+            sent.append(server['server_id'])
+            self.release.wait(5)
+
+        # Use a single thread, so that only the first request is started
+        executor = broadcast_module._executor
+        broadcast_module._executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            servers = [{'server_id': '{}'.format(i)} for i in range(3)]
+            completed, timed_out, failed = broadcast(self.app, 'request', servers, deadline=0.2, send=send)
+            self.assertEqual(len(timed_out), 3)
+            self.release.set()
+            broadcast_module._executor.shutdown(wait=True)
+        finally:
+            broadcast_module._executor = executor
+        self.assertEqual(sent, ['0'])
+
+    def test_excludes_sender(self):
+        self.assertEqual(get_recipients(self.servers, 'a'), [{'server_id': 'b'}, {'server_id': 'slow'}])
+        self.assertEqual(get_recipients(self.servers, None), self.servers)
+
+    def test_trace_propagated(self):
+        traces = []
+
+        def send(request, server, timeout):
+            traces.append(get_current_trace())
+            with span('upstream', server=server['server_id']):
+                pass
+            return 'response'
+
+        trace = start_trace('match')
+        completed, timed_out, failed = broadcast(self.app, 'request', self.servers[:2], send=send)
+        self.assertEqual(len(completed), 2)
+        self.assertEqual(traces, [trace, trace])
+        self.assertEqual(sorted(s.attributes['server'] for s in trace.spans), ['a', 'b'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import threading
+import time
+import unittest
+
+from server.managers import bulk as bulk_module
+from server.managers.bulk import BulkWriter
+
+
+class FakeBulk:
+    """Records the batches passed to elasticsearch.helpers.bulk"""
+    def __init__(self, errors=()):
+        self.batches = []
+        self.errors = list(errors)
+        self.called = threading.Event()
+
+    def __call__(self, client, actions, raise_on_error=True):
+        actions = list(actions)
+        self.batches.append(actions)
+        self.called.set()
+        return len(actions) - len(self.errors), self.errors
+
+
+class BulkWriterTests(unittest.TestCase):
+    def setUp(self):
+        self.bulk = FakeBulk()
+        self.addCleanup(setattr, bulk_module, 'bulk', bulk_module.bulk)
+        bulk_module.bulk = self.bulk
+
+    def test_batches_by_size(self):
+        writer = BulkWriter(None, batch_size=3, flush_interval=60)
+        self.addCleanup(writer.close)
+        for i in range(7):
+            writer.put('index', 'doc', {'i': i})
+
+        # Full batches are indexed without waiting for the interval
+        self.assertTrue(self.bulk.called.wait(5))
+        time.sleep(0.2)
+        sizes = [len(batch) for batch in self.bulk.batches]
+        self.assertTrue(all(size >= 3 for size in sizes))
+        self.assertTrue(7 - sum(sizes) < 3)
+
+    def test_batches_by_interval(self):
+        writer = BulkWriter(None, batch_size=100, flush_interval=0.1)
+        self.addCleanup(writer.close)
+        writer.put('index', 'doc', {'i': 1})
+
+        self.assertTrue(self.bulk.called.wait(5))
+        self.assertEqual(self.bulk.batches, [[{'_index': 'index', '_type': 'doc', '_source': {'i': 1}}]])
+        self.assertEqual(writer.indexed, 1)
+
+    def test_drops_when_full(self):
+        release = threading.Event()
+        index = self.bulk
+
+        def slow_bulk(client, actions, raise_on_error=True):
+            result = index(client, actions, raise_on_error=raise_on_error)
+            release.wait(5)
+            return result
+
+        bulk_module.bulk = slow_bulk
+        writer = BulkWriter(None, buffer_size=2, batch_size=1, flush_interval=60)
+        self.addCleanup(writer.close)
+
+        # The first document is taken off the queue, and indexing it blocks
+        self.assertTrue(writer.put('index', 'doc', {'i': 1}))
+        self.assertTrue(self.bulk.called.wait(5))
+        self.assertTrue(writer.put('index', 'doc', {'i': 2}))
+        self.assertTrue(writer.put('index', 'doc', {'i': 3}))
+        self.assertFalse(writer.put('index', 'doc', {'i': 4}))
+        self.assertEqual(writer.dropped, 1)
+
+        release.set()
+        writer.close()
+        self.assertEqual([batch[0]['_source']['i'] for batch in self.bulk.batches], [1, 2, 3])
+
+    def test_close_flushes(self):
+        writer = BulkWriter(None, batch_size=100, flush_interval=60)
+        for i in range(5):
+            writer.put('index', 'doc', {'i': i})
+        start = time.time()
+        writer.close()
+
+        self.assertTrue(time.time() - start < 5)
+
+        self.assertFalse(writer._thread.is_alive())
+        self.assertEqual(sum(len(batch) for batch in self.bulk.batches), 5)
+        self.assertEqual(writer.indexed, 5)
+        self.assertEqual(writer.pending(), 0)
+
+    def test_callbacks(self):
+        self.bulk.errors = [
+            {'create': {'_id': 'b', 'status': 500, 'error': 'Failed'}},
+            # Already exists
+            {'create': {'_id': 'c', 'status': 409, 'error': 'Conflict'}},
+        ]
+        results = {}
+
+        def callback(doc_id):
+            return lambda indexed: results.__setitem__(doc_id, indexed)
+
+        writer = BulkWriter(None, batch_size=100, flush_interval=60)
+        for doc_id in ['a', 'b', 'c']:
+            writer.put_action({'_op_type': 'create', '_index': 'index', '_type': 'doc', '_id': doc_id,
+                               '_source': {}}, callback=callback(doc_id))
+        writer.close()
+
+        self.assertEqual(results, {'a': True, 'b': False, 'c': True})
+        self.assertEqual(writer.failed, 1)
+
+    def test_callbacks_on_error(self):
+        def failing_bulk(client, actions, raise_on_error=True):
+            raise IOError('Connection refused')
+
+        bulk_module.bulk = failing_bulk
+        results = []
+        writer = BulkWriter(None, batch_size=100, flush_interval=60)
+        writer.put_action({'_index': 'index', '_type': 'doc', '_id': 'a', '_source': {}}, callback=results.append)
+        writer.close()
+        self.assertEqual(results, [False])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import time
+import unittest
+
+from server.cache import LRUCache, TTLCache, canonical_hash
+
+
+class CanonicalHashTests(unittest.TestCase):
+    def test_key_order_ignored(self):
+        a = {'patient': {'id': '1', 'features': [{'id': 'HP:0000522'}]}}
+        b = {'patient': {'features': [{'id': 'HP:0000522'}], 'id': '1'}}
+        self.assertEqual(canonical_hash(a), canonical_hash(b))
+
+    def test_values_compared(self):
+        self.assertNotEqual(canonical_hash({'id': '1'}), canonical_hash({'id': '2'}))
+
+
+class LRUCacheTests(unittest.TestCase):
+    def test_least_recently_used_evicted(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_counters(self):
+        cache = LRUCache()
+        cache.get('a')
+        cache.set('a', 1)
+        cache.get('a')
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['size'], 1)
+
+    def test_disabled(self):
+        cache = LRUCache(maxsize=0)
+        cache.set('a', 1)
+        self.assertIsNone(cache.get('a'))
+
+
+class TTLCacheTests(unittest.TestCase):
+    def test_expired(self):
+        cache = TTLCache()
+        cache.set('a', 1, ttl=0.01)
+        cache.set('b', 2, ttl=60)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 2)
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_not_cached_without_ttl(self):
+        cache = TTLCache()
+        cache.set('a', 1, ttl=0)
+        self.assertIsNone(cache.get('a'))
+
+
+if __name__ == '__main__':
+    unittest.main()
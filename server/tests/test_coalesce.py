@@ -0,0 +1,81 @@
+import threading
+import time
+import unittest
+
+from server.coalesce import CallTimeout, SingleFlight
+
+
+class SingleFlightTests(unittest.TestCase):
+    def setUp(self):
+        self.single_flight = SingleFlight()
+        self.calls = 0
+        self.release = threading.Event()
+
+    def slow_call(self, value):
+        self.calls += 1
+        self.release.wait(5)
+        return value
+
+    def run_concurrently(self, n, key='key'):
+        results = []
+
+        def run():
+            results.append(self.single_flight.do(key, self.slow_call, 'result'))
+
+        threads = [threading.Thread(target=run) for i in range(n)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_identical_calls_share_result(self):
+        results = self.run_concurrently(5)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(sorted(shared for result, shared in results), [False, True, True, True, True])
+        self.assertTrue(all(result == 'result' for result, shared in results))
+        self.assertEqual(self.single_flight.in_flight(), 0)
+
+    def test_sequential_calls_not_shared(self):
+        self.release.set()
+        self.single_flight.do('key', self.slow_call, 1)
+        self.single_flight.do('key', self.slow_call, 2)
+        self.assertEqual(self.calls, 2)
+
+    def test_error_shared(self):
+        errors = []
+
+        def fail():
+            self.release.wait(5)
+            raise ValueError('failed')
+
+        def run():
+            try:
+                self.single_flight.do('key', fail)
+            except ValueError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(errors), 3)
+
+    def test_wait_timeout(self):
+        thread = threading.Thread(target=self.single_flight.do, args=('key', self.slow_call, 1))
+        thread.start()
+        time.sleep(0.05)
+        with self.assertRaises(CallTimeout):
+            self.single_flight.do('key', self.slow_call, 2, wait_timeout=0.05)
+        self.release.set()
+        thread.join()
+        self.assertEqual(self.calls, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
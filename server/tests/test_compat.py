@@ -0,0 +1,16 @@
+import sys
+import unittest
+
+from server.compat import LazyModule
+
+
+class LazyModuleTests(unittest.TestCase):
+    def test_imported_on_first_use(self):
+        sys.modules.pop('colorsys', None)
+        module = LazyModule('colorsys')
+        self.assertNotIn('colorsys', sys.modules)
+        self.assertEqual(module.get().__name__, 'colorsys')
+        self.assertIs(module.get(), sys.modules['colorsys'])
+
+    def test_missing_module(self):
+        self.assertIsNone(LazyModule('no_such_module_installed').get())
@@ -0,0 +1,40 @@
+import unittest
+
+from server.health import ServerHealth, CLOSED, OPEN, HALF_OPEN
+
+
+class ServerHealthTests(unittest.TestCase):
+    def test_opens_after_failures(self):
+        health = ServerHealth(failure_threshold=3, reset_timeout=60)
+        for i in range(3):
+            self.assertTrue(health.allow_request())
+            health.record(504)
+        self.assertEqual(health.state, OPEN)
+        self.assertFalse(health.allow_request())
+
+    def test_half_open_probe(self):
+        health = ServerHealth(failure_threshold=1, reset_timeout=0)
+        health.record(500)
+        self.assertTrue(health.allow_request())
+        self.assertEqual(health.state, HALF_OPEN)
+        health.record(200, 0.1)
+        self.assertEqual(health.state, CLOSED)
+
+    def test_failed_probe_reopens(self):
+        health = ServerHealth(failure_threshold=1, reset_timeout=0)
+        health.record(500)
+        health.allow_request()
+        health.record(500)
+        self.assertEqual(health.state, OPEN)
+
+    def test_adaptive_timeout(self):
+        health = ServerHealth()
+        self.assertEqual(health.get_timeout(20, min_samples=10), 20)
+        for i in range(10):
+            health.record(200, 1.0)
+        self.assertEqual(health.get_timeout(20, multiplier=3, min_samples=10), 3.0)
+        self.assertEqual(health.get_timeout(20, multiplier=1, min_timeout=2, min_samples=10), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
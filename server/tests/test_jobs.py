@@ -0,0 +1,170 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from server.jobs import DONE, RUNNING, Job, JobRunner, remove_expired
+
+
+def get_dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', ''])
+    process.wait()
+    return process.pid
+
+
+class JobTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def create_job(self, n=3, servers=('a', 'b')):
+        requests = [json.dumps({'patient': {'id': str(i)}}).encode('utf-8') for i in range(n)]
+        return Job.create(self.root, 'client', servers, requests)
+
+    def test_create_and_load(self):
+        job = self.create_job()
+        self.assertEqual(job.state['total'], 6)
+        self.assertEqual(job.read_request(job.offsets[2]), {'patient': {'id': '2'}})
+
+        loaded = Job.load(self.root, job.id)
+        self.assertEqual(loaded.state, job.state)
+        self.assertIsNone(Job.load(self.root, '../' + job.id))
+        self.assertIsNone(Job.load(self.root, 'missing'))
+
+    def test_results(self):
+        job = self.create_job(n=1, servers=['a'])
+        job.add_result({'line': 1, 'status': 500}, failed=True)
+        self.assertEqual(job.state['state'], DONE)
+        self.assertEqual(Job.load(self.root, job.id).state['failed'], 1)
+
+        data = b''.join(job.iter_results(chunk_size=4))
+        self.assertEqual([json.loads(line) for line in data.splitlines()], [{'line': 1, 'status': 500}])
+
+    def test_remove_expired(self):
+        job = self.create_job()
+        remove_expired(self.root, 60)
+        self.assertIsNotNone(Job.load(self.root, job.id))
+        remove_expired(self.root, -1)
+        self.assertIsNone(Job.load(self.root, job.id))
+
+
+class JobRunnerTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.lock = threading.Lock()
+        self.active = {}
+        self.max_active = {}
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def process(self, job, request, server_id):
+        with self.lock:
+            self.active[server_id] = self.active.get(server_id, 0) + 1
+            self.max_active[server_id] = max(self.max_active.get(server_id, 0), self.active[server_id])
+        time.sleep(0.01)
+        with self.lock:
+            self.active[server_id] -= 1
+        if request['patient']['id'] == '0':
+            raise ValueError('failed')
+        return {'status': 200, 'response': request}, False
+
+    def test_runs_all_items_within_receiver_concurrency(self):
+        requests = [json.dumps({'patient': {'id': str(i)}}).encode('utf-8') for i in range(10)]
+        job = Job.create(self.root, 'client', ['a', 'b'], requests)
+        runner = JobRunner(self.process, max_workers=8, receiver_concurrency=2)
+        runner.submit(job)
+        runner.shutdown()
+
+        state = Job.load(self.root, job.id).state
+        self.assertEqual(state['state'], DONE)
+        self.assertEqual(state['completed'], 20)
+        self.assertEqual(state['failed'], 2)
+        self.assertEqual(self.max_active, {'a': 2, 'b': 2})
+
+        results = [json.loads(line) for line in b''.join(job.iter_results()).splitlines()]
+        self.assertEqual(sorted((result['serverId'], result['line']) for result in results),
+                         sorted((server_id, line) for server_id in 'ab' for line in range(1, 11)))
+
+    def test_recover_orphaned_job(self):
+        requests = [json.dumps({'patient': {'id': str(i)}}).encode('utf-8') for i in range(1, 4)]
+        job = Job.create(self.root, 'client', ['a', 'b'], requests)
+        job.set_state(RUNNING)
+        job.add_result({'line': 1, 'serverId': 'a', 'status': 200})
+        job.add_result({'line': 2, 'serverId': 'b', 'status': 500}, failed=True)
+        # A result was being written when the worker exited
+        with open(os.path.join(job.directory, Job.RESULTS_FILE), 'ab') as ofp:
+            ofp.write(b'{"line": 3, "ser')
+
+        # Not while the owner is alive
+        runner = JobRunner(self.process, max_workers=2, receiver_concurrency=1)
+        self.assertEqual(runner.recover(self.root), 0)
+
+        job.state['ownerPid'] = get_dead_pid()
+        job.save()
+        self.assertEqual(runner.recover(self.root), 1)
+        runner.shutdown()
+        self.assertEqual(runner.recover(self.root), 0)
+
+        state = Job.load(self.root, job.id).state
+        self.assertEqual(state['state'], DONE)
+        self.assertEqual(state['ownerPid'], os.getpid())
+        self.assertEqual(state['completed'], 6)
+        self.assertEqual(state['failed'], 1)
+
+        results = [json.loads(line) for line in b''.join(job.iter_results()).splitlines()]
+        self.assertEqual(sorted((result['serverId'], result['line']) for result in results),
+                         sorted((server_id, line) for server_id in 'ab' for line in range(1, 4)))
+
+    def test_shutdown_without_finishing(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def process(job, request, server_id):
+            started.set()
+            release.wait(5)
+            return {'status': 200, 'response': request}, False
+
+        requests = [json.dumps({'patient': {'id': str(i)}}).encode('utf-8') for i in range(5)]
+        job = Job.create(self.root, 'client', ['a'], requests)
+        runner = JobRunner(process, max_workers=1, receiver_concurrency=1)
+        runner.submit(job)
+        self.assertTrue(started.wait(5))
+        runner.shutdown(wait=False, finish=False)
+        release.set()
+        runner.shutdown()
+
+        # Only the item in progress is completed; the job is left for another process
+        state = Job.load(self.root, job.id).state
+        self.assertEqual(state['state'], RUNNING)
+        self.assertEqual(state['completed'], 1)
+        self.assertEqual(sum(len(items) for items in job.get_remaining().values()), 4)
+
+
+class RunJobItemTests(unittest.TestCase):
+    def setUp(self):
+        import server
+
+        self.server = server
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        for name in ['get_outgoing_server', 'MMERequest']:
+            self.addCleanup(setattr, server, name, getattr(server, name))
+        server.get_outgoing_server = lambda server_id: {'server_id': server_id}
+
+    def test_error_response(self):
+        def invalid_request(*args, **kwargs):
+            raise self.server.ErrorResponse('Invalid request', status=422)
+
+        self.server.MMERequest = invalid_request
+        job = Job.create(self.root, 'client', ['a'], [b'{}'])
+        result, failed = self.server.run_job_item(job, {}, 'a')
+        self.assertTrue(failed)
+        self.assertEqual(result, {'status': 422, 'response': {'message': 'Invalid request'}})
@@ -0,0 +1,45 @@
+import unittest
+
+from copy import deepcopy
+
+from server.merge import get_score, merge_results
+
+
+def result(patient_id, score):
+    return {'patient': {'id': patient_id}, 'score': {'patient': score}}
+
+
+RESPONSES = [
+    ('a', [result('1', 0.5), result('2', 0.9), result('1', 0.7)]),
+    ('b', [result('1', 0.8), {'patient': {'id': '3'}}]),
+]
+
+
+class MergeTests(unittest.TestCase):
+    def test_ranked_and_deduplicated(self):
+        merged = merge_results(RESPONSES)
+        self.assertEqual([(r['_server'], r['patient']['id'], get_score(r)) for r in merged], [
+            ('a', '2', 0.9),
+            ('b', '1', 0.8),
+            ('a', '1', 0.7),
+            ('b', '3', 0.0),
+        ])
+
+    def test_limit(self):
+        merged = merge_results(RESPONSES, limit=2)
+        self.assertEqual([r['patient']['id'] for r in merged], ['2', '1'])
+        self.assertEqual(merged[1]['_server'], 'b')
+
+    def test_does_not_modify_results(self):
+        responses = deepcopy(RESPONSES)
+        merge_results(responses)
+        self.assertEqual(responses, RESPONSES)
+
+    def test_invalid_scores(self):
+        self.assertEqual(get_score({'score': {'patient': 'high'}}), 0.0)
+        self.assertEqual(get_score({'score': None}), 0.0)
+        self.assertEqual(get_score({}), 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
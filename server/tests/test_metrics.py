@@ -0,0 +1,84 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from server.metrics import (Registry, compact_snapshots, export_text, merge_snapshots, read_snapshots,
+                            write_snapshot, EXITED_FILENAME)
+
+
+class MetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+        self.requests = self.registry.counter('requests_total', 'Requests', labels=('status',))
+        self.latency = self.registry.histogram('latency_seconds', 'Latency', buckets=(0.1, 1))
+        self.in_flight = self.registry.gauge('in_flight', 'In flight')
+
+    def test_export_text(self):
+        self.requests.inc(status=200)
+        self.requests.inc(status=200)
+        self.latency.observe(0.05)
+        self.latency.observe(5)
+        text = export_text(self.registry.snapshot())
+        self.assertIn('# TYPE requests_total counter', text)
+        self.assertIn('requests_total{status="200"} 2', text)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 1', text)
+        self.assertIn('latency_seconds_bucket{le="1.0"} 1', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 2', text)
+        self.assertIn('latency_seconds_count 2', text)
+
+    def test_merge_ignores_gauges_of_exited_processes(self):
+        self.requests.inc(status=200)
+        self.in_flight.inc()
+        snapshot = self.registry.snapshot()
+        merged = merge_snapshots([(snapshot, True), (snapshot, False)])
+        self.assertEqual(merged['requests_total']['series'], [[['200'], 2]])
+        self.assertEqual(merged['in_flight']['series'], [[[], 1]])
+
+    def test_snapshot_directory(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self.requests.inc(status=500)
+            write_snapshot(directory, source=self.registry)
+            merged = read_snapshots(directory, source=self.registry)
+            # Our own snapshot file is replaced by the live metrics
+            self.assertEqual(merged['requests_total']['series'], [[['500'], 1]])
+        finally:
+            shutil.rmtree(directory)
+
+    def write_exited_snapshot(self, directory):
+        """Write the registry's snapshot as if from a process that has exited"""
+        process = subprocess.Popen([sys.executable, '-c', ''])
+        process.wait()
+        with open(os.path.join(directory, '{}.json'.format(process.pid)), 'w') as ofp:
+            json.dump(self.registry.snapshot(), ofp)
+
+    def test_compact_snapshots(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self.requests.inc(status=200)
+            self.in_flight.inc()
+            self.write_exited_snapshot(directory)
+            self.write_exited_snapshot(directory)
+            write_snapshot(directory, source=self.registry)
+
+            self.assertEqual(compact_snapshots(directory), 2)
+            self.assertEqual(sorted(filename for filename in os.listdir(directory) if filename.endswith('.json')),
+                             sorted([EXITED_FILENAME, '{}.json'.format(os.getpid())]))
+
+            # Counters of exited processes are kept, and their gauges dropped
+            self.write_exited_snapshot(directory)
+            self.assertEqual(compact_snapshots(directory), 1)
+            merged = read_snapshots(directory, source=self.registry)
+            self.assertEqual(merged['requests_total']['series'], [[['200'], 4]])
+            self.assertEqual(merged['in_flight']['series'], [[[], 1]])
+            self.assertEqual(compact_snapshots(directory), 0)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
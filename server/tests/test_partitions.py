@@ -0,0 +1,34 @@
+import unittest
+
+from datetime import datetime
+
+from server.managers.partitions import (get_next_partition_start, get_partition_name, get_partition_names,
+                                        parse_partition_name)
+
+
+class PartitionTests(unittest.TestCase):
+    def test_names(self):
+        timestamp = datetime(2017, 12, 31, 23, 59)
+        self.assertEqual(get_partition_name('exchange', timestamp, 'month'), 'exchange-2017.12')
+        self.assertEqual(get_partition_name('exchange', timestamp, 'day'), 'exchange-2017.12.31')
+        self.assertEqual(parse_partition_name('exchange', 'exchange-2017.12'), (datetime(2017, 12, 1), 'month'))
+        self.assertEqual(parse_partition_name('exchange', 'exchange-2017.12.31'), (datetime(2017, 12, 31), 'day'))
+        self.assertIsNone(parse_partition_name('exchange', 'exchange_rollups'))
+        self.assertIsNone(parse_partition_name('exchange', 'exchange-old'))
+
+    def test_next_partition(self):
+        self.assertEqual(get_next_partition_start(datetime(2017, 12, 1), 'month'), datetime(2018, 1, 1))
+        self.assertEqual(get_next_partition_start(datetime(2017, 1, 31), 'day'), datetime(2017, 2, 1))
+
+    def test_range(self):
+        names = get_partition_names('exchange', since=datetime(2017, 11, 15), until=datetime(2018, 1, 1),
+                                    partitioning='month')
+        self.assertEqual(names, ['exchange-2017.11', 'exchange-2017.12'])
+
+        names = get_partition_names('exchange', since=datetime(2017, 1, 1, 12), until=datetime(2017, 1, 2, 1),
+                                    partitioning='day')
+        self.assertEqual(names, ['exchange-2017.01.01', 'exchange-2017.01.02'])
+
+    def test_unbounded_or_long_range(self):
+        self.assertIsNone(get_partition_names('exchange', until=datetime(2017, 1, 1)))
+        self.assertIsNone(get_partition_names('exchange', since=datetime(2000, 1, 1), until=datetime(2017, 1, 1)))
@@ -0,0 +1,74 @@
+import json
+import threading
+import unittest
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from server.pool import ConnectionPool
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.server.clients.add(self.client_address)
+        length = int(self.headers['Content-Length'])
+        self.rfile.read(length)
+        body = json.dumps({'results': []}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ConnectionPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), MockHandler)
+        self.server.clients = set()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{}/v1/match'.format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connection_reused(self):
+        pool = ConnectionPool()
+        for i in range(3):
+            with pool.urlopen('POST', self.url, body=b'{}', timeout=5) as response:
+                self.assertEqual(response.getcode(), 200)
+                self.assertEqual(json.loads(response.read().decode('utf-8')), {'results': []})
+
+        self.assertEqual(len(self.server.clients), 1)
+
+    def test_timings(self):
+        pool = ConnectionPool()
+        phases = []
+        for i in range(2):
+            with pool.urlopen('POST', self.url, body=b'{}', timeout=5) as response:
+                response.read()
+                phases.append(sorted(response.timings))
+                self.assertTrue(all(start <= end for start, end in response.timings.values()))
+
+        # The second request reuses the connection
+        self.assertEqual(phases, [['dns', 'tcp', 'ttfb'], ['ttfb']])
+
+    def test_idle_connection_evicted(self):
+        pool = ConnectionPool(idle_timeout=0)
+        for i in range(2):
+            with pool.urlopen('POST', self.url, body=b'{}', timeout=5) as response:
+                response.read()
+
+        self.assertEqual(len(self.server.clients), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
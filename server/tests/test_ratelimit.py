@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from server.ratelimit import FairScheduler, MemoryBucketStore, RateLimiter, SQLiteBucketStore, refill
+
+
+class TokenBucketTests(unittest.TestCase):
+    def test_refill(self):
+        self.assertEqual(refill(None, 0, 0, rate=1, burst=2), (1, 0))
+        self.assertEqual(refill(0, 0, 0.5, rate=1, burst=2), (0.5, 0.5))
+        self.assertEqual(refill(0, 0, 100, rate=1, burst=2), (1, 0))
+
+    def check_store(self, store):
+        limiter = RateLimiter(store, limits={'batch': (1, 3)})
+        self.assertEqual([limiter.check('batch') for i in range(3)], [0, 0, 0])
+        self.assertTrue(0 < limiter.check('batch') <= 1)
+        # Other clients have no limit by default
+        self.assertEqual(limiter.check('interactive'), 0)
+
+    def test_memory_store(self):
+        self.check_store(MemoryBucketStore())
+
+    def test_sqlite_store_shared(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'limits.sqlite')
+            self.check_store(SQLiteBucketStore(path))
+            # A second store on the same file sees the same, empty bucket
+            limiter = RateLimiter(SQLiteBucketStore(path), limits={'batch': (1, 3)})
+            self.assertTrue(limiter.check('batch') > 0)
+        finally:
+            shutil.rmtree(directory)
+
+
+class FairSchedulerTests(unittest.TestCase):
+    def test_weighted_order(self):
+        scheduler = FairScheduler(1, weights={'interactive': 2})
+        self.assertTrue(scheduler.acquire('batch'))
+
+        order = []
+
+        def wait(sender):
+            self.assertTrue(scheduler.acquire(sender, timeout=5))
+            order.append(sender)
+            scheduler.release()
+
+        threads = []
+        for sender in ['batch'] * 4 + ['interactive'] * 4:
+            thread = threading.Thread(target=wait, args=(sender,))
+            thread.start()
+            threads.append(thread)
+            time.sleep(0.01)
+        self.assertEqual(scheduler.depth(), {'batch': 4, 'interactive': 4})
+
+        scheduler.release()
+        for thread in threads:
+            thread.join()
+        # Interactive requests, with twice the weight, jump ahead of the queued batch
+        self.assertEqual(order[:3], ['interactive', 'batch', 'interactive'])
+        self.assertEqual(order[-1], 'batch')
+        self.assertEqual(scheduler.active, 0)
+
+    def test_timeout(self):
+        scheduler = FairScheduler(1)
+        self.assertTrue(scheduler.acquire('a'))
+        self.assertFalse(scheduler.acquire('b', timeout=0.01))
+        self.assertEqual(scheduler.depth(), {'b': 0})
+        scheduler.release()
+        self.assertEqual(scheduler.active, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from server.registry import ServerRegistry, invalidate
+
+
+class ServerRegistryTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.stamp_file = os.path.join(self.tmpdir, 'servers.stamp')
+        self.loads = 0
+        self.servers = [
+            {'server_id': 'a', 'direction': 'out', 'base_url': 'http://a.example.com'},
+            {'server_id': 'b', 'direction': 'in'},
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def load(self):
+        self.loads += 1
+        return list(self.servers)
+
+    def test_lookups_cached(self):
+        registry = ServerRegistry(self.load, stamp_file=self.stamp_file)
+        self.assertEqual(registry.get('a')['base_url'], 'http://a.example.com')
+        self.assertIsNone(registry.get('b'))
+        self.assertEqual([s['server_id'] for s in registry.list(direction='in')], ['b'])
+        self.assertEqual(self.loads, 1)
+
+    def test_invalidated_by_stamp_file(self):
+        registry = ServerRegistry(self.load, stamp_file=self.stamp_file)
+        self.assertIsNone(registry.get('c'))
+        self.servers.append({'server_id': 'c', 'direction': 'out'})
+        invalidate(self.stamp_file)
+        self.assertIsNotNone(registry.get('c'))
+        self.assertEqual(self.loads, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
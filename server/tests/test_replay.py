@@ -0,0 +1,73 @@
+import io
+import unittest
+
+from server.bench import MockNode
+from server.metrics import clock
+from server.replay import export, iter_jsonl, iter_logged, parse_timestamp, replay, schedule
+
+
+def get_records(n, interval=0.1):
+    return [{
+        'created_at': '2017-01-01T00:00:{:09.6f}'.format(i * interval),
+        'receiver_id': 'server',
+        'request': {'patient': {'id': '{}'.format(i)}},
+    } for i in range(n)]
+
+
+class FakeStats:
+    def __init__(self, docs):
+        self.docs = docs
+        self.decoded = 0
+
+    def scan_exchanges(self, include_payloads=True, **filters):
+        self.filters = dict(filters, include_payloads=include_payloads)
+        for doc in self.docs:
+            yield doc if include_payloads else dict((k, v) for k, v in doc.items() if k != 'request')
+
+    def get_request(self, doc):
+        self.decoded += 1
+        return doc['request']
+
+
+class ReplayTests(unittest.TestCase):
+    def test_parse_timestamp(self):
+        self.assertEqual(parse_timestamp('2017-01-01T10:00:00').hour, 10)
+        self.assertEqual(parse_timestamp('2017-01-01T10:00:00.500000').microsecond, 500000)
+
+    def test_export_round_trip(self):
+        records = get_records(3)
+        ofp = io.StringIO()
+        self.assertEqual(export(records, ofp), 3)
+        self.assertEqual(list(iter_jsonl(io.StringIO(ofp.getvalue()))), records)
+
+    def test_logged_without_payloads(self):
+        stats = FakeStats(get_records(5))
+        records = list(iter_logged(stats, include_requests=False, limit=3, status=(500, 600)))
+        self.assertEqual(len(records), 3)
+        self.assertNotIn('request', records[0])
+        self.assertEqual(stats.decoded, 0)
+        self.assertEqual(stats.filters, {'ordered': True, 'include_payloads': False, 'status': (500, 600)})
+
+        records = list(iter_logged(stats))
+        self.assertEqual(records[4]['request'], {'patient': {'id': '4'}})
+        self.assertEqual(stats.decoded, 5)
+
+    def test_schedule_compresses_time(self):
+        start = clock()
+        scheduled = list(schedule(get_records(5, interval=0.1), speed=4))
+        elapsed = clock() - start
+        self.assertEqual(len(scheduled), 5)
+        self.assertTrue(0.09 <= elapsed < 0.3)
+
+    def test_replay(self):
+        node = MockNode(latency=0).start()
+        try:
+            summary = replay(get_records(10, interval=0.001), node.base_url, 'token', speed=0, concurrency=3)
+        finally:
+            node.stop()
+        self.assertEqual(summary['statuses'], {'200': 10})
+        self.assertEqual(summary['skipped'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+import threading
+import unittest
+
+from datetime import datetime, timedelta
+
+from server.managers import bulk as bulk_module
+from server.managers import rollups as rollups_module
+from server.managers.bulk import BulkWriter
+from server.managers.rollups import RollupBuffer, RollupManager, get_hour
+
+
+class FakeWriter:
+    """Records the actions queued on a bulk writer"""
+    def __init__(self):
+        self.actions = []
+
+    def put_action(self, action, callback=None):
+        self.actions.append(action)
+        return True
+
+
+class FakeBulk:
+    """Records the actions passed to elasticsearch.helpers.bulk"""
+    def __init__(self):
+        self.actions = []
+        self.called = threading.Event()
+
+    def __call__(self, client, actions, raise_on_error=True):
+        actions = list(actions)
+        self.actions.extend(actions)
+        if actions:
+            self.called.set()
+        return len(actions), []
+
+
+def make_exchange(sender_id='a', receiver_id='b', status=200, took=0.5, created_at=None):
+    return {
+        'created_at': created_at or datetime.now(),
+        'sender_id': sender_id,
+        'receiver_id': receiver_id,
+        'is_test': False,
+        'status': status,
+        'took': took,
+    }
+
+
+class RollupBufferTests(unittest.TestCase):
+    def test_drain_changed_buckets(self):
+        buffer = RollupBuffer()
+        hour = get_hour(datetime.now())
+        buffer.add(hour, 'a', 'b', False, 200, 0.5)
+        buffer.add(hour, 'a', 'b', False, 500, 1.5)
+        buffer.add(hour, 'a', 'c', False, 200, 0.1)
+
+        docs = dict(buffer.drain())
+        self.assertEqual(len(docs), 2)
+        doc = [doc for doc in docs.values() if doc['receiver_id'] == 'b'][0]
+        self.assertEqual(doc['count'], 2)
+        self.assertEqual(doc['errors'], 1)
+        self.assertEqual(doc['took_max'], 1.5)
+        self.assertEqual(doc['source'], buffer.source)
+
+        # Only buckets that changed again are drained, with the same id and the latest totals
+        self.assertEqual(buffer.drain(), [])
+        buffer.add(hour, 'a', 'b', False, 200, 0.5)
+        [(doc_id, doc)] = buffer.drain()
+        self.assertIn(doc_id, docs)
+        self.assertEqual(doc['count'], 3)
+
+    def test_drops_past_hours(self):
+        buffer = RollupBuffer(retain_hours=1)
+        old_hour = get_hour(datetime.now() - timedelta(hours=3))
+        buffer.add(old_hour, 'a', 'b', False, 200, 0.5)
+        [(old_id, doc)] = buffer.drain()
+        self.assertEqual(doc['hour'], old_hour)
+
+        # A late exchange for a dropped hour starts a new document
+        buffer.add(old_hour, 'a', 'b', False, 200, 0.5)
+        [(doc_id, doc)] = buffer.drain()
+        self.assertNotEqual(doc_id, old_id)
+        self.assertEqual(doc['count'], 1)
+
+    def test_is_due(self):
+        buffer = RollupBuffer(flush_interval=60)
+        self.assertFalse(buffer.is_due())
+        self.assertTrue(buffer.is_due(0))
+        buffer.last_drain -= 60
+        self.assertTrue(buffer.is_due())
+
+
+class RollupManagerTests(unittest.TestCase):
+    def setUp(self):
+        # Each test gets its own buffer
+        self.addCleanup(setattr, rollups_module, '_buffer', rollups_module._buffer)
+        self.addCleanup(setattr, rollups_module, '_buffer_pid', rollups_module._buffer_pid)
+        rollups_module._buffer = None
+        # Only the writer is used, not the database
+        self.manager = RollupManager.__new__(RollupManager)
+
+    def test_record_queues_when_due(self):
+        writer = FakeWriter()
+        self.manager.record(make_exchange(), writer=writer, flush_interval=60)
+        self.assertEqual(writer.actions, [])
+
+        rollups_module.get_buffer().last_drain -= 60
+        self.manager.record(make_exchange(), writer=writer, flush_interval=60)
+        [action] = writer.actions
+        self.assertEqual(action['_index'], RollupManager.NAME)
+        self.assertEqual(action['_source']['count'], 2)
+
+    def test_flush_due_buffer(self):
+        writer = FakeWriter()
+        self.manager.record(make_exchange(), writer=writer, flush_interval=60)
+        rollups_module._flush_due_buffer(writer)
+        self.assertEqual(writer.actions, [])
+
+        rollups_module.get_buffer().last_drain -= 60
+        rollups_module._flush_due_buffer(writer)
+        self.assertEqual(len(writer.actions), 1)
+
+    def test_flush_buffer_on_close(self):
+        writer = FakeWriter()
+        self.manager.record(make_exchange(), writer=writer, flush_interval=60)
+        rollups_module._flush_buffer(writer)
+        self.assertEqual(len(writer.actions), 1)
+
+    def test_flushed_without_more_exchanges(self):
+        fake_bulk = FakeBulk()
+        self.addCleanup(setattr, bulk_module, 'bulk', bulk_module.bulk)
+        bulk_module.bulk = fake_bulk
+        writer = BulkWriter(None, flush_interval=0.05)
+        self.addCleanup(writer.close)
+
+        # The bucket is indexed by the writer's background thread once due
+        self.manager.record(make_exchange(), writer=writer, flush_interval=0.1)
+        self.assertTrue(fake_bulk.called.wait(5))
+        [action] = fake_bulk.actions
+        self.assertEqual(action['_source']['count'], 1)
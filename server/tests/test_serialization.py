@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import unittest
+
+from server import serialization
+from server.streaming import iter_json
+
+EXAMPLE = {'patient': {'id': '1', 'label': 'Ça/va', 'score': 0.25, 'features': [{'id': 'HP:0000522'}]}}
+
+
+class SerializerTests(unittest.TestCase):
+    def test_backends_round_trip(self):
+        for backend in serialization.get_available_backends():
+            serializer = serialization.Serializer(backend)
+            data = serializer.dumps(EXAMPLE)
+            self.assertIsInstance(data, bytes)
+            self.assertEqual(json.loads(data.decode('utf-8')), EXAMPLE)
+            self.assertEqual(serializer.loads(data), EXAMPLE)
+            self.assertEqual(serializer.loads(data.decode('utf-8')), EXAMPLE)
+
+    def test_stdlib_always_available(self):
+        self.assertIn('json', serialization.get_available_backends())
+        self.assertFalse(serialization.Serializer('json').is_fast)
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            serialization.Serializer('pickle')
+
+    def test_iter_json_with_each_backend(self):
+        original = serialization.get_serializer().backend
+        try:
+            for backend in serialization.get_available_backends():
+                serialization.configure(backend)
+                data = b''.join(iter_json(EXAMPLE, chunk_size=8))
+                self.assertEqual(json.loads(data.decode('utf-8')), EXAMPLE)
+        finally:
+            serialization.configure(original)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import json
+import unittest
+
+from server.shaping import gunzip_data, gzip_data, get_stripped_fields, strip_fields, validate_profile, OPTIONAL_FIELDS
+from server.streaming import ResponseTooLarge
+
+
+class ShapingTests(unittest.TestCase):
+    def setUp(self):
+        self.request = {
+            'patient': {
+                'id': 'P1',
+                'label': 'patient 1',
+                'contact': {'name': 'Contact', 'href': 'mailto:contact@example.com', 'institution': 'Example'},
+                'features': [
+                    {'id': 'HP:0000252', 'label': 'Microcephaly', 'observed': 'yes'},
+                    {'id': 'HP:0000522'},
+                ],
+                'genomicFeatures': [
+                    {'gene': {'id': 'EFTUD2', 'label': 'EFTUD2'}, 'zygosity': 1},
+                ],
+            }
+        }
+
+    def test_strip_fields(self):
+        fields = get_stripped_fields({'fields': ['patient.features.label']})
+        stripped = strip_fields(self.request, fields)
+
+        patient = stripped['patient']
+        self.assertNotIn('label', patient)
+        self.assertEqual(patient['contact'], {'name': 'Contact', 'href': 'mailto:contact@example.com'})
+        self.assertEqual(patient['features'], self.request['patient']['features'])
+        self.assertEqual(patient['genomicFeatures'], [{'gene': {'id': 'EFTUD2'}}])
+        # The original is unchanged
+        self.assertEqual(self.request['patient']['label'], 'patient 1')
+        self.assertEqual(self.request['patient']['genomicFeatures'][0]['zygosity'], 1)
+
+    def test_no_profile(self):
+        self.assertEqual(get_stripped_fields(None), ())
+        self.assertEqual(get_stripped_fields({'gzip_requests': True}), ())
+        self.assertEqual(get_stripped_fields({'fields': []}), tuple(OPTIONAL_FIELDS))
+        self.assertIs(strip_fields(self.request, ()), self.request)
+
+    def test_validate_profile(self):
+        validate_profile({'fields': ['patient.sex'], 'gzip_requests': True})
+        with self.assertRaises(ValueError):
+            validate_profile({'fields': ['patient.id']})
+        with self.assertRaises(ValueError):
+            validate_profile({'gzip': True})
+
+    def test_gzip(self):
+        data = json.dumps(self.request).encode('utf-8') * 10
+        compressed = gzip_data(data)
+        self.assertTrue(len(compressed) < len(data))
+        self.assertEqual(gzip_data(data), compressed)
+        self.assertEqual(gunzip_data(compressed), data)
+        self.assertEqual(gunzip_data(compressed, max_size=len(data)), data)
+        with self.assertRaises(ResponseTooLarge):
+            gunzip_data(compressed, max_size=len(data) - 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import random
+import unittest
+
+from server.sketch import LatencySketch, RELATIVE_ACCURACY
+
+
+class LatencySketchTests(unittest.TestCase):
+    def test_empty(self):
+        self.assertIsNone(LatencySketch().quantile(0.5))
+
+    def test_quantiles_within_accuracy(self):
+        random.seed(0)
+        values = sorted(random.lognormvariate(-1, 1) for i in range(10000))
+        sketch = LatencySketch()
+        for value in values:
+            sketch.add(value)
+
+        for q in [0.5, 0.95, 0.99]:
+            exact = values[int(q * (len(values) - 1))]
+            self.assertAlmostEqual(sketch.quantile(q) / exact, 1, delta=RELATIVE_ACCURACY * 1.01)
+
+    def test_merge_matches_combined(self):
+        combined = LatencySketch()
+        parts = [LatencySketch(), LatencySketch()]
+        for i in range(1, 1000):
+            value = i / 100
+            combined.add(value)
+            parts[i % 2].add(value)
+
+        merged = LatencySketch(parts[0].to_dict())
+        merged.merge(parts[1])
+        self.assertEqual(merged.count, combined.count)
+        self.assertEqual(merged.quantile(0.9), combined.quantile(0.9))
+
+    def test_small_values(self):
+        sketch = LatencySketch()
+        sketch.add(0)
+        sketch.add(0.0001)
+        self.assertEqual(sketch.quantile(1), 0.001)
+
+
+if __name__ == '__main__':
+    unittest.main()
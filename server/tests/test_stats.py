@@ -0,0 +1,80 @@
+import unittest
+
+from datetime import datetime, timedelta
+
+from server.managers.payloads import PayloadManager
+from server.managers.stats import StatsManager
+from server.managers import partitions
+
+
+class FakeIndices:
+    """Stands in for the Elasticsearch indices API, with the number of segments of each index"""
+    def __init__(self, segments):
+        self.segments_by_index = segments
+        self.deleted = []
+        self.merged = []
+
+    def get_settings(self, index):
+        prefix = index.rstrip('*')
+        return dict((name, {}) for name in self.segments_by_index if name.startswith(prefix))
+
+    def exists(self, index):
+        return index in self.segments_by_index
+
+    def segments(self, index):
+        return {'indices': dict((name, {'shards': {'0': [{'num_search_segments': self.segments_by_index[name]}]}})
+                                for name in index.split(','))}
+
+    def delete(self, index):
+        self.deleted.append(index)
+
+    def forcemerge(self, index, max_num_segments=None):
+        self.merged.append(index)
+
+
+class FakeDB:
+    def __init__(self, segments):
+        self.indices = FakeIndices(segments)
+
+
+def get_partition(prefix, months_ago):
+    start = partitions.get_partition_start(datetime.now())
+    for i in range(months_ago):
+        start = partitions.get_partition_start(start - timedelta(days=1))
+    return partitions.get_partition_name(prefix, start)
+
+
+class RetentionTests(unittest.TestCase):
+    def setUp(self):
+        # Only the database is used, through the fake
+        self.stats = StatsManager.__new__(StatsManager)
+
+    def test_payload_index(self):
+        now = datetime.now()
+        self.assertEqual(StatsManager.get_payload_index(now), get_partition(PayloadManager.NAME, 0))
+        self.assertNotEqual(StatsManager.get_payload_index(now), StatsManager.get_index(now))
+
+    def test_payloads_deleted_with_exchanges(self):
+        old, merged, recent, current = [4, 2, 1, 0]
+        segments = {}
+        for prefix in [StatsManager.NAME, PayloadManager.NAME]:
+            segments.update({
+                get_partition(prefix, old): 5,
+                get_partition(prefix, merged): 1,
+                get_partition(prefix, recent): 5,
+                get_partition(prefix, current): 5,
+            })
+        self.stats._db = FakeDB(segments)
+
+        actions = self.stats.apply_retention(keep_days=75, forcemerge_days=0, dry_run=True)
+        self.assertEqual(self.stats._db.indices.deleted, [])
+        self.assertEqual(sorted(index for action, index in actions if action == 'delete'),
+                         sorted(get_partition(prefix, old) for prefix in [StatsManager.NAME, PayloadManager.NAME]))
+
+        # Partitions merged by an earlier run, and the current ones, are not merged
+        self.assertEqual(sorted(index for action, index in actions if action == 'forcemerge'),
+                         sorted(get_partition(prefix, recent) for prefix in [StatsManager.NAME, PayloadManager.NAME]))
+
+        self.assertEqual(self.stats.apply_retention(keep_days=75, forcemerge_days=0), actions)
+        self.assertEqual(len(self.stats._db.indices.deleted), 2)
+        self.assertEqual(len(self.stats._db.indices.merged), 2)
@@ -0,0 +1,41 @@
+import io
+import json
+import unittest
+
+from server.streaming import iter_json, iter_json_lines, load_json, ResponseTooLarge
+
+
+class LoadJsonTests(unittest.TestCase):
+    def test_load(self):
+        data = {'results': [{'score': {'patient': 0.5}, 'patient': {'id': '1'}}]}
+        body = io.BytesIO(json.dumps(data).encode('utf-8'))
+        self.assertEqual(load_json(body), data)
+
+    def test_max_size(self):
+        body = io.BytesIO(json.dumps({'results': ['x' * 100]}).encode('utf-8'))
+        with self.assertRaises(ResponseTooLarge):
+            load_json(body, max_size=50)
+
+    def test_content_length_checked_first(self):
+        body = io.BytesIO(b'{}')
+        with self.assertRaises(ResponseTooLarge):
+            load_json(body, max_size=50, content_length='1000')
+
+
+class IterJsonTests(unittest.TestCase):
+    def test_chunks(self):
+        data = {'results': [{'patient': {'id': str(i)}} for i in range(100)]}
+        chunks = list(iter_json(data, chunk_size=64))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(json.loads(b''.join(chunks).decode('utf-8')), data)
+
+    def test_lines(self):
+        objs = [{'patient': {'id': str(i)}} for i in range(100)]
+        chunks = list(iter_json_lines(iter(objs), chunk_size=64))
+        self.assertTrue(len(chunks) > 1)
+        self.assertTrue(all(chunk.endswith(b'\n') for chunk in chunks))
+        self.assertEqual([json.loads(line.decode('utf-8')) for line in b''.join(chunks).splitlines()], objs)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from server.metrics import stage_seconds
+from server.tracing import (FileExporter, activate, end_trace, format_server_timing, get_current_trace, span,
+                            stage, start_trace)
+
+
+class TracingTests(unittest.TestCase):
+    def tearDown(self):
+        end_trace()
+
+    def test_spans(self):
+        trace = start_trace('match')
+        with span('normalize_request'):
+            pass
+        with span('upstream', server='a'):
+            pass
+        self.assertIs(end_trace(), trace)
+        self.assertIsNone(get_current_trace())
+
+        data = trace.to_dict()
+        self.assertEqual([s['name'] for s in data['spans']], ['normalize_request', 'upstream'])
+        self.assertEqual(data['spans'][1]['attributes'], {'server': 'a'})
+        self.assertTrue(data['duration'] >= data['spans'][1]['start'] >= 0)
+
+    def test_no_trace(self):
+        with span('upstream'):
+            pass
+        self.assertIsNone(get_current_trace())
+
+    def test_stage_observed_without_trace(self):
+        def count():
+            return sum(value['count'] for key, value in stage_seconds.snapshot()['series'] if key == ['tracing_test'])
+
+        before = count()
+        with stage('tracing_test'):
+            pass
+        self.assertEqual(count(), before + 1)
+
+    def test_activate_in_other_thread(self):
+        trace = start_trace('broadcast')
+
+        def run():
+            with activate(trace):
+                with span('upstream', server='b'):
+                    pass
+            self.assertIsNone(get_current_trace())
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        self.assertEqual([s.name for s in end_trace().spans], ['upstream'])
+
+    def test_server_timing(self):
+        trace = start_trace('match')
+        trace.add_span('parse_request', trace.start, trace.start + 0.0015)
+        trace.add_span('upstream', trace.start + 0.002, trace.start + 0.1, server='my "server"')
+        end_trace()
+        header = format_server_timing(trace)
+        self.assertTrue(header.startswith('parse_request;dur=1.500, upstream;dur=98.000;desc="my \\"server\\""'))
+        self.assertIn(', total;dur=', header)
+
+
+class FileExporterTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_export(self):
+        path = os.path.join(self.directory, 'traces.jsonl')
+        exporter = FileExporter(path)
+        for name in ['a', 'b']:
+            start_trace(name)
+            exporter.export(end_trace())
+
+        with open(path) as ifp:
+            traces = [json.loads(line) for line in ifp]
+        self.assertEqual([trace['name'] for trace in traces], ['a', 'b'])
@@ -0,0 +1,98 @@
+import json
+import unittest
+
+from server.tests.test_app import EXAMPLE_REQUEST
+
+
+class FakeModel:
+    """Stands in for the reference server's models, which look up terms in the database"""
+    def __init__(self, data):
+        self.data = data
+
+    @classmethod
+    def from_api(cls, data):
+        return cls(data)
+
+    def to_api(self):
+        return json.loads(json.dumps(self.data))
+
+
+class ValidateOnceTests(unittest.TestCase):
+    def setUp(self):
+        import server
+        from server.metrics import stage_seconds
+
+        self.server = server
+        self.stage_seconds = stage_seconds
+        self.validated = []
+        for name in ['validate_request', 'validate_response', 'MatchRequest', 'MatchResponse']:
+            self.addCleanup(setattr, server, name, getattr(server, name))
+        server.validate_request = self.counting(server.validate_request, 'request')
+        server.validate_response = self.counting(server.validate_response, 'response')
+        server.MatchRequest = server.MatchResponse = FakeModel
+
+        config = server.app.config
+        self.addCleanup(config.__setitem__, 'VALIDATION_MODE', config.get('VALIDATION_MODE', 'input'))
+        config['VALIDATION_MODE'] = 'input'
+
+        for kind in ['request', 'response']:
+            server.get_normalization_cache(kind).clear()
+
+    def counting(self, validate, kind):
+        def wrapper(data):
+            self.validated.append(kind)
+            return validate(data)
+        return wrapper
+
+    def count_stage(self, stage):
+        return sum(value['count'] for key, value in self.stage_seconds.snapshot()['series'] if key == [stage])
+
+    def post_request(self, data):
+        app = self.server.app
+        with app.test_request_context('/v1/servers/test/match', method='POST', data=json.dumps(data)):
+            return self.server.get_request(self.server.flask_request)
+
+    def test_request_validated_once(self):
+        before = self.count_stage('validate_request')
+        request = self.post_request(EXAMPLE_REQUEST)
+
+        # Preparing the request for several servers doesn't validate it again
+        request.get_normalized_data()
+        request.get_normalized_data(('patient.label',))
+        request.get_normalized_hash()
+        self.assertEqual(self.validated, ['request'])
+        self.assertEqual(self.count_stage('validate_request'), before + 1)
+
+    def test_identical_request_not_normalized_again(self):
+        before = self.count_stage('normalize_request')
+        self.post_request(EXAMPLE_REQUEST)
+        self.post_request(EXAMPLE_REQUEST)
+        self.assertEqual(self.count_stage('normalize_request'), before + 1)
+
+    def test_response_validated_once(self):
+        before = self.count_stage('validate_response')
+        body = {'results': []}
+        response = self.server.MMEResponse({'patient': {}}, body)
+        response.get_response()
+        response.get_normalized()
+        self.assertEqual(self.validated, ['response'])
+
+        # An identical response is normalized from the cache
+        self.server.MMEResponse({'patient': {}}, body)
+        self.assertEqual(self.validated, ['response'])
+        self.assertEqual(self.count_stage('validate_response'), before + 1)
+
+    def test_stages_traced(self):
+        from server.tracing import end_trace, start_trace
+
+        trace = start_trace('match_server')
+        try:
+            self.post_request(EXAMPLE_REQUEST)
+        finally:
+            end_trace()
+        self.assertEqual([span.name for span in trace.spans],
+                         ['parse_request', 'validate_request', 'normalize_request'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,213 @@
+"""
+Lightweight per-request tracing
+
+A trace is started for each request, and the stages of handling it are
+recorded as spans, timed with a monotonic high-resolution clock. Finished
+traces are passed to an exporter, and can be summarized in a Server-Timing
+header. The current trace is kept per thread; work handed to other threads
+must activate it there.
+"""
+
+from __future__ import with_statement, division, unicode_literals
+
+import json
+import logging
+import threading
+import time
+import uuid
+
+from contextlib import contextmanager
+
+from .compat import import_optional
+from .metrics import clock, stage_seconds
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class Span:
+    """A timed operation within a trace"""
+    def __init__(self, name, start, end, attributes=None):
+        self.name = name
+        self.start = start
+        self.end = end
+        self.attributes = attributes or {}
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+
+class Trace:
+    """The spans recorded while handling a single request"""
+    def __init__(self, name, trace_id=None):
+        self.name = name
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.timestamp = time.time()
+        self.start = clock()
+        self.end = None
+        self.attributes = {}
+        self._lock = threading.Lock()
+        self.spans = []
+
+    def add_span(self, name, start, end, **attributes):
+        with self._lock:
+            self.spans.append(Span(name, start, end, attributes))
+
+    def finish(self):
+        self.end = clock()
+
+    def to_dict(self):
+        """Get the trace as a JSON-serializable dict, with times in milliseconds from its start"""
+        with self._lock:
+            spans = list(self.spans)
+        return {
+            'traceId': self.trace_id,
+            'name': self.name,
+            'timestamp': self.timestamp,
+            'duration': ((self.end or clock()) - self.start) * 1000,
+            'attributes': self.attributes,
+            'spans': [{
+                'name': span.name,
+                'start': (span.start - self.start) * 1000,
+                'duration': span.duration * 1000,
+                'attributes': span.attributes,
+            } for span in sorted(spans, key=lambda span: span.start)],
+        }
+
+
+def start_trace(name):
+    """Start a trace, as the current trace of this thread"""
+    trace = _local.trace = Trace(name)
+    return trace
+
+
+def get_current_trace():
+    """Get the current trace of this thread, or None"""
+    return getattr(_local, 'trace', None)
+
+
+def end_trace():
+    """Finish the current trace of this thread, returning it (or None)"""
+    trace = get_current_trace()
+    _local.trace = None
+    if trace is not None:
+        trace.finish()
+    return trace
+
+
+@contextmanager
+def activate(trace):
+    """Make the trace (possibly None) the current trace of this thread, for the block"""
+    previous = get_current_trace()
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+
+def add_span(name, start, end, **attributes):
+    """Add a span timed by the caller to the current trace, if any"""
+    trace = get_current_trace()
+    if trace is not None:
+        trace.add_span(name, start, end, **attributes)
+
+
+@contextmanager
+def span(name, **attributes):
+    """Record the block as a span of the current trace, if any"""
+    trace = get_current_trace()
+    if trace is None:
+        yield
+        return
+
+    start = clock()
+    try:
+        yield
+    finally:
+        trace.add_span(name, start, clock(), **attributes)
+
+
+@contextmanager
+def stage(name, **attributes):
+    """Time the block as a stage of request handling
+
+    The time is observed in the stage_seconds metric, and recorded as a span
+    of the current trace, if any.
+    """
+    start = clock()
+    try:
+        yield
+    finally:
+        end = clock()
+        stage_seconds.observe(end - start, stage=name)
+        add_span(name, start, end, **attributes)
+
+
+def _escape(value):
+    return '{}'.format(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def format_server_timing(trace):
+    """Format the trace's spans as a Server-Timing header value"""
+    metrics = []
+    for span in sorted(trace.spans, key=lambda span: span.start):
+        metric = '{};dur={:.3f}'.format(span.name, span.duration * 1000)
+        server = span.attributes.get('server')
+        if server:
+            metric += ';desc="{}"'.format(_escape(server))
+        metrics.append(metric)
+    if trace.end is not None:
+        metrics.append('total;dur={:.3f}'.format((trace.end - trace.start) * 1000))
+    return ', '.join(metrics)
+
+
+class FileExporter:
+    """Appends finished traces to a file, one JSON object per line"""
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, trace):
+        line = json.dumps(trace.to_dict(), separators=(',', ':')) + '\n'
+        try:
+            with self._lock:
+                with open(self.path, 'a') as ofp:
+                    ofp.write(line)
+        except (IOError, OSError) as e:
+            logger.warning('Error exporting trace: {}'.format(e))
+
+
+class NullExporter:
+    """Discards traces"""
+    def export(self, trace):
+        pass
+
+
+_exporters = {}
+_exporters_lock = threading.Lock()
+
+
+def get_exporter(name=None, path=None):
+    """Get the trace exporter for this process
+
+    name - 'file' (to path), None to discard traces, or the import path of a
+        class (module:Class) that is created with path, and has an export(trace) method
+    """
+    with _exporters_lock:
+        key = (name, path)
+        if key not in _exporters:
+            if not name:
+                exporter = NullExporter()
+            elif name == 'file':
+                exporter = FileExporter(path)
+            else:
+                module_name, class_name = name.split(':')
+                module = import_optional(module_name)
+                if module is None:
+                    raise ValueError('Trace exporter not found: {}'.format(name))
+                exporter = getattr(module, class_name)(path)
+            _exporters[key] = exporter
+        return _exporters[key]